@@ -12,12 +12,18 @@
  *    [New Location1 value: 00000000 00000000 00000000 00000010]
  */
 
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE /* copy_file_range(), SEEK_DATA and SEEK_HOLE */
+#endif
+
 #include "pmfuzz.h"
 #include "rtinfo.h"
 
 #include <assert.h>
 #include <err.h>
+#include <errno.h>
 #include <execinfo.h>
+#include <fcntl.h>
 #include <libunwind.h>
 #include <pthread.h>
 #include <signal.h>
@@ -25,12 +31,15 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/ioctl.h>
+#include <sys/stat.h>
 #include <sys/types.h>
 #include <sys/wait.h>
 #include <time.h>
 #include <ucontext.h>
 #include <unistd.h>
 #include <unwind.h>
+#include <linux/fs.h>
 
 #ifndef DISABLE_PMFUZZ
 
@@ -57,6 +66,12 @@ extern uint8_t      *__last_pmfuzz_area_ptr;
 /* Maximum number of crash sites to generate */
 #define MAX_CRASH_DUMP_ID (10000)
 
+/* Regions of the map changed since they last matched __last_pmfuzz_area_ptr,
+   one bit per 1/64th of the map. The map only changes through update_loc(),
+   so a failure point only compares and copies the regions set here. All the
+   regions start dirty, the map is shared with the fuzzer. */
+static uint64_t     __pmfuzz_dirty_regions = ~0ULL;
+
 /* Failure point variables */
 uint8_t             pmfuzz_init_complete = 0;
 uint32_t            __pmfuzz_failure_id = -1; // Initialize to -1
@@ -70,6 +85,7 @@ FILE*               failure_list_file;
 #define FI_IMG_SUFFIX_ENV   "FI_IMG_SUFFIX" /* Suffix for crash sites */
 #define GEN_ALL_CS_ENV      "GEN_ALL_CS"    /* Makes selection probability 1 */
 #define IMG_CREAT_FINJ_ENV  "IMG_CREAT_FINJ"/* Enables all images for failure inj during creation */
+#define FI_DUMP_STATS_ENV   "FI_DUMP_STATS" /* File to append dump latencies to */
 
 /* Modes for failure injection */
 #define TEST_MODE           "TEST"          /* Run on top of testing tool */
@@ -77,17 +93,6 @@ FILE*               failure_list_file;
 #define IMG_GEN_MODE        "IMG_GEN"       /* Generate crash image */
 #define IMG_REP_MODE        "IMG_REP"       /* Reproduce image */
 
-#define debug(...) do {\
-    if (getenv(PMFUZZ_DEBUG_ENV)) {\
-        if (strcmp("1", getenv(PMFUZZ_DEBUG_ENV)) == 0) {\
-            dprintf(2, __VA_ARGS__);\
-        }\
-    }\
-} while(0);
-
-#define debug_enabled (getenv(PMFUZZ_DEBUG_ENV) && \
-        strcmp("1", getenv(PMFUZZ_DEBUG_ENV)) == 0)
-
 /**
  * @enum FIMode
  * @brief Failure injection mode
@@ -99,6 +104,40 @@ typedef enum {
     FIM_MAX     = 3,
 } FIMode_t;
 
+/**
+ * @brief Environment of the failure injection and the instrumentation, read
+ * once per process by @ref pmfuzz_load_cfg() instead of on every PM access
+ * and failure point
+ */
+typedef struct {
+    uint8_t     loaded;         /* Set once the environment is read */
+    uint8_t     debug;          /* PMFUZZ_DEBUG=1 */
+    uint8_t     pm_path;        /* ENABLE_PM_PATH or UNFOCUSSED_MODE set */
+    uint8_t     post_failure;   /* POST_FAILURE set */
+    uint8_t     gen_all_cs;     /* GEN_ALL_CS set */
+    uint8_t     img_creat_finj; /* IMG_CREAT_FINJ set */
+    uint8_t     fake_mmap;      /* USE_FAKE_MMAP=1 */
+    FIMode_t    fi_mode;        /* FI_MODE, FIM_NONE till pmfuzz_init() */
+    const char *img_suffix;     /* FI_IMG_SUFFIX, "" if unset */
+    const char *dump_stats;     /* FI_DUMP_STATS, NULL if unset or empty */
+} PMFuzzCfg_t;
+
+static PMFuzzCfg_t pmfuzz_cfg = {0};
+
+static PMFuzzCfg_t *pmfuzz_load_cfg(void);
+
+/* Config of the process, the environment is read on the first use */
+#define PMFUZZ_CFG (__builtin_expect(pmfuzz_cfg.loaded, 1) \
+        ? &pmfuzz_cfg : pmfuzz_load_cfg())
+
+#define debug(...) do {\
+    if (PMFUZZ_CFG->debug) {\
+        dprintf(2, __VA_ARGS__);\
+    }\
+} while(0);
+
+#define debug_enabled (PMFUZZ_CFG->debug)
+
 /* Compute the next highest power of 2 of 32-bit val */
 uint32_t get_next_pow_2(uint32_t val) {
     val--;
@@ -111,13 +150,79 @@ uint32_t get_next_pow_2(uint32_t val) {
     return val;
 }
 
+/**
+ * @brief log2 of the size of a region of the map, see __pmfuzz_dirty_regions
+ * @return Shift, the map is split in at most 64 regions
+ */
+static inline uint32_t dirty_region_shift() {
+    if (__pmfuzz_map_size <= 64)
+        return 0;
+    return 32 - __builtin_clz(__pmfuzz_map_size - 1) - 6;
+}
+
+/**
+ * @brief Bit of the region of the map containing a byte
+ * @param off Offset of the byte in the map
+ * @return Mask with the region's bit set
+ */
+static inline uint64_t dirty_region_bit(uint32_t off) {
+    return 1ULL << ((off >> dirty_region_shift()) & 63);
+}
+
+/**
+ * @brief Compares the dirty regions of the map to __last_pmfuzz_area_ptr,
+ * the regions found unchanged are no longer dirty
+ * @return Mask of the regions that differ
+ */
+static uint64_t diff_dirty_regions() {
+    uint64_t result = 0;
+    uint32_t region_sz = 1U << dirty_region_shift();
+
+    for (uint64_t dirty = __pmfuzz_dirty_regions; dirty; dirty &= dirty - 1) {
+        uint32_t start = __builtin_ctzll(dirty)*region_sz;
+        if (start >= __pmfuzz_map_size)
+            continue;
+
+        uint32_t len = __pmfuzz_map_size - start < region_sz 
+                        ? __pmfuzz_map_size - start : region_sz;
+        if (memcmp(__pmfuzz_area_ptr + start, __last_pmfuzz_area_ptr + start,
+                len) != 0) {
+            result |= dirty & -dirty;
+        }
+    }
+
+    __pmfuzz_dirty_regions = result;
+    return result;
+}
+
+/**
+ * @brief Copies the regions of the map in mask to __last_pmfuzz_area_ptr,
+ * they are no longer dirty
+ * @return void
+ */
+static void save_dirty_regions(uint64_t mask) {
+    uint32_t region_sz = 1U << dirty_region_shift();
+
+    for (uint64_t todo = mask; todo; todo &= todo - 1) {
+        uint32_t start = __builtin_ctzll(todo)*region_sz;
+        if (start >= __pmfuzz_map_size)
+            continue;
+
+        uint32_t len = __pmfuzz_map_size - start < region_sz 
+                        ? __pmfuzz_map_size - start : region_sz;
+        memcpy(__last_pmfuzz_area_ptr + start, __pmfuzz_area_ptr + start, len);
+    }
+
+    __pmfuzz_dirty_regions &= ~mask;
+}
+
 /**
  * @brief Updates a single element in the whole map
  * @param loc Location of the element to update
  * @return void
 */
 void update_loc(uint32_t loc) {
-    if (getenv("ENABLE_PM_PATH") != NULL || getenv("UNFOCUSSED_MODE") != NULL) {
+    if (PMFUZZ_CFG->pm_path) {
         uint32_t elem_id = loc;
 
         uint32_t cur_loc = elem_id^__pmfuzz_prev_loc;
@@ -125,6 +230,7 @@ void update_loc(uint32_t loc) {
 
         if (__pmfuzz_area_ptr[cur_loc] < COUNTER_CAP) {
             __pmfuzz_area_ptr[cur_loc]++;
+            __pmfuzz_dirty_regions |= dirty_region_bit(cur_loc);
         }
     } else { // For baseline
         if (__pmfuzz_sra_elem_size == 0) {
@@ -137,7 +243,15 @@ void update_loc(uint32_t loc) {
         uint32_t cur_loc = elem_id^__pmfuzz_prev_loc;
         __pmfuzz_prev_loc = elem_id>>1;
 
-        sra_push_back(__pmfuzz_area_ptr, __pmfuzz_map_size, __pmfuzz_sra_elem_size, cur_loc, 0);
+        if (sra_push_back(__pmfuzz_area_ptr, __pmfuzz_map_size, 
+                __pmfuzz_sra_elem_size, cur_loc, 0)) {
+            __pmfuzz_dirty_regions 
+                |= dirty_region_bit(cur_loc*__pmfuzz_sra_elem_size);
+
+            /* Elements span regions in maps with less than 64 elements */
+            if (__pmfuzz_sra_elem_size > (1U << dirty_region_shift()))
+                __pmfuzz_dirty_regions = ~0ULL;
+        }
     }
 }
 
@@ -231,6 +345,367 @@ FIMode_t get_fi_mode() {
     return result;
 }
 
+/**
+ * @brief Reads the environment into @ref pmfuzz_cfg
+ * @return Pointer to @ref pmfuzz_cfg
+ */
+static PMFuzzCfg_t *pmfuzz_load_cfg(void) {
+    const char *debug_str = getenv(PMFUZZ_DEBUG_ENV);
+    const char *fake_mmap_str = getenv("USE_FAKE_MMAP");
+
+    pmfuzz_cfg.debug = debug_str && strcmp("1", debug_str) == 0;
+    pmfuzz_cfg.pm_path = getenv("ENABLE_PM_PATH") != NULL 
+                            || getenv("UNFOCUSSED_MODE") != NULL;
+    pmfuzz_cfg.post_failure = getenv("POST_FAILURE") != NULL;
+    pmfuzz_cfg.gen_all_cs = getenv(GEN_ALL_CS_ENV) != NULL;
+    pmfuzz_cfg.img_creat_finj = getenv(IMG_CREAT_FINJ_ENV) != NULL;
+    pmfuzz_cfg.fake_mmap = fake_mmap_str && strcmp("1", fake_mmap_str) == 0;
+
+    /* FI_MODE is only checked once the pool is known, see pmfuzz_init() */
+    if (pmfuzz_init_complete)
+        pmfuzz_cfg.fi_mode = get_fi_mode();
+
+    pmfuzz_cfg.img_suffix = getenv(FI_IMG_SUFFIX_ENV);
+    if (pmfuzz_cfg.img_suffix == NULL)
+        pmfuzz_cfg.img_suffix = "";
+
+    pmfuzz_cfg.dump_stats = getenv(FI_DUMP_STATS_ENV);
+    if (pmfuzz_cfg.dump_stats != NULL && pmfuzz_cfg.dump_stats[0] == '\0')
+        pmfuzz_cfg.dump_stats = NULL;
+
+    pmfuzz_cfg.loaded = 1;
+
+    return &pmfuzz_cfg;
+}
+
+/**
+ * @brief Makes a forked child, e.g., of the AFL fork server, read its 
+ * environment again on the first use of the config and compare the whole 
+ * map at its first failure point
+ * @return void
+ */
+static void pmfuzz_atfork_child(void) {
+    pmfuzz_cfg.loaded = 0;
+
+    /* The fuzzer resets the map before every run */
+    __pmfuzz_dirty_regions = ~0ULL;
+}
+
+__attribute__((constructor)) static void pmfuzz_register_atfork(void) {
+    pthread_atfork(NULL, NULL, pmfuzz_atfork_child);
+}
+
+/* Granularity of the dirty range tracking of mmap-backed pools */
+#define DUMP_PAGE_SIZE (4096UL)
+
+/**
+ * @brief Last image dumped from an mmap-backed pool, the next dump reflinks
+ * it and only writes the pages that changed since
+ */
+static struct {
+    char     path[1024];    /* Path of the last dump, empty if none */
+    uint8_t *shadow;        /* Contents of the pool at the last dump */
+    size_t   size;          /* Size of the shadow */
+} last_dump = {"", NULL, 0};
+
+/* Time pmfuzz_init() completed, see pmfuzz_report_exit() */
+static uint64_t pmfuzz_init_ns = 0;
+
+static uint64_t get_time_ns() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec*1000000000ULL + ts.tv_nsec;
+}
+
+/**
+ * @brief Writes all of buf to fd at off
+ * @return 0 on success, -1 on failure
+ */
+static int pwrite_all(int fd, const uint8_t *buf, size_t len, off_t off) {
+    while (len > 0) {
+        ssize_t ret = pwrite(fd, buf, len, off);
+        if (ret < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        buf += ret;
+        off += ret;
+        len -= ret;
+    }
+    return 0;
+}
+
+/**
+ * @brief Writes the pages of buf that differ from ref (or are non-zero if
+ * ref is NULL) to fd, consecutive pages are written using one call
+ * @return Bytes written, -1 on failure
+ */
+static ssize_t write_changed_pages(int fd, const uint8_t *buf, 
+        const uint8_t *ref, size_t size) {
+    static const uint8_t zero_page[DUMP_PAGE_SIZE];
+    ssize_t written = 0;
+    size_t run_start = 0, run_len = 0;
+
+    for (size_t off = 0; off < size; off += DUMP_PAGE_SIZE) {
+        size_t len = size - off < DUMP_PAGE_SIZE ? size - off : DUMP_PAGE_SIZE;
+        const uint8_t *cmp = ref ? ref + off : zero_page;
+
+        if (memcmp(buf + off, cmp, len) != 0) {
+            if (run_len == 0)
+                run_start = off;
+            run_len += len;
+            continue;
+        }
+
+        if (run_len > 0) {
+            if (pwrite_all(fd, buf + run_start, run_len, run_start) != 0)
+                return -1;
+            written += run_len;
+            run_len = 0;
+        }
+    }
+
+    if (run_len > 0) {
+        if (pwrite_all(fd, buf + run_start, run_len, run_start) != 0)
+            return -1;
+        written += run_len;
+    }
+
+    return written;
+}
+
+/**
+ * @brief Copies src_fd to dest_fd using copy_file_range() on the data 
+ * extents of src_fd, holes stay holes. dest_fd should be empty.
+ * @return Bytes copied, -1 if the kernel or the file system does not 
+ * support it. Ranges copied before the failure are left in dest_fd.
+ */
+static ssize_t copy_data_ranges(int src_fd, int dest_fd, off_t size) {
+    ssize_t copied = 0;
+    off_t data = 0;
+
+    while (data < size) {
+        data = lseek(src_fd, data, SEEK_DATA);
+        if (data < 0) {
+            if (errno == ENXIO) /* No data till the end of the file */
+                break;
+            return -1;
+        }
+
+        off_t hole = lseek(src_fd, data, SEEK_HOLE);
+        if (hole < 0)
+            return -1;
+
+        loff_t off_in = data, off_out = data;
+        while (off_in < hole) {
+            ssize_t ret = copy_file_range(src_fd, &off_in, dest_fd, &off_out, 
+                hole - off_in, 0);
+            if (ret < 0 && errno == EINTR)
+                continue;
+            if (ret <= 0)
+                return -1;
+            copied += ret;
+        }
+
+        data = hole;
+    }
+
+    if (ftruncate(dest_fd, size) != 0)
+        return -1;
+
+    return copied;
+}
+
+/**
+ * @brief Copies src_fd to dest_fd using read() and write()
+ * @return Bytes copied, -1 on failure
+ */
+static ssize_t copy_rw(int src_fd, int dest_fd) {
+    static uint8_t buf[1 << 20];
+    ssize_t copied = 0;
+    off_t off = 0;
+
+    while (1) {
+        ssize_t ret = pread(src_fd, buf, sizeof(buf), off);
+        if (ret < 0 && errno == EINTR)
+            continue;
+        if (ret < 0)
+            return -1;
+        if (ret == 0)
+            break;
+        if (pwrite_all(dest_fd, buf, ret, off) != 0)
+            return -1;
+
+        off += ret;
+        copied += ret;
+    }
+
+    return copied;
+}
+
+/**
+ * @brief Dumps a file-backed pool, the pool file is reflinked if the file 
+ * system supports it, copied in the kernel otherwise
+ * @param method Set to the method used
+ * @return Bytes written, -1 on failure
+ */
+static ssize_t dump_file_backed(const char *src, int dest_fd, 
+        const char **method) {
+    ssize_t result = -1;
+    struct stat st;
+
+    int src_fd = open(src, O_RDONLY);
+    if (src_fd < 0 || fstat(src_fd, &st) != 0) {
+        perror("Cannot open PM image");
+        goto out;
+    }
+
+    *method = "clone";
+    if (ioctl(dest_fd, FICLONE, src_fd) == 0) {
+        result = 0;
+        goto out;
+    }
+
+    *method = "copy_range";
+    result = copy_data_ranges(src_fd, dest_fd, st.st_size);
+    if (result >= 0)
+        goto out;
+
+    *method = "rw";
+    result = copy_rw(src_fd, dest_fd);
+
+out:
+    if (src_fd >= 0)
+        close(src_fd);
+    return result;
+}
+
+/**
+ * @brief Dumps an mmap-backed pool. The last dump is reflinked and the pages
+ * that changed since are written, if there is no last dump or the file 
+ * system does not support reflinks, only the non-zero pages are written.
+ * @param method Set to the method used
+ * @return Bytes written, -1 on failure
+ */
+static ssize_t dump_mmap_backed(const char *dest, int dest_fd, 
+        const uint8_t *pm_addr, size_t pm_size, const char **method) {
+    ssize_t result;
+    const uint8_t *ref = NULL;
+
+    if (last_dump.shadow != NULL && last_dump.size == pm_size) {
+        int last_fd = open(last_dump.path, O_RDONLY);
+        if (last_fd >= 0) {
+            if (ioctl(dest_fd, FICLONE, last_fd) == 0)
+                ref = last_dump.shadow;
+            close(last_fd);
+        }
+    }
+
+    if (ref != NULL) {
+        *method = "dirty";
+    } else {
+        *method = "sparse";
+        if (ftruncate(dest_fd, pm_size) != 0)
+            return -1;
+    }
+
+    result = write_changed_pages(dest_fd, pm_addr, ref, pm_size);
+    if (result < 0)
+        return -1;
+
+    /* Remember this dump for the next one */
+    if (last_dump.size != pm_size) {
+        free(last_dump.shadow);
+        last_dump.shadow = malloc(pm_size);
+        last_dump.size = last_dump.shadow ? pm_size : 0;
+    }
+    if (last_dump.shadow != NULL && strlen(dest) < sizeof(last_dump.path)) {
+        memcpy(last_dump.shadow, pm_addr, pm_size);
+        strcpy(last_dump.path, dest);
+    } else {
+        last_dump.path[0] = '\0';
+    }
+
+    return result;
+}
+
+/**
+ * @brief Appends a line to the file in `FI_DUMP_STATS`, if set
+ * @return void
+ */
+static void append_dump_stats(uint32_t failure_id, const char *method, 
+        ssize_t bytes, uint64_t ns) {
+    const char *stats_path = PMFUZZ_CFG->dump_stats;
+    if (stats_path == NULL)
+        return;
+
+    int stats_fd = open(stats_path, O_WRONLY | O_CREAT | O_APPEND, 0644);
+    if (stats_fd >= 0) {
+        dprintf(stats_fd, "%u %s %zd %lu\n", failure_id, method, bytes, 
+            (unsigned long)ns);
+        close(stats_fd);
+    }
+}
+
+/**
+ * @brief Dumps the PM pool to a crash site without starting a process
+ *
+ * If `USE_FAKE_MMAP=1`, the pool lives in memory at `PM_ADDR` and is written
+ * using @ref dump_mmap_backed(), otherwise the pool file at `TC_NAME` is 
+ * copied using @ref dump_file_backed(). If `FI_DUMP_STATS` is set, a line 
+ * with the failure id, the method, the bytes written and the latency in ns
+ * is appended to the file it points to. A line with the method `exit` is 
+ * appended when the process exits, see @ref pmfuzz_report_exit().
+ * @param dest Path of the crash site
+ * @return void
+ */
+static void pmfuzz_dump_image(const char *dest) {
+    uint64_t start = get_time_ns();
+    const char *method = "none";
+    ssize_t written = -1;
+
+    int dest_fd = open(dest, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    if (dest_fd < 0) {
+        perror("Cannot open output file");
+        return;
+    }
+
+    if (PMFUZZ_CFG->fake_mmap) {
+        uint8_t *pm_addr = (uint8_t*)strtoull(getenv("PM_ADDR"), NULL, 10);
+        size_t pm_size = strtoull(getenv("PM_SIZE"), NULL, 10);
+
+        written = dump_mmap_backed(dest, dest_fd, pm_addr, pm_size, &method);
+    } else {
+        written = dump_file_backed(getenv("TC_NAME"), dest_fd, &method);
+    }
+
+    close(dest_fd);
+
+    if (written < 0) {
+        dprintf(2, "[FI] Cannot dump the PM image to %s (%s): %s\n", dest, 
+            method, strerror(errno));
+        return;
+    }
+
+    uint64_t elapsed = get_time_ns() - start;
+    debug("[FI] Dumped %zd bytes using %s in %lu ns\n", written, method, 
+        (unsigned long)elapsed);
+
+    append_dump_stats(__pmfuzz_failure_id, method, written, elapsed);
+}
+
+/**
+ * @brief Appends the number of failure points and the time since 
+ * @ref pmfuzz_init() to `FI_DUMP_STATS` as method `exit`, registered using
+ * atexit()
+ * @return void
+ */
+static void pmfuzz_report_exit(void) {
+    append_dump_stats(__pmfuzz_failure_id + 1, "exit", 0, 
+        get_time_ns() - pmfuzz_init_ns);
+}
+
 /**
  * @brief Injects a failure point, creating a copy of the PM pool
  * Failure injection works in three modes:
@@ -245,6 +720,8 @@ FIMode_t get_fi_mode() {
  * 1. `FI_MODE={<empty or unset>|IMG_GEN|IMG_REP}`
  * 2. `FAILURE_LIST=<path to file to write failure ids to>`
  * 3. `FI_IMG_SUFFIX=<suffix>`: Used for suffixing generated crash sites.
+ * 4. `FI_DUMP_STATS=<path>`: Appends the latency of every dump to the file,
+ *    see @ref pmfuzz_dump_image()
  *
  * ### Modes
  * #### 1. None
@@ -276,7 +753,7 @@ void pmfuzz_inject_failure(char* file, int line) {
     __pmfuzz_failure_id++;
 
     // Debugging
-    if (!getenv("POST_FAILURE"))
+    if (!PMFUZZ_CFG->post_failure)
         debug("[FI] Failure ID %d at %s : %d\n", __pmfuzz_failure_id, file, line);
 
     // Debugging
@@ -290,7 +767,7 @@ void pmfuzz_inject_failure(char* file, int line) {
         return;
     }
 
-    FIMode_t mode = get_fi_mode();
+    FIMode_t mode = PMFUZZ_CFG->fi_mode;
     debug("Mode = %d\n", mode)
     switch (mode) {
         case FIM_NONE: {
@@ -314,8 +791,6 @@ void pmfuzz_inject_failure(char* file, int line) {
             /* Genearte PM image if PM bitmap has changed:
                 1. Program generates PM image (IMG_GEN_MODE):
                     Only when PM bitmap has changed */
-            int pm_bitmap_diff = memcmp(__pmfuzz_area_ptr, 
-                __last_pmfuzz_area_ptr, __pmfuzz_map_size);
 
             /* Decrease the probablity of a selecting a failure point as the 
             failure id increases until MAX_CRASH_DUMP_ID. Probability is 0 
@@ -333,7 +808,7 @@ void pmfuzz_inject_failure(char* file, int line) {
             }
 
             /* If asked for, generated all the crash sites */
-            if (getenv(GEN_ALL_CS_ENV) != NULL) {
+            if (PMFUZZ_CFG->gen_all_cs) {
                 if ((__pmfuzz_failure_id < 100) && (__pmfuzz_failure_id%5 == 0)) {
                     save_img = 1;
                 } else {
@@ -341,15 +816,22 @@ void pmfuzz_inject_failure(char* file, int line) {
                 }
             }
 
-            if (getenv(IMG_CREAT_FINJ_ENV) != NULL) {
+            if (PMFUZZ_CFG->img_creat_finj) {
                 debug("[FI] Enabling failure image generation for all failure "
                     "points, %s=1\n", IMG_CREAT_FINJ_ENV);
                 save_img = 1;
             }
 
+            /* Only the regions changed since the last comparison are 
+               compared, nothing is compared if the map did not change */
+            uint64_t pm_bitmap_diff = 0;
+            if (save_img && __pmfuzz_dirty_regions) {
+                pm_bitmap_diff = diff_dirty_regions();
+            }
+
             if (pm_bitmap_diff && save_img) {
                 /* PM bit map updated: copy bitmap and inject failure */
-                memcpy(__last_pmfuzz_area_ptr, __pmfuzz_area_ptr, __pmfuzz_map_size);
+                save_dirty_regions(pm_bitmap_diff);
 
                 /* Enable failure point injection */
                 inject_failure = 1;
@@ -366,10 +848,7 @@ void pmfuzz_inject_failure(char* file, int line) {
         }
     }
 
-    char *tc_suffix = getenv(FI_IMG_SUFFIX_ENV);
-    if (tc_suffix == NULL) {
-        tc_suffix = "";
-    }
+    const char *tc_suffix = PMFUZZ_CFG->img_suffix;
 
     /* Create child process */
     if (inject_failure) {
@@ -398,26 +877,7 @@ void pmfuzz_inject_failure(char* file, int line) {
         
         debug("[FI] Saving image to %s\n", tc_name);
         
-        if (getenv("USE_FAKE_MMAP") 
-                && !strcmp(getenv("USE_FAKE_MMAP"), "1")) {
-
-            FILE *pm_out = fopen(tc_name, "wb");
-            if (pm_out) {
-                /* Dump pm data to image */
-                char *pm_addr_str = getenv("PM_ADDR");
-                uint64_t pm_addr = strtoull(pm_addr_str, NULL, 10);
-                int pm_size = atoi(getenv("PM_SIZE"));
-                fwrite((void*)pm_addr, pm_size, 1, pm_out); 
-                fclose(pm_out);
-            } else {
-                perror("Cannot open output file");
-            }
-        } else {    
-            char cmd[16384];
-            /* Copy current PM image */
-            sprintf(cmd, "cp '%s' '%s'", getenv("TC_NAME"), tc_name);
-            system(cmd);
-        }
+        pmfuzz_dump_image(tc_name);
 
         if (mode == FIM_IMG_GEN && failure_list_file != NULL) {
             /* Print failure id to failure_list_file */
@@ -469,7 +929,9 @@ void pmfuzz_init(void* addr, unsigned long size, char* path) {
     pmfuzz_set_path_env(path);
     debug("[FI] Initializing PMFuzz failure injection\n");
     
+    /* Resolved once, see PMFuzzCfg_t */
     FIMode_t mode = get_fi_mode();
+    pmfuzz_cfg.fi_mode = mode;
     if (getenv(FAILURE_LIST_ENV) 
             && (mode == FIM_IMG_GEN || mode == FIM_IMG_REP)) {
         if (mode == FIM_IMG_GEN) {
@@ -500,6 +962,11 @@ void pmfuzz_init(void* addr, unsigned long size, char* path) {
         }
         assert(failure_list_file && "Failure list file not exist");
     }
+
+    pmfuzz_init_ns = get_time_ns();
+    if (PMFUZZ_CFG->dump_stats != NULL)
+        atexit(pmfuzz_report_exit);
+
     pmfuzz_init_complete = 1;
 }
 
@@ -41,11 +41,11 @@
  * @param elem_sz Size of each element in bytes (used for indexing the array)
  * @param loc Index of the shift reg in the array
  * @param basebit Value of unset bit in the map
- * @return void
+ * @return 1 if the shift reg changed, 0 if it is already full
  * 
  * **NOTE**: elem_sz cannot be larger than INT_32_MAX
 */
-static inline void 
+static inline uint8_t 
 sra_push_back(uint8_t *mem, size_t size, size_t elem_sz, size_t loc, uint8_t basebit) {
     size_t elem_cnt = size/elem_sz;
     assert(loc < elem_cnt);
@@ -77,5 +77,7 @@ sra_push_back(uint8_t *mem, size_t size, size_t elem_sz, size_t loc, uint8_t bas
                 BITCLEAR(arr, it);
             }
         }
+        return 1;
     }
+    return 0;
 }
\ No newline at end of file
@@ -6,8 +6,15 @@
  * @brief  Brief description here
  */
 
+#include <cstdlib>
 #include <pmfuzz/pmfuzz.h>
 
-int main() {
+int main(int argc, char *argv[]) {
   printf("PMFuzz version: %s\n", pmfuzz_version_str);
+
+  /* Number of PM accesses to report, used by pmfuzz-bench.py exec */
+  long accesses = argc > 1 ? atol(argv[1]) : 0;
+  for (long i = 0; i < accesses; i++) {
+    pmfuzz_rw(PMFUZZ_RND(1 << 16) + (uint32_t)i);
+  }
 }
@@ -0,0 +1,131 @@
+"""
+@file       cmin.py
+@details    Corpus minimization using the stored coverage maps
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+afl-cmin runs the target on every testcase to find the tuples it covers.
+PMFuzz already keeps the coverage map (map_<testcase>) and the PM access map
+(pm_map_<testcase>) of every testcase, so the tuples are read from the memory
+mapped maps instead and the corpus is minimized using the same greedy set
+cover as afl-cmin:
+
+1. Every tuple is assigned to the smallest testcase covering it.
+2. Going from the rarest tuple to the most common one, the testcase assigned
+   to every tuple that is not covered yet is kept and all of its tuples are
+   marked covered.
+
+A tuple is a map index along with its hit count bucket, log2(count)+1, same
+as tools/cp-map generates for the modified afl-cmin. The tuples of both maps
+are covered, so a testcase adding PM coverage is never dropped. The result
+differs from tools/pmfuzz-cmin (the default afl.cmin), which only drops the
+testcases whose PM map is identical to another testcase's. Here a testcase is
+dropped when the testcases kept cover all of its tuples, and testcases with
+the same PM map are all kept if their coverage maps add different tuples.
+
+Testcases without a PM map are returned to the caller, Dedup runs afl-cmin
+on only those.
+"""
+
+import numpy as np
+
+from os import path
+
+import handlers.name_handler as nh
+
+# Hit count buckets per map index, log2(255)+1 = 8, 0 is unused
+BUCKETS = 9
+
+_BUCKET_LUT = np.array([0] + [int(np.log2(cnt)) + 1 for cnt in range(1, 256)],
+                dtype=np.int64)
+
+def map_paths(testcase):
+    """ @brief Default location of a testcase's maps, in the same directory
+    @return Tuple (map, pm_map) of paths """
+
+    metadata = nh.get_metadata_files(testcase)
+    return (metadata['map'], metadata['pm_map'])
+
+def map_tuples(map_f):
+    """ @brief Reads the tuples covered by a map
+
+    @param map_f Path to the map
+    @return numpy.ndarray of int64 with the tuple ids (index*BUCKETS + bucket)
+            or None if the map does not exist """
+
+    try:
+        map_sz = path.getsize(map_f)
+    except FileNotFoundError:
+        return None
+
+    if map_sz == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    cov_map = np.memmap(map_f, dtype=np.uint8, mode='r')
+    try:
+        idx = np.flatnonzero(cov_map)
+        result = idx*BUCKETS + _BUCKET_LUT[cov_map[idx]]
+    finally:
+        del cov_map
+
+    return result
+
+def minimize(testcases, get_maps=map_paths):
+    """ @brief Minimizes a corpus using the maps of its testcases
+
+    @param testcases List of complete paths to the testcases, testcases with
+           the same name in different directories are minimized separately
+    @param get_maps Function that maps a testcase to the paths of its map and
+           its PM map
+    @return (kept, missing), lists of paths of the testcases kept and of the
+            testcases without a PM map. Testcases covering no tuple are never
+            kept. """
+
+    entries = []
+    missing = []
+
+    for tc in testcases:
+        map_f, pm_map_f = get_maps(tc)
+
+        pm_tuples = map_tuples(pm_map_f)
+        if pm_tuples is None:
+            missing.append(tc)
+            continue
+
+        tuples = map_tuples(map_f)
+        if tuples is None:
+            tuples = np.zeros(0, dtype=np.int64)
+
+        # PM map tuples are negative to keep them apart from the map's
+        tuples = np.concatenate((tuples, -1 - pm_tuples))
+        entries.append((path.getsize(tc), path.basename(tc), tc, tuples))
+
+    if len(entries) == 0:
+        return [], missing
+
+    # Smallest testcases first, ties broken by name for a stable result
+    entries.sort(key=lambda entry: entry[:2])
+
+    lens = np.array([len(entry[3]) for entry in entries], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lens)))
+    all_tuples = np.concatenate([entry[3] for entry in entries])
+    owners = np.repeat(np.arange(len(entries)), lens)
+
+    # first is the first occurrence of a tuple, i.e., its smallest testcase
+    _, first, inverse, counts = np.unique(all_tuples, return_index=True,
+                                    return_inverse=True, return_counts=True)
+    best = owners[first]
+
+    covered = np.zeros(len(counts), dtype=bool)
+    kept = np.zeros(len(entries), dtype=bool)
+
+    for tup in np.argsort(counts, kind='stable'):
+        if covered[tup]:
+            continue
+
+        owner = best[tup]
+        kept[owner] = True
+        covered[inverse[starts[owner]:starts[owner+1]]] = True
+
+    return [entry[2] for entry, keep in zip(entries, kept) if keep], missing
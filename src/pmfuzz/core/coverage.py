@@ -0,0 +1,172 @@
+"""
+@file       coverage.py
+@details    Incremental union of the coverage maps with a checkpoint
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+The progress collector reports the number of tuples covered by all the maps in
+@dedup and the running stage. Since these directories mostly grow, the union
+of the maps is kept along with the names of the maps folded into it, and only
+new maps are read on every update. If any folded map is removed (e.g., by the
+DedupEngine), the union for that directory is rebuilt from the remaining
+maps. The state is saved to @info/coverage.ckpt so a restarted collector does
+not start over.
+
+A map shorter than the union (or than the largest new map), e.g., one still
+being copied, is not folded and is checked again on the next update.
+"""
+
+import numpy as np
+import os
+
+from os import path
+
+from core import whatsup as wu
+from helper.manifest import DirManifest
+from helper.prettyprint import *
+
+class CoverageAccumulator:
+    """ @class Running union of the maps in a set of directories """
+
+    CKPT_NAME = 'coverage.ckpt'
+
+    def __init__(self, outdir):
+        """ @brief Create an accumulator for a PMFuzz output directory, loads
+        the checkpoint if one exists
+
+        @param outdir PMFuzz output directory, the checkpoint is saved in its
+               @info directory """
+
+        self.ckpt_f     = path.join(outdir, '@info', self.CKPT_NAME)
+        self.folded     = 0     # Maps read since creation
+        self.rebuilds   = 0     # Unions rebuilt due to removed maps
+
+        # key -> {'dir', 'names', 'map', 'gen'}
+        self._state     = {}
+        self._dirty     = False
+
+        self._load()
+
+    def _load(self):
+        if not path.isfile(self.ckpt_f):
+            return
+
+        try:
+            with np.load(self.ckpt_f, allow_pickle=False) as ckpt:
+                keys = set(name.rsplit('/', 1)[0] for name in ckpt.files)
+
+                for key in keys:
+                    cov_map = ckpt[key + '/map']
+                    self._state[key] = {
+                        'dir':      str(ckpt[key + '/dir']),
+                        'names':    set(ckpt[key + '/names'].tolist()),
+                        'map':      cov_map if len(cov_map) > 0 else None,
+                        'gen':      None,
+                    }
+        except (OSError, ValueError, KeyError) as e:
+            printw('Ignoring unreadable coverage checkpoint %s: %s' \
+                % (self.ckpt_f, str(e)))
+            self._state = {}
+
+    def update(self, key, tcdir, filt, rename):
+        """ @brief Folds the maps added to a directory since the last update
+        into the union for key
+
+        @param key Name of the union, e.g., 'dedup.map'. Every key should
+               always be used with the same filt and rename.
+        @param tcdir Directory containing the maps
+        @param filt Selects the testcases in the directory, e.g., nh.is_map
+        @param rename Maps a selected name to its map file, see
+               whatsup.get_cumulative_map()
+        @return numpy.ndarray with the union of the maps or None if there are
+                no maps, should not be modified """
+
+        manifest = DirManifest.get(tcdir)
+        names = manifest.view(filt)
+        state = self._state.get(key, None)
+
+        if state != None and state['dir'] == manifest.dirpath \
+                and state['gen'] == manifest.generation:
+            return state['map']
+
+        if state == None or state['dir'] != manifest.dirpath \
+                or not state['names'] <= names:
+            if state != None and state['dir'] == manifest.dirpath:
+                self.rebuilds += 1
+
+            state = {'dir': manifest.dirpath, 'names': set(), 'map': None}
+            self._state[key] = state
+            self._dirty = True
+
+        new = sorted(names - state['names'])
+        complete = self._complete(tcdir, new, rename, state['map'])
+
+        if len(complete) > 0:
+            new_map = wu.merge_map_files(
+                [path.join(tcdir, rename(name)) for name in complete])
+
+            state['map'] = wu.combine_maps(state['map'], new_map)
+            state['names'].update(complete)
+
+            self.folded += len(complete)
+            self._dirty = True
+
+        # Incomplete maps are checked again even if the directory is unchanged
+        if len(complete) == len(new):
+            state['gen'] = manifest.generation
+
+        return state['map']
+
+    def _complete(self, tcdir, names, rename, cov_map):
+        """ @brief Selects the maps that are completely written
+
+        @param cov_map Current union, its size is the expected map size
+        @return List of names """
+
+        sizes = {}
+        for name in names:
+            try:
+                sizes[name] = path.getsize(path.join(tcdir, rename(name)))
+            except FileNotFoundError:
+                pass
+
+        if cov_map is not None:
+            map_sz = len(cov_map)
+        else:
+            map_sz = max(sizes.values(), default=0)
+
+        return [name for name in names \
+                    if name in sizes and sizes[name] >= map_sz]
+
+    def save(self):
+        """ @brief Atomically writes the checkpoint if anything changed since
+        the last save
+        @return None """
+
+        if not self._dirty:
+            return
+
+        arrays = {}
+        for key, state in self._state.items():
+            cov_map = state['map']
+            if cov_map is None:
+                cov_map = np.zeros(0, dtype=np.uint8)
+
+            arrays[key + '/dir']    = np.array(state['dir'])
+            arrays[key + '/names']  = np.array(sorted(state['names']),
+                                        dtype=str)
+            arrays[key + '/map']    = cov_map
+
+        tmp_f = self.ckpt_f + '.tmp'
+        with open(tmp_f, 'wb') as obj:
+            np.savez(obj, **arrays)
+            obj.flush()
+            os.fsync(obj.fileno())
+
+        os.replace(tmp_f, self.ckpt_f)
+        self._dirty = False
+
+    def __str__(self):
+        return 'CoverageAccumulator(%s, folded=%d, rebuilds=%d)' \
+            % (self.ckpt_f, self.folded, self.rebuilds)
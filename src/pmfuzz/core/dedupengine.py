@@ -21,15 +21,19 @@
 class DedupEngine:
     """ @class DedupEngine
     @brief Performs deduplication on files """
-    def __init__(self, testcase_paths, verbose, checker=None):
+    def __init__(self, testcase_paths, verbose, checker=None, 
+            hash_cache=None):
         """ @brief create a DedupEngine object
 
         @param testcase_path List of path pointing to testcases to deduplicate 
         @param checker Function that maps a filename to a boolean indicating if
                that case should be processed, default: None
+        @param hash_cache HashCache object to read the digests from, files 
+               are always hashed if None
         """
         self.testcase_paths = testcase_paths
         self.verbose = verbose
+        self.hash_cache = hash_cache
         
         if checker == None:
             self.checker = lambda *_: True  
@@ -69,7 +73,10 @@ def run(self):
         # Find and collect maps with duplicate hash values
         hash_map = {}
         for tc in testcases:
-            sum = sha256sum(tc)
+            if self.hash_cache != None:
+                sum = self.hash_cache.digest(tc)
+            else:
+                sum = sha256sum(tc)
 
             if not sum in hash_map:
                 hash_map[sum] = []
@@ -85,3 +92,6 @@ def run(self):
             # Drop the oldest and remove others
             del hash_map[key][min_indx]
             self._delete_tcs(hash_map[key])
+
+        if self.verbose and self.hash_cache != None:
+            printv(str(self.hash_cache))
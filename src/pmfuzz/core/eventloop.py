@@ -0,0 +1,421 @@
+"""
+@file       eventloop.py
+@details    Event loop that drives the PMFuzz state machine
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+Instead of polling the output directory every few seconds, the state machine
+blocks in EventLoop.wait() until a timer deadline passes, a child process
+exits (SIGCHLD) or a watched directory changes (inotify). The caller then asks
+the loop what changed and only runs the phases whose inputs did.
+
+inotify is used through ctypes. If it is unavailable (or a watch cannot be
+added), changes are detected by comparing the mtime of the directories and
+wait() never blocks for longer than POLL_INTERVAL.
+
+The SIGCHLD handler and the wakeup descriptor of the signal module are
+process wide. Processes forked while a loop is open (e.g., by Parallel) 
+restore the previous ones, so their children do not wake up the loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import itertools
+import os
+import selectors
+import signal
+import struct
+import time
+
+from helper.prettyprint import *
+
+# Max time to block when falling back to polling the directories
+POLL_INTERVAL   = 2     # sec
+
+# inotify(7) constants
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+
+# Entries added to or removed from a directory
+IN_DIR_CHANGES  = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO \
+                    | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HDR      = struct.Struct('iIII')   # wd, mask, cookie, len
+
+# Loops that installed their SIGCHLD handler in this process
+_open_loops     = []
+
+def _after_fork_in_child():
+    """ @brief Restores the signal handlers of the open loops in a forked
+    child, the loops are not used by the child """
+
+    for loop in reversed(_open_loops):
+        loop._restore_signals()
+
+    del _open_loops[:]
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+class Inotify:
+    """ @class Minimal inotify binding using ctypes """
+
+    def __init__(self):
+        """ @brief Creates an inotify instance
+        @throws OSError if inotify is not supported """
+
+        libc_name = ctypes.util.find_library('c')
+        if libc_name == None:
+            libc_name = 'libc.so.6'
+
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.paths = {}     # wd -> path
+
+    def add_watch(self, dirpath, mask=IN_DIR_CHANGES):
+        """ @brief Watches a directory, watching the same directory again
+        returns the same watch descriptor
+
+        @param dirpath Path of the directory
+        @param mask inotify event mask
+        @return Watch descriptor
+        @throws OSError if the watch could not be added """
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath),
+                mask | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dirpath)
+
+        self.paths[wd] = dirpath
+        return wd
+
+    def read_events(self):
+        """ @brief Reads all the pending events without blocking
+        @return list of (path of the watched directory or None if the queue
+                overflowed, mask, name) """
+
+        result = []
+
+        while True:
+            try:
+                buf = os.read(self.fd, 64*1024)
+            except BlockingIOError:
+                break
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, name_len = _EVENT_HDR.unpack_from(buf, pos)
+                pos += _EVENT_HDR.size
+                name = buf[pos:pos+name_len].rstrip(b'\0')
+                pos += name_len
+
+                dirpath = self.paths.get(wd, None)
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+
+                result.append((dirpath, mask, os.fsdecode(name)))
+
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+class EventLoop:
+    """ @class Waits for timers, child exits and directory changes
+
+    #### Usage
+
+    \code{python}
+        loop = EventLoop()
+        loop.watch(outdir)
+        while True:
+            if loop.changed(outdir):
+                ...
+            loop.call_at(deadline)
+            loop.wait(timeout=60)
+    \endcode
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose    = verbose
+        self.selector   = selectors.DefaultSelector()
+
+        self._timers    = []        # Heap of (deadline, seq, callback)
+        self._seq       = itertools.count()
+
+        self._watched   = {}        # path -> mtime_ns, None if using inotify
+        self._pending   = set()     # Watched paths that do not exist yet
+        self._wakeups   = set()     # Deadlines of timers without callbacks
+        self._dirty     = set()     # Watched paths changed since changed()
+        self._child     = False     # SIGCHLD since child_exited()
+        self._zombie    = None      # Pid of the unwaited child last reported
+
+        # Before the SIGCHLD handler, finding libc may run a subprocess
+        try:
+            self.inotify = Inotify()
+            self.selector.register(self.inotify.fd, selectors.EVENT_READ,
+                'inotify')
+        except OSError as e:
+            printw('inotify unavailable (%s), polling directories' % str(e))
+            self.inotify = None
+
+        # Self pipe for SIGCHLD, the signal module writes to it
+        self._sig_r, self._sig_w = os.pipe()
+        os.set_blocking(self._sig_r, False)
+        os.set_blocking(self._sig_w, False)
+
+        self._old_wakeup_fd = signal.set_wakeup_fd(self._sig_w)
+        self._old_sigchld   = signal.signal(signal.SIGCHLD,
+                                lambda signum, frame: None)
+        self.selector.register(self._sig_r, selectors.EVENT_READ, 'signal')
+
+        _open_loops.append(self)
+
+    def _restore_signals(self):
+        signal.set_wakeup_fd(self._old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self._old_sigchld)
+
+    def close(self):
+        """ @brief Restores the signal handlers and closes all descriptors
+        @return None """
+
+        if self in _open_loops:
+            _open_loops.remove(self)
+            self._restore_signals()
+
+        self.selector.close()
+
+        os.close(self._sig_r)
+        os.close(self._sig_w)
+
+        if self.inotify != None:
+            self.inotify.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def call_at(self, deadline, callback=None):
+        """ @brief Wakes the loop at deadline and calls callback, if any
+
+        @param deadline Time as returned by time.time()
+        @param callback Function without arguments or None
+        @return None """
+
+        if callback == None:
+            if deadline in self._wakeups:
+                return
+            self._wakeups.add(deadline)
+
+        heapq.heappush(self._timers, (deadline, next(self._seq), callback))
+
+    def call_later(self, delay, callback=None):
+        """ @brief Same as call_at(time.time() + delay, callback) """
+
+        self.call_at(time.time() + delay, callback)
+
+    def watch(self, dirpath):
+        """ @brief Starts watching a directory for added or removed entries,
+        no-op if the directory is already watched. A new watch is reported as
+        changed by the next changed() call.
+
+        @param dirpath Path of the directory, may not exist yet
+        @return None """
+
+        dirpath = os.path.realpath(dirpath)
+
+        if dirpath in self._watched:
+            return
+
+        # Retried on the next call to changed()
+        if not os.path.isdir(dirpath):
+            self._pending.add(dirpath)
+            return
+
+        if self.inotify != None:
+            try:
+                self.inotify.add_watch(dirpath)
+                self._watched[dirpath] = None
+            except OSError as e:
+                # Removed in between
+                if e.errno == errno.ENOENT:
+                    self._pending.add(dirpath)
+                    return
+
+                printw('Polling %s, unable to watch it: %s' \
+                    % (dirpath, str(e)))
+                self._watched[dirpath] = self._mtime(dirpath)
+        else:
+            self._watched[dirpath] = self._mtime(dirpath)
+
+        self._pending.discard(dirpath)
+        self._dirty.add(dirpath)
+
+    def _mtime(self, dirpath):
+        try:
+            return os.stat(dirpath).st_mtime_ns
+        except FileNotFoundError:
+            return -1
+
+    def changed(self, dirpath):
+        """ @brief Checks if a directory changed since the last call, starts
+        watching it if it is not watched yet
+
+        @param dirpath Path of the directory
+        @return bool, True on the first call for a directory """
+
+        self.watch(dirpath)
+        dirpath = os.path.realpath(dirpath)
+
+        if dirpath not in self._watched:
+            # Does not exist yet
+            return False
+
+        mtime = self._watched[dirpath]
+        if mtime != None:
+            cur_mtime = self._mtime(dirpath)
+            if cur_mtime != mtime:
+                self._watched[dirpath] = cur_mtime
+                self._dirty.add(dirpath)
+
+        result = dirpath in self._dirty
+        self._dirty.discard(dirpath)
+
+        return result
+
+    def child_exited(self):
+        """ @brief Checks if a child process exited since the last call
+        @return bool """
+
+        result = self._child
+        self._child = False
+
+        return result
+
+    def _handle_inotify(self):
+        for dirpath, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._dirty.update(self._watched.keys())
+                continue
+
+            if dirpath == None:
+                continue
+
+            self._dirty.add(dirpath)
+
+            # The directory is gone, watch it again once it is recreated
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._watched.pop(dirpath, None)
+
+    def _handle_signal(self):
+        try:
+            signums = os.read(self._sig_r, 4096)
+        except BlockingIOError:
+            return
+
+        if signal.SIGCHLD in signums:
+            self._child = True
+
+    def _unwaited_child(self):
+        """ @brief Checks for a child that exited and was not waited for yet,
+        without waiting for it. A child is only reported once, in case its
+        owner never waits for it.
+        @return bool """
+
+        try:
+            info = os.waitid(os.P_ALL, 0, 
+                        os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return False
+
+        if info == None or info.si_pid == self._zombie:
+            return False
+
+        self._zombie = info.si_pid
+        return True
+
+    def wait(self, timeout=None):
+        """ @brief Blocks until a timer expires, a child exits, a watched
+        directory changes or timeout seconds pass, and runs the callbacks of
+        the expired timers
+
+        @param timeout Max time to block in seconds, None to block till an
+               event
+        @return set of wake up reasons: 'timer', 'child', 'fs', 'timeout' """
+
+        reasons = set()
+        now = time.time()
+
+        # Child exits left pending by drain()
+        if self._child:
+            reasons.add('child')
+            timeout = 0
+
+        if len(self._timers) > 0:
+            until_timer = max(0, self._timers[0][0] - now)
+            if timeout == None or until_timer < timeout:
+                timeout = until_timer
+
+        polling = self.inotify == None or len(self._pending) > 0 \
+            or any(mtime != None for mtime in self._watched.values())
+        if polling and (timeout == None or timeout > POLL_INTERVAL):
+            timeout = POLL_INTERVAL
+
+        for key, _ in self.selector.select(timeout):
+            if key.data == 'inotify':
+                self._handle_inotify()
+                reasons.add('fs')
+            elif key.data == 'signal':
+                self._handle_signal()
+                if self._child:
+                    reasons.add('child')
+
+        now = time.time()
+        while len(self._timers) > 0 and self._timers[0][0] <= now:
+            deadline, _, callback = heapq.heappop(self._timers)
+            self._wakeups.discard(deadline)
+            reasons.add('timer')
+
+            if callback != None:
+                callback()
+
+        if len(reasons) == 0:
+            reasons.add('timeout')
+
+        if self.verbose:
+            printv('Woke up: ' + ', '.join(sorted(reasons)))
+
+        return reasons
+
+    def drain(self):
+        """ @brief Discards the events that are already pending, e.g., the
+        exits of the children that were waited for synchronously. Directory
+        changes are kept. A child that exited and was not waited for is still
+        reported by the next wait() and child_exited().
+        @return None """
+
+        if self.inotify != None:
+            self._handle_inotify()
+
+        self._handle_signal()
+        self._child = self._unwaited_child()
@@ -89,10 +89,16 @@
 
 import handlers.name_handler as nh
 
+from core.eventloop import EventLoop
+from core.turnover import Turnover
 from helper.common import *
 from helper.prettyprint import *
 from helper import config
+from helper import fileio
 from helper.ptimer import *
+from helper.manifest import DirManifest
+from interfaces.afl import AFLSupervisor
+from interfaces.afl import get_stage_stats
 from stages.dedup import *
 from stages.stage1 import *
 from stages.stage2 import *
@@ -102,6 +108,12 @@
 # Time to wait before starting stage 1
 STAGE1_WAITTIME = 5  # sec
 
+# Max time the state machine waits without an event
+MAX_IDLE        = 60 # sec
+
+# Stage 1 testcases collected per pass with the pipeline enabled
+PIPELINE_BATCH  = 16
+
 
 def run_stage1(indir:str, outdir:str, cfg, cores:int, 
         verbose:bool=False, force_yes=False, dry_run=False):
@@ -114,13 +126,22 @@ def run_stage1(indir:str, outdir:str, cfg, cores:int,
     stage1.whatsup()
 
 def run_stage2(indir:str, outdir:str, cfg, cores:int, 
-        verbose:bool=False, force_yes=False, dry_run=False):
-    """ @brief Wrapper for running stages.Stage2 """
+        verbose:bool=False, force_yes=False, dry_run=False, state=None,
+        stage2=None, hold=False):
+    """ @brief Wrapper for running stages.Stage2
+
+    @param state Synced State of the outdir, created if None
+    @param stage2 Stage2 object returned by the last call, reused if it is
+           for the running stage and iteration
+    @param hold Keep running the iteration even if it completed, e.g., while
+           stage 1 testcases are still being collected for it
+    @return Stage2 object for the running iteration """
 
     # Find the youngest stage
-    state = State('State', indir, outdir, cfg, cores, verbose, 
-                        force_yes, dry_run)
-    state.sync()
+    if state == None:
+        state = State('State', indir, outdir, cfg, cores, verbose, 
+                            force_yes, dry_run)
+        state.sync()
 
     stage       = int(state.stage)
     iter_id     = int(state.iter_id)
@@ -146,32 +167,132 @@ def run_stage2(indir:str, outdir:str, cfg, cores:int,
 
     else:
         # Stage 2 is already running, resume operations
-        stage2 = Stage2(stage, iter_id, indir, outdir, 
-                        cfg, cores, verbose, force_yes, dry_run)
+        if stage2 == None or stage2.stage != stage \
+                or stage2.iter_id != iter_id:
+            stage2 = Stage2(stage, iter_id, indir, outdir, 
+                            cfg, cores, verbose, force_yes, dry_run)
+
+            # Background minimization left pending by an earlier process
+            stage2.turnover = Turnover.resume(outdir, cfg, verbose)
+            if stage2.turnover != None:
+                stage2.cores = cores - stage2.turnover.reserve
+
+        # Give the reserved cores back once the background work is done
+        if stage2.turnover != None and stage2.turnover.done():
+            stage2.turnover.finish(cfg)
+            stage2.turnover = None
+            stage2.cores = cores
         
-        if stage2.completed:
+        if stage2.completed and not hold and stage2.turnover == None:
             printi('Stage %d completed' % stage)
+            completed_at = time.time()
+
             # If this iteration is completed, terminate it, run deduplication
             # and move on to the next
             stage2.terminate()
             dedup_cfg = cfg['pmfuzz']['stage']['dedup']
-            run_dedup(stage, iter_id, indir, outdir, cfg, cores, 
-                        verbose, force_yes, dry_run, 
-                        min_corpus=dedup_cfg['global']['minimize_corpus'],
-                        min_tc=dedup_cfg['global']['minimize_tc'],
-                        )
-            stage2.clear()
-            
-            # Create a new stage 2 object for next iteration
-            stage2 = Stage2(next_stage, next_iter_id, indir, outdir, 
-                        cfg, cores, verbose, force_yes, dry_run)
-            stage2.run()
+            reserve = Turnover.reserved_cores(cfg, cores)
+
+            if reserve == 0:
+                run_dedup(stage, iter_id, indir, outdir, cfg, cores, 
+                            verbose, force_yes, dry_run, 
+                            min_corpus=dedup_cfg['global']['minimize_corpus'],
+                            min_tc=dedup_cfg['global']['minimize_tc'],
+                            )
+                stage2.clear()
+
+                report_copy_stats(outdir, stage, iter_id, stage2.img_cache)
+                
+                # Create a new stage 2 object for next iteration
+                stage2 = Stage2(next_stage, next_iter_id, indir, outdir, 
+                            cfg, cores, verbose, force_yes, dry_run)
+                stage2.run()
+
+                Turnover.report(outdir, stage, iter_id, 'sequential', cores,
+                    0, completed_at, time.time(), time.time())
+            else:
+                # Copy the results to @dedup and drop the duplicates, this
+                # decides the parents of the next iteration. The 
+                # minimization runs in the background on the reserved cores.
+                run_dedup(stage, iter_id, indir, outdir, cfg, cores, 
+                            verbose, force_yes, dry_run, 
+                            min_corpus=False, min_tc=False)
+
+                report_copy_stats(outdir, stage, iter_id, stage2.img_cache)
+
+                turnover = Turnover.start(outdir, cfg, stage, iter_id, cores,
+                    completed_at, 
+                    min_tc=dedup_cfg['global']['minimize_tc'],
+                    min_corpus=dedup_cfg['global']['minimize_corpus'],
+                    verbose=verbose)
+
+                stage2 = Stage2(next_stage, next_iter_id, indir, outdir, 
+                            cfg, cores - reserve, verbose, force_yes, dry_run)
+                stage2.turnover = turnover
+                stage2.run()
+
+                turnover.next_started()
 
         else:
 
             # If stage 2 has not completed yet, let it continue
             stage2.resume()
 
+    return stage2
+
+
+def report_copy_stats(outdir:str, stage:int, iter_id:int, img_cache=None):
+    """ Records the number of copies and the bytes moved by each copy method 
+    during an iteration to @info/copystats.csv and resets the counters. The
+    counters of the image cache, if any, are recorded to @info/imgcache.csv.
+
+    @param img_cache helper.imgcache.ImageCache or None
+    @return None """
+
+    stats = fileio.copy_stats(reset=True)
+    stats_f = path.join(outdir, '@info', 'copystats.csv')
+
+    write_hdr = not path.isfile(stats_f)
+
+    with open(stats_f, 'a') as obj:
+        if write_hdr:
+            obj.write('stage,iter,method,calls,bytes_moved,bytes_copied\n')
+
+        for method, stat in stats.items():
+            obj.write('%d,%d,%s,%d,%d,%d\n' % (stage, iter_id, method, 
+                stat['calls'], stat['moved'], stat['copied']))
+
+    copied = sum(stat['copied'] for stat in stats.values())
+    moved = sum(stat['moved'] for stat in stats.values())
+
+    printi('Copies in iteration %d: ' % iter_id \
+        + ', '.join('%s: %d' % (m, st['calls']) for m, st in stats.items()) \
+        + ', I/O saved: %.2f MiB' % ((copied - moved)/1024/1024))
+
+    if img_cache == None:
+        return
+
+    stats = img_cache.stats(reset=True)
+    stats_f = path.join(outdir, '@info', 'imgcache.csv')
+
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits']/lookups if lookups > 0 else 0
+
+    write_hdr = not path.isfile(stats_f)
+
+    with open(stats_f, 'a') as obj:
+        if write_hdr:
+            obj.write('stage,iter,hits,misses,hit_rate,bytes_saved,'
+                'evictions,images,disk\n')
+
+        obj.write('%d,%d,%d,%d,%.3f,%d,%d,%d,%d\n' % (stage, iter_id, 
+            stats['hits'], stats['misses'], hit_rate, stats['bytes_saved'],
+            stats['evictions'], stats['images'], stats['disk']))
+
+    printi('Image cache in iteration %d: %.1f%% hits, %.2f MiB not '
+        'decompressed again' % (iter_id, 100*hit_rate, 
+            stats['bytes_saved']/1024/1024))
+
 
 def run_dedup(stage:int, iter_id:int, indir:str, outdir:str, 
         cfg=None, cores:int=1, verbose:bool=False, force_resp=False, 
@@ -193,10 +314,13 @@ def run_dedup(stage:int, iter_id:int, indir:str, outdir:str,
 
 
 def collect_stage1(indir:str, outdir:str, cfg, cores1:int, cores2:int, 
-        disable_stage2, verbose:bool=False, force_resp=False, dry_run=False):
+        disable_stage2, verbose:bool=False, force_resp=False, dry_run=False,
+        batch=None):
     """ Wrapper for running collection on stage 1.
     
-    @return None """
+    @param batch Max number of testcases to collect and send to @dedup, all 
+           if None
+    @return Number of testcases left to collect """
 
     stage1 = Stage1('', indir, outdir, cfg, cores1, verbose, force_resp, 
                     dry_run)
@@ -205,7 +329,7 @@ def collect_stage1(indir:str, outdir:str, cfg, cores1:int, cores2:int,
                     dry_run, gbl=False, fdedup=False, min_corpus=False, 
                     min_tc=False)
 
-    stage1.collect()
+    left = stage1.collect(batch)
 
     dedup = Dedup(1, 1, indir, outdir, cfg, cores1, verbose, 
                     force_resp, dry_run)
@@ -221,7 +345,7 @@ def collect_stage1(indir:str, outdir:str, cfg, cores1:int, cores2:int,
     dedup.update_global()
                    
     # Minimize the global corpus if stage 2 is disabled
-    if disable_stage2:
+    if disable_stage2 and left == 0:
         dedup.run(
             fdedup      = False,
             min_corpus  = True,
@@ -229,6 +353,50 @@ def collect_stage1(indir:str, outdir:str, cfg, cores1:int, cores2:int,
             gbl         = True,
         )
 
+    return left
+
+def record_pipeline(outdir:str, cores:int, backlog:int):
+    """ Records the core utilisation during the stage 1 -> stage 2 
+    transition to @info/pipeline.csv and the time from the start of PMFuzz 
+    to the first stage 2 AFL instance to @info/first_stage2_exec.
+
+    @param cores Total cores available to stage 1 and stage 2
+    @param backlog Stage 1 testcases not collected yet
+    @return None """
+
+    now = int(time.time())
+    inf_dir = path.join(outdir, '@info')
+
+    stage1_stats = get_stage_stats(path.join(outdir, 
+                        nh.get_outdir_name(1, 1), nh.AFL_DIR_NM))
+    supervisor = AFLSupervisor.get()
+    stage2_running = supervisor.running_count(Stage2.TIMER_TC) \
+                        + supervisor.running_count(Stage2.TIMER_CS)
+    busy = stage1_stats['alive'] + stage2_running
+
+    first_f = path.join(inf_dir, 'first_stage2_exec')
+    if stage2_running > 0 and not path.isfile(first_f):
+        with open(path.join(inf_dir, 'starttime'), 'r') as obj:
+            starttime = int(obj.read().strip())
+
+        with open(first_f, 'w') as obj:
+            obj.write(str(now - starttime))
+
+        printi('First stage 2 AFL instance %ds after start' \
+            % (now - starttime))
+
+    stats_f = path.join(inf_dir, 'pipeline.csv')
+    write_hdr = not path.isfile(stats_f)
+
+    with open(stats_f, 'a') as obj:
+        if write_hdr:
+            obj.write('time,backlog,stage1_alive,stage2_running,cores,'
+                'utilisation\n')
+
+        obj.write('%d,%d,%d,%d,%d,%.2f\n' % (now, backlog, 
+            stage1_stats['alive'], stage2_running, cores, 
+            busy/max(cores, 1)))
+
 def update_info(outdir):
     inf_dir = path.join(outdir, '@info')
 
@@ -283,19 +451,46 @@ def run_pmfuzz(indir, outdir, cfg, cores1=1, cores2=1,
         if not resp:
             abort('Resume cancelled.')
 
-    # Run the state machine
+    # Run the state machine, a pass runs whenever an event wakes the loop
+    loop = EventLoop(verbose)
+    stage1_queue = path.join(outdir, nh.get_outdir_name(1, 1), 
+                    nh.AFL_DIR_NM, 'master_fuzzer', 'queue')
+    stage2 = None
+
+    # Streams the stage 1 testcases to stage 2 in batches instead of 
+    # collecting the complete queue first
+    pipeline_cfg = cfg['pmfuzz']['stage']['2'].get('pipeline', 
+                        {'enable': False})
+    batch = None
+    if pipeline_cfg.get('enable', False):
+        batch = pipeline_cfg.get('batch', PIPELINE_BATCH)
+    
+    stage1_backlog = 0
+    gbl_manifest = DirManifest.get(path.join(outdir, Dedup.DEDUP_DIR_GBL))
+
+    # Reasons the loop woke up for, the first pass runs everything
+    reasons = {'timeout'}
+
     while True:
 
-        # Update state        
-        state.sync()
+        # Update state, stages are only created or removed in the outdir
+        state_changed = loop.changed(outdir)
+        if state_changed:
+            state.sync()
 
         stage_id    = int(state.stage)
         iter_id     = int(state.iter_id)
 
-        if stage_id != 0:
-            # Always run deduplication on stage 1 first
-            collect_stage1(indir, outdir, cfg, cores1, cores2, disable_stage2,
-                verbose, force_yes, dry_run)
+        # Always run deduplication on stage 1 first, skipped if stage 1 has
+        # not found anything new since the last collection
+        if stage_id != 0 and (loop.changed(stage1_queue) \
+                or stage1_backlog > 0):
+            stage1_backlog = collect_stage1(indir, outdir, cfg, cores1, 
+                cores2, disable_stage2, verbose, force_yes, dry_run, batch)
+
+            # Let stage 2 run before collecting the next batch
+            if stage1_backlog > 0:
+                loop.call_later(0)
         
         # No stage is running
         if stage_id == 0:
@@ -305,26 +500,58 @@ def run_pmfuzz(indir, outdir, cfg, cores1=1, cores2=1,
             # Create a timer for future
             ptimer = PTimer(path.join(outdir, nh.get_outdir_name(1, 1)))
             ptimer.start_new(STAGE1_WAITTIME)
+            loop.call_at(ptimer.deadline())
         
         # Stage 1 is already is running
         elif stage_id == 1 and not disable_stage2:
 
             # Continue to stage 2 if stage 1 timer has expired
             timer = PTimer(path.join(outdir, nh.get_outdir_name(1, 1)))
-            if timer.expired():
+
+            # With the pipeline, start as soon as a testcase reached @dedup
+            ready = batch != None and len(gbl_manifest.view(nh.is_tc)) > 0
+            if timer.expired() or ready:
                 printi('Starting to stage 2 (elapsed: %s)' % timer.elapsed_hr())
-                run_stage2(indir, outdir, cfg, cores2, verbose, 
+                stage2 = run_stage2(indir, outdir, cfg, cores2, verbose, 
                             force_yes, dry_run)
+            else:
+                loop.call_at(timer.deadline())
 
         elif stage_id == 2 and not disable_stage2:
-            # Run/resume stage 2
-            run_stage2(indir, outdir, cfg, cores2, verbose, 
-                        force_yes, dry_run)
+            # Run/resume stage 2 unless the only events were changes in
+            # directories stage 2 does not read
+            stage2_changed = state_changed or stage2 == None
+            if stage2 != None:
+                # Check both to consume the pending changes of each
+                afl_changed = loop.changed(stage2.afl_dir)
+                loc_changed = loop.changed(stage2.dedup.dedup_dir_loc)
+                stage2_changed = stage2_changed or afl_changed or loc_changed
+
+            if stage2_changed or reasons != {'fs'}:
+                stage2 = run_stage2(indir, outdir, cfg, cores2, verbose, 
+                            force_yes, dry_run, state=state, stage2=stage2,
+                            hold=iter_id == 1 and stage1_backlog > 0)
 
         elif not disable_stage2:
             abort('Unimplemented')
 
-        time.sleep(2)
+        if stage2 != None and stage2.next_deadline != None:
+            loop.call_at(stage2.next_deadline)
+
+        # Utilisation over the transition, till the first iteration ends
+        if stage_id == 1 or (stage_id == 2 and iter_id == 1):
+            record_pipeline(outdir, cores1 + cores2, stage1_backlog)
+
+        # Children exited during the pass were waited for by the pass itself
+        loop.drain()
+
+        # Unless they were AFL instances that died, run the next pass now
+        if len(AFLSupervisor.get().reap()) > 0:
+            loop.call_later(0)
+
+        # Sleep until a deadline, a child exit or a change in the outdir. 
+        # MAX_IDLE bounds the wait in case a change is missed.
+        reasons = loop.wait(MAX_IDLE)
 
 if __name__ == '__main__':
     abort('Cannot run %s directly, check README.' % sys.argv[0])
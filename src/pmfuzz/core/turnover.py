@@ -0,0 +1,247 @@
+"""
+@file       turnover.py
+@details    Overlaps the global deduplication of a stage 2 iteration with the
+            next iteration
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+When a stage 2 iteration completes, its results are copied to @dedup and the
+duplicates are removed in the foreground, so the parents of the next
+iteration are known and the next iteration starts right away. The slow global
+steps (testcase and corpus minimization) then run in a background process on
+a reserved share of the cores. The background process only reports the
+testcases the corpus minimization drops, they are removed from @dedup by the
+state machine once the process exits, so @dedup is never modified by two
+processes at once. A testcase the next iteration already picked up keeps
+running if it is dropped, its images are never removed.
+
+The pending turnover is recorded in @info/turnover.pending so a restarted
+PMFuzz runs the background steps again. Every turnover is reported to
+@info/turnover.csv.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+
+from os import path
+
+from helper.common import *
+from helper.prettyprint import *
+from stages.dedup import Dedup
+
+class Turnover:
+    """ @class Background global deduplication of a completed iteration """
+
+    PENDING_NAME    = 'turnover.pending'
+    REPORT_NAME     = 'turnover.csv'
+
+    def __init__(self, outdir, state, verbose=False):
+        """ @brief Create a turnover, use start() or resume() instead
+
+        @param outdir PMFuzz output directory
+        @param state dict with the keys stage, iter_id, cores, reserve,
+               min_tc, min_corpus, start and fg_end """
+
+        self.outdir     = outdir
+        self.state      = state
+        self.verbose    = verbose
+
+        self.pending_f  = Turnover.pending_path(outdir)
+        self.result_f   = path.join(outdir, '@temp', 'turnover-%d.%d.json' \
+                            % (state['stage'], state['iter_id']))
+        self.proc       = None
+
+    @staticmethod
+    def pending_path(outdir):
+        return path.join(outdir, '@info', Turnover.PENDING_NAME)
+
+    @staticmethod
+    def reserved_cores(cfg, cores):
+        """ @brief Cores kept for the background steps, 0 if the turnover
+        is not overlapped
+        @return int """
+
+        turnover_cfg = cfg['pmfuzz']['stage']['2'].get('turnover',
+                            {'overlap': False})
+
+        if not turnover_cfg.get('overlap', False) or cores < 2:
+            return 0
+
+        reserve = int(cores*turnover_cfg.get('reserve', 0.25))
+        return min(max(reserve, 1), cores - 1)
+
+    @classmethod
+    def start(cls, outdir, cfg, stage, iter_id, cores, start, min_tc,
+            min_corpus, verbose=False):
+        """ @brief Starts the background steps of a completed iteration,
+        the iteration's results should already be in @dedup
+
+        @param cores Total stage 2 cores
+        @param start Time the iteration completed
+        @param min_tc Minimize the global testcases
+        @param min_corpus Minimize the global corpus
+        @return Turnover """
+
+        state = {
+            'stage':        stage,
+            'iter_id':      iter_id,
+            'cores':        cores,
+            'reserve':      Turnover.reserved_cores(cfg, cores),
+            'min_tc':       min_tc,
+            'min_corpus':   min_corpus,
+            'start':        start,
+            'fg_end':       time.time(),
+        }
+
+        result = cls(outdir, state, verbose)
+        result._save()
+        result._launch(cfg)
+
+        return result
+
+    @classmethod
+    def resume(cls, outdir, cfg, verbose=False):
+        """ @brief Runs the background steps of a turnover left pending by
+        an earlier PMFuzz process again
+        @return Turnover or None if no turnover is pending """
+
+        pending_f = Turnover.pending_path(outdir)
+        if not path.isfile(pending_f):
+            return None
+
+        with open(pending_f, 'r') as obj:
+            state = json.load(obj)
+
+        printi('Resuming turnover of iteration %d' % state['iter_id'])
+
+        result = cls(outdir, state, verbose)
+        result._launch(cfg)
+
+        return result
+
+    def _save(self):
+        tmp_f = self.pending_f + '.tmp'
+        with open(tmp_f, 'w') as obj:
+            json.dump(self.state, obj)
+
+        os.replace(tmp_f, self.pending_f)
+
+    def _launch(self, cfg):
+        """ @brief Forks the background process """
+
+        dedup = Dedup(self.state['stage'], self.state['iter_id'], '',
+                    self.outdir, cfg, max(self.state['reserve'], 1),
+                    self.verbose, True, False)
+
+        if path.isfile(self.result_f):
+            os.remove(self.result_f)
+
+        self.proc = multiprocessing.Process(target=Turnover._background,
+                        args=(dedup, self.state, self.result_f))
+        self.proc.start()
+
+        printi('Minimizing iteration %d in the background (pid %d, %d '
+            'cores)' % (self.state['iter_id'], self.proc.pid,
+                max(self.state['reserve'], 1)))
+
+    @staticmethod
+    def _background(dedup, state, result_f):
+        """ @brief Entry point of the background process, the event loop's
+        signal handlers are already restored in forked processes """
+
+        dropped = dedup._deduplicate_gbl(
+            fdedup      = False,
+            min_tc      = state['min_tc'],
+            min_corpus  = state['min_corpus'],
+            apply       = False,
+        )
+
+        tmp_f = result_f + '.tmp'
+        with open(tmp_f, 'w') as obj:
+            json.dump(dropped, obj)
+
+        os.replace(tmp_f, result_f)
+
+    def next_started(self):
+        """ @brief Records that the next iteration started, the stage 2 cores
+        were idle till now
+        @return None """
+
+        self.state['fg_end'] = time.time()
+        self._save()
+
+    @property
+    def reserve(self):
+        return self.state['reserve']
+
+    def done(self):
+        """ @brief Checks if the background process exited, does not block
+        @return bool """
+
+        return self.proc == None or not self.proc.is_alive()
+
+    def finish(self, cfg):
+        """ @brief Applies the result of the background process, removes the
+        directory of the iteration and reports the turnover, should only be
+        called once done() returns True
+
+        @return None """
+
+        self.proc.join()
+
+        dedup = Dedup(self.state['stage'], self.state['iter_id'], '',
+                    self.outdir, cfg, 1, self.verbose, True, False)
+
+        if self.proc.exitcode != 0 or not path.isfile(self.result_f):
+            printw('Background minimization of iteration %d failed (exit '
+                'code %s), keeping the corpus as is' \
+                % (self.state['iter_id'], str(self.proc.exitcode)))
+        else:
+            with open(self.result_f, 'r') as obj:
+                dropped = json.load(obj)
+
+            dedup.drop_testcases_gbl(dropped)
+            os.remove(self.result_f)
+
+            printi('Dropped %d testcases after minimizing iteration %d' \
+                % (len(dropped), self.state['iter_id']))
+
+        # Remove the iteration's directory
+        rmtree(dedup.resultdir)
+
+        self.report(self.outdir, self.state['stage'], self.state['iter_id'],
+            'overlap', self.state['cores'], self.state['reserve'],
+            self.state['start'], self.state['fg_end'], time.time())
+
+        os.remove(self.pending_f)
+
+    @staticmethod
+    def report(outdir, stage, iter_id, mode, cores, reserve, start, fg_end,
+            end):
+        """ @brief Appends a turnover to @info/turnover.csv. The stage 2
+        cores are idle from the completion of the iteration till the next
+        iteration starts (fg_end), the reserved cores are busy with the
+        background steps till end.
+
+        @param mode 'sequential' or 'overlap'
+        @return None """
+
+        stats_f = path.join(outdir, '@info', Turnover.REPORT_NAME)
+        write_hdr = not path.isfile(stats_f)
+
+        fg_secs = fg_end - start
+        bg_secs = end - fg_end
+
+        with open(stats_f, 'a') as obj:
+            if write_hdr:
+                obj.write('stage,iter,mode,cores,reserve,fg_secs,bg_secs,'
+                    'idle_core_secs\n')
+
+            obj.write('%d,%d,%s,%d,%d,%.1f,%.1f,%.1f\n' % (stage, iter_id,
+                mode, cores, reserve, fg_secs, bg_secs, cores*fg_secs))
+
+        printi('Turnover of iteration %d: %.1fs with all cores idle, %.1fs '
+            'in the background' % (iter_id, fg_secs, bg_secs))
@@ -1,5 +1,5 @@
 import argparse
-import bitarray
+import collections
 import matplotlib
 import numpy as np
 import os
@@ -14,6 +14,8 @@
 from subprocess import Popen, PIPE
 
 from helper import common
+from interfaces import afl
+from helper.manifest import DirManifest
 
 from helper.prettyprint import *
 from handlers import name_handler as nh
@@ -41,86 +43,178 @@ def get_phys_count():
 
     return (sockets, cores_per_socket, threads_per_core)
 
-def get_cumulative_map(tcdir, filt, rename):
+# Number of maps read into memory at once while merging maps
+MAP_BATCH = 256
+
+# (dir, filter, rename) -> (generation of the dir, merged map), see
+# get_cumulative_map()
+_map_cache      = collections.OrderedDict()
+MAP_CACHE_SZ    = 16
+
+def same_name(fname):
+    """ @brief Rename function for get_cumulative_map() for using the map
+    files selected by the filter as is """
+    return fname
+
+def pm_map_to_map(fname):
+    """ @brief Rename function for get_cumulative_map() for using the
+    coverage maps of the testcases selected using their PM map """
+    return fname.replace('pm_', '')
+
+def merge_map_files(paths, batch=MAP_BATCH):
+    """ @brief ORs the bitmaps in a list of files, the maps are read batch
+    files at a time so memory use does not depend on the number of files
+
+    @param paths List of complete paths to the map files, all the maps should
+           be of the same size. A map that is shorter than the largest one,
+           e.g., still being copied, is zero padded, a map removed meanwhile 
+           is skipped.
+    @param batch Number of maps to read and reduce at once
+    @return numpy.ndarray of uint8 with the merged bitmap or None if paths is
+            empty """
+
+    if len(paths) == 0:
+        return None
+
+    map_sz = 0
+    for file_path in paths:
+        try:
+            map_sz = max(map_sz, os.path.getsize(file_path))
+        except FileNotFoundError:
+            pass
+
+    cumulative = np.zeros(map_sz, dtype=np.uint8)
+    buf = np.empty((min(batch, len(paths)), map_sz), dtype=np.uint8)
+
+    for start in range(0, len(paths), batch):
+        chunk = paths[start:start+batch]
+
+        # Read directly into the batch buffer, avoids allocating per map
+        for i, file_path in enumerate(chunk):
+            try:
+                fd = os.open(file_path, os.O_RDONLY)
+            except FileNotFoundError:
+                buf[i] = 0
+                continue
+
+            try:
+                cnt = os.readv(fd, [buf[i]])
+            finally:
+                os.close(fd)
+
+            buf[i, cnt:] = 0
+
+        np.bitwise_or.reduce(buf[:len(chunk)], axis=0, out=buf[0])
+        np.bitwise_or(cumulative, buf[0], out=cumulative)
+
+    return cumulative
+
+def get_cumulative_map(tcdir, filt, rename, cov=None):
     """ @brief Gets the combined bitmap for all the testcases in a dir
+
+    The result is cached until the directory is modified, so rename should be
+    a module level function (e.g., same_name) and not a new lambda on every
+    call for the cache to be used.
     
     @param tcdir Complete path to a directory containing paths
     @param filt Use filter on the directory
     @param rename Renames the testcase (useful for PM paths)
-    @return BitArray object containing the merged bitmap
+    @param cov CoverageAccumulator to get the map from, only the maps added
+           since the last call are read
+    @return numpy.ndarray containing the merged bitmap or None if no file in
+            the directory matches filt, should not be modified
     """
-    pmfuzzdir_list = os.listdir(tcdir)
+    if cov != None:
+        key = ':'.join([os.path.basename(os.path.normpath(tcdir)), 
+                        filt.__name__, rename.__name__])
+        return cov.update(key, tcdir, filt, rename)
 
-    cumulative = None
-    for f in filter(filt, pmfuzzdir_list):
-        file_path = os.path.join(tcdir, rename(f))
+    manifest = DirManifest.get(tcdir)
+    names = manifest.view(filt)
+    key = (manifest.dirpath, filt, rename)
 
-        if cumulative == None:
-            with open(file_path, 'rb') as obj:
-                cumulative = bitarray.bitarray()
-                cumulative.fromfile(obj)
-        else:
-            with open(file_path, 'rb') as obj:
-                cur = bitarray.bitarray()
-                cur.fromfile(obj)
+    if key in _map_cache and _map_cache[key][0] == manifest.generation:
+        _map_cache.move_to_end(key)
+        return _map_cache[key][1]
+
+    cumulative = merge_map_files(
+        [os.path.join(tcdir, rename(f)) for f in sorted(names)])
 
-                # Combine the maps
-                cumulative = cumulative|cur
+    _map_cache[key] = (manifest.generation, cumulative)
+    _map_cache.move_to_end(key)
+    if len(_map_cache) > MAP_CACHE_SZ:
+        _map_cache.popitem(last=False)
 
     return cumulative
 
 def combine_maps(*maps):
     """ @brief Combines maps while ignoring any None values 
-    @return BitArray object with all maps combined """
+    @return numpy.ndarray with all maps combined or None if all the maps are
+            None """
 
     common.abort_if(len(maps) < 1, 'No map supplied')
-    cumulative = maps[0]
+    cumulative = None
     
-    for m in maps[1:]:
-        if m != None:
-            cumulative = cumulative|m
+    for m in maps:
+        if m is None:
+            continue
+
+        if cumulative is None:
+            cumulative = m.copy()
+        else:
+            np.bitwise_or(cumulative, m, out=cumulative)
 
     return cumulative
 
 def count_tuples(map):
     """ @brief counts non zero tuples in a map
-    @param map BitArray containing the bitmap
+    @param map numpy.ndarray containing the bitmap
     @return Count of non-zero bytes in the bitmap"""
 
     count = 0
     
-    if map != None:
-        for bit in map.tobytes():
-            if bit != 0:
-                count += 1
+    if map is not None:
+        count = int(np.count_nonzero(map))
     
     return count
 
-def get_total_paths(pmfuzzdir, stage_max, iterid_max):
+def get_total_paths(pmfuzzdir, stage_max, iterid_max, cov=None):
+    """ @brief Counts the tuples covered by all the testcases in @dedup and 
+    the running stage
+
+    @param cov CoverageAccumulator to fold the maps into incrementally, maps
+           are merged from scratch (cached only till a directory changes) if
+           None
+    @return int """
+
     total_paths = count_tuples(combine_maps(
         get_cumulative_map(
             os.path.join(pmfuzzdir, '@dedup'), 
-            nh.is_map, lambda fname: fname
+            nh.is_map, same_name, cov
         ),
         # Incase this is None, it is ignored in combine_maps
         get_inclusive_map(
             pmfuzzdir, stage_max, iterid_max, 
-            nh.is_map, lambda fname: fname
+            nh.is_map, same_name, cov
         ),
     ))
 
     return total_paths
 
-def get_total_pm_paths(pmfuzzdir, stage_max, iterid_max):
+def get_total_pm_paths(pmfuzzdir, stage_max, iterid_max, cov=None):
+    """ @brief Counts the tuples covered by all the testcases with a PM map in
+    @dedup and the running stage, see get_total_paths()
+    @return int """
+
     total_pm_paths = count_tuples(combine_maps(
         get_cumulative_map(
             os.path.join(pmfuzzdir, '@dedup'), 
-            nh.is_pm_map, lambda fname: fname.replace('pm_', '')
+            nh.is_pm_map, pm_map_to_map, cov
         ),
         # Incase this is None, it is ignored in combine_maps
         get_inclusive_map(
             pmfuzzdir, stage_max, iterid_max, 
-            nh.is_pm_map, lambda fname: fname.replace('pm_', '')
+            nh.is_pm_map, pm_map_to_map, cov
         ),
     ))
 
@@ -138,16 +232,22 @@ def get_mqueue_population(cfg, pmfuzzdir):
     return count
     
 
+def get_afl_stats(pmfuzzdir, stage, iter_id):
+    """ @brief Returns the aggregated fuzzer_stats of all the AFL instances of
+    a stage, see interfaces.afl.get_stage_stats()
+    @return dict """
+
+    tgtdir = os.path.join(pmfuzzdir, nh.get_outdir_name(stage, iter_id), 
+        nh.AFL_DIR_NM)
+
+    return afl.get_stage_stats(tgtdir)
+
 def get_exec_rate(cfg, pmfuzzdir):
-    tgtdir = os.path.join(pmfuzzdir, 'stage=1,iter=1', '.afl-results')
-    whatsup_cmd = [cfg['pmfuzz']['bin_dir'] + '/afl-whatsup', '-s', tgtdir]
-    whatsup_res = subprocess.check_output(whatsup_cmd).decode("utf-8")
-    speed = '0'
-    for line in whatsup_res.split('\n'):
-        if 'Cumulative' in line:
-            tokens = line.split(':')
-            speed = tokens[1].split()[0]
-    return speed
+    """ @brief Returns the cumulative execs/sec of the stage 1 fuzzers, same
+    as the 'Cumulative speed' reported by afl-whatsup
+    @return str """
+
+    return str(int(get_afl_stats(pmfuzzdir, 1, 1)['execs_per_sec']))
 
 def record_progress(args, total_tc, total_pm_tc, total_paths, total_pm_paths, exec_rate, mq_pop):
     if args.progress_file != None:
@@ -292,16 +392,17 @@ def plot(progress_file, to_stdout=True, to_img=True, title='Progress plot'):
             plx.show()
             print('X units = ' + scale)
 
-def get_inclusive_map(pmfuzz_d, cur_stage, cur_iterid, filt, rename):
+def get_inclusive_map(pmfuzz_d, cur_stage, cur_iterid, filt, rename, 
+        cov=None):
     """ @brief Returns the cumulative map for the currently running stage, 
-    returns 0 if the currently running stage is stage 1"""
+    returns None if the currently running stage is stage 1"""
     cumulative = None
 
     if cur_stage != 1:
         stage_d = nh.get_outdir_name(cur_stage, cur_iterid)
         testcase_d = os.path.join(pmfuzz_d, stage_d, 'testcases')
         
-        cumulative = get_cumulative_map(testcase_d, filt, rename)
+        cumulative = get_cumulative_map(testcase_d, filt, rename, cov)
     return cumulative
 
 def get_inclusive_tc_cnt(pmfuzz_d, cur_stage, cur_iterid, filt):
@@ -318,7 +419,6 @@ def get_inclusive_tc_cnt(pmfuzz_d, cur_stage, cur_iterid, filt):
         stage_d = nh.get_outdir_name(cur_stage, cur_iterid)
         testcase_d = os.path.join(pmfuzz_d, stage_d, 'testcases')
         
-        for fname in filter(filt, os.listdir(testcase_d)):
-            count += 1
+        count = len(DirManifest.get(testcase_d).view(filt))
 
     return count
@@ -11,6 +11,7 @@
 import re
 import tempfile
 
+from functools import lru_cache
 from os import path
 
 from helper.common import *
@@ -42,6 +43,173 @@
 PM_IMG_REGEX            = r'^(id=\d+)(\.id=\d+)*(,id=\d+(\.id=\d+)*)*\.pm_pool$'
 PM_CMPR_IMG_REGEX       = r'^(id=\d+)(\.id=\d+)*(,id=\d+(\.id=\d+)*)*\.pm_pool.tar.gz$'
 
+# Kinds of names
+KIND_TC                 = 'testcase'
+KIND_MIN_TC             = 'min_testcase'
+KIND_MAP                = 'map'
+KIND_PM_MAP             = 'pm_map'
+KIND_CRASH_SITE         = 'crash_site'
+KIND_CMPR_CRASH_SITE    = 'crash_cmpr_site'
+KIND_PM_IMG             = 'pm_pool'
+KIND_CMPR_PM_IMG        = 'pm_cmpr_pool'
+
+# Single regex matching every kind of name, equivalent to the *_REGEX above
+_NAME_RE                = re.compile(r'^(?P<prefix>pm_map_|map_)?'
+                            + r'(id=\d+)(\.id=\d+)*(,id=\d+(\.id=\d+)*)*\.'
+                            + r'(?P<ext>min\.testcase|testcase|crash_site'
+                            + r'|crash_site.tar.gz|pm_pool|pm_pool.tar.gz)$')
+
+# (prefix, ext) -> kind
+_KINDS                  = {
+    (None,      'testcase'):            KIND_TC,
+    (None,      'min.testcase'):        KIND_MIN_TC,
+    ('map_',    'testcase'):            KIND_MAP,
+    ('pm_map_', 'testcase'):            KIND_PM_MAP,
+    (None,      'crash_site'):          KIND_CRASH_SITE,
+    (None,      'crash_site.tar.gz'):   KIND_CMPR_CRASH_SITE,
+    (None,      'pm_pool'):             KIND_PM_IMG,
+    (None,      'pm_pool.tar.gz'):      KIND_CMPR_PM_IMG,
+}
+
+_TC_RE                  = re.compile(TC_REGEX)
+_ID_DELIM_RE            = re.compile(r',|\.')
+
+# Max number of parsed names to keep, each entry is a few hundred bytes
+NAME_CACHE_SZ           = 1 << 18
+
+class TestcaseName:
+    """ @brief Immutable parsed form of a testcase, map, image or crash site
+    name. Use tc_name() to create one, it memoizes the parsing.
+
+    **Example**
+    @code{.py}
+
+    >>> name = tc_name('/a/id=010.id=016,id=012.testcase')
+    >>> name.kind, name.bare, name.lineage, name.parent
+    ('testcase', 'id=010.id=016,id=012', (10, 12), 'id=010.id=016.testcase')
+    >>> name.ancestor_cnt, name.iter_cnt
+    (1, 2)
+    >>> name.metadata('/a')['pm_cmpr_pool']
+    '/a/id=010.id=016,id=012.pm_pool.tar.gz'
+    >>> tc_name('map_id=010.testcase').kind
+    'map'
+    >>> tc_name('id=010.testcase') is tc_name('/b/id=010.testcase')
+    True
+
+    @endcode """
+
+    __slots__ = ('name', 'kind', 'valid', 'bare', 'lineage', 'parent')
+
+    def __init__(self, name):
+        """ @brief Parses a name, use tc_name() instead
+        @param name Name of the file without the directory """
+
+        kind = None
+        match = _NAME_RE.search(name)
+        if match != None:
+            ext = match.group('ext')
+
+            # The '.' before tar.gz is not escaped in the *_REGEX above
+            if ext.endswith('tar.gz'):
+                ext = ext[:-len('.tar.gz')] + '.tar.gz'
+
+            kind = _KINDS.get((match.group('prefix'), ext))
+
+        # Convert the name to the testcase it belongs to
+        basename = name
+        if 'pm_map' in basename:
+            basename = basename.replace('pm_map_', '')
+        elif 'map' in basename:
+            basename = basename.replace('map_', '')
+        elif '.pm_pool.tar.gz' in basename:
+            basename = basename.replace('.pm_pool.tar.gz', '.testcase')
+        elif '.pm_pool' in basename:
+            basename = basename.replace('.pm_pool', '.testcase')
+        elif '.crash_site.tar.gz' in basename:
+            basename = basename.replace('.crash_site.tar.gz', '.testcase')
+        elif '.crash_site' in basename:
+            basename = basename.replace('.crash_site', '.testcase')
+        elif '.min' in basename:
+            basename = basename.replace('.min', '')
+
+        valid = _TC_RE.search(basename) != None
+        bare = basename.replace('.testcase', '')
+
+        # Ids at every stage, dropping the ids of the crash sites
+        lineage = None
+        if valid:
+            lineage = tuple(int(tkn.split('.')[0].split('=')[1]) \
+                                for tkn in bare.split(','))
+
+        # Parent is the name with the last id removed
+        ext = get_extension(name)
+        clean_name = name.replace(ext, '')
+
+        parent = ''
+        ids = _ID_DELIM_RE.split(clean_name)
+        if len(ids) > 1:
+            delims = [char for char in clean_name if char in '.,']
+            parent = ids[0]
+            for delim, elem in zip(delims, ids[1:-1]):
+                parent += delim + elem
+            parent += ext
+
+        for attr, val in [('name', name), ('kind', kind), ('valid', valid),
+                ('bare', bare), ('lineage', lineage), ('parent', parent)]:
+            object.__setattr__(self, attr, val)
+
+    def __setattr__(self, attr, val):
+        raise AttributeError('TestcaseName is immutable')
+
+    @property
+    def ancestor_cnt(self):
+        return len(self.bare.split(',')) - 1
+
+    @property
+    def iter_cnt(self):
+        return self.ancestor_cnt + 1
+
+    def metadata(self, dirname='', deleted=False):
+        """ @brief Names of the metadata files of this testcase, see
+        get_metadata_files()
+        @return dict """
+
+        bare = path.join(dirname, self.bare)
+        basename = self.bare + '.testcase'
+
+        result = {
+            'testcase':         bare + '.testcase',
+            'clean':            bare,
+            'min_testcase':     bare + '.min.testcase',
+            'pm_map':           path.join(dirname, 'pm_map_' + basename),
+            'map':              path.join(dirname, 'map_' + basename),
+            'crash_site':       bare + '.crash_site',
+            'crash_cmpr_site':  bare + '.crash_site.tar.gz',
+            'pm_pool':          bare + '.pm_pool',
+            'pm_cmpr_pool':     bare + '.pm_pool.tar.gz',
+        }
+
+        if deleted:
+            result['deleted'] = bare + '.deleted'
+
+        return result
+
+    def __repr__(self):
+        return 'TestcaseName(%r)' % self.name
+
+@lru_cache(maxsize=NAME_CACHE_SZ)
+def _parse_name(basename):
+    return TestcaseName(basename)
+
+def tc_name(filename):
+    """ @brief Returns the parsed name for a filename or a file path, names
+    are parsed once and cached
+
+    @param filename Name or complete path
+    @return TestcaseName """
+
+    return _parse_name(path.basename(filename))
+
 def get_outdir_name(stage, iter_id):
     """ Get the name of the output directory for a give stage and iter id """
 
@@ -97,22 +265,12 @@ def get_lineage(tc_name):
     
     @endcode """
 
-    tc_name = path.basename(tc_name)
-    tc_name = get_metadata_files(tc_name)['clean']
+    name = _parse_name(path.basename(tc_name))
 
-    tokens = tc_name.split(',')
-    
-    lineage = []
-    for tkn in tokens:
-        # If there is a crash image extension, remove it
-        clean_tkn = tkn
-        if '.' in tkn:
-            clean_tkn = tkn[:tkn.find('.')]
-            
-        value = int(clean_tkn.split('=')[1])
-        lineage.append(value)
-    
-    return lineage
+    abort_if(not name.valid, 'Cannot convert ' + tc_name + ' to a valid '\
+        + 'testcase name, got: ' + name.bare + '.testcase')
+
+    return list(name.lineage)
 
 def clean_tc_name(tc_name):
     """ Removes extra information from testcase's name.
@@ -247,38 +405,7 @@ def get_testcase_parent(testcase):
 
     @endcode """
 
-    result = ''
-
-    basename = path.basename(testcase)
-
-    # Separate the ids and the file extension
-    ext = get_extension(basename)
-    clean_name = basename.replace(ext, '')
-
-    ids = re.split(',|\.', clean_name)
-    
-    # Collect the delimiters:
-    delims = []
-    for char in clean_name:
-        if char in ['.', ',']:
-            delims.append(char)
-
-    # Count the number of ids
-    id_cnt = len(ids)
-
-    # If there are more than 1 ids, set the result value
-    if id_cnt > 1:
-        parent_ids = ids[:-1]
-
-        # Reconstruct the name with the delimiters and the parent ids
-        result = parent_ids[0]
-        iter = 0
-        for elem in parent_ids[1:]:
-            result += delims[iter] + elem
-            iter += 1
-        result += ext
-
-    return result
+    return tc_name(testcase).parent
 
 def get_img_dir(tgtcmd):
     """ @brief Returns the image directory from a target command 
@@ -331,6 +458,12 @@ def is_regex(filename, regex):
 
     return match != None
 
+def is_kind(filename, *kinds):
+    """ @brief Checks if a filename/file path is one of the kinds (KIND_*)
+    @return Bool"""
+
+    return tc_name(filename).kind in kinds
+
 def is_tc(filename, all=False):
     """ @brief Checks if a filename/file path follows the testcase naming 
     pattern.
@@ -356,8 +489,8 @@ def is_tc(filename, all=False):
     
     @return Bool"""
 
-    return is_regex(filename, TC_REGEX) \
-        or (all and is_regex(filename, TC_MIN_REGEX))
+    kind = tc_name(filename).kind
+    return kind == KIND_TC or (all and kind == KIND_MIN_TC)
 
 def is_min_tc(filename, all=False):
     """ @brief Checks if a filename/file path follows the min testcase naming 
@@ -368,7 +501,7 @@ def is_min_tc(filename, all=False):
 
     @return Bool"""
 
-    return is_regex(filename, TC_MIN_REGEX)
+    return is_kind(filename, KIND_MIN_TC)
 
 def is_generic_tc(filename):
     return is_tc(filename, all=True)
@@ -390,26 +523,26 @@ def is_cmpr_img(filename):
     
     @return Bool"""
 
-    return is_regex(filename, PM_CMPR_IMG_REGEX)
+    return is_kind(filename, KIND_CMPR_PM_IMG)
     
 def is_img(filename):
     """ @brief Checks if a filename/file path follows the PM img naming 
     pattern.
     @return Bool"""
 
-    return is_regex(filename, PM_IMG_REGEX)
+    return is_kind(filename, KIND_PM_IMG)
 
 def is_map(filename):
     """ @brief Checks if a filename follows the map naming pattern
     @return Bool"""
 
-    return is_regex(filename, MAP_REGEX)
+    return is_kind(filename, KIND_MAP)
 
 def is_pm_map(filename):
     """ @brief Checks if a filename follows the pm map naming pattern
     @return Bool"""
 
-    return is_regex(filename, PM_MAP_REGEX)
+    return is_kind(filename, KIND_PM_MAP)
 
 def is_hash_f(filename):
     """ @brief Checks if a filename is for a hash file
@@ -421,7 +554,7 @@ def is_crash_site(filename):
     """ @brief Checks if a filename follows the crash site naming pattern
     @return Bool"""
 
-    return is_regex(filename, CRASH_SITE_REGEX)
+    return is_kind(filename, KIND_CRASH_SITE)
 
 def is_cmpr_crash_site(filename):
     """ @brief Checks if a filename follows the compressed crash site naming 
@@ -439,7 +572,7 @@ def is_cmpr_crash_site(filename):
 
     @return Bool"""
 
-    return is_regex(filename, CMPR_CRASH_SITE_REGEX)
+    return is_kind(filename, KIND_CMPR_CRASH_SITE)
 
 def iter_cnt(filename):
     """@brief returns the number of iterations a testcase has been passed 
@@ -470,17 +603,12 @@ def ancestor_cnt(filename):
 
     @endcode"""
 
-    basename = path.basename(filename)
+    name = tc_name(filename)
 
-    clean_name = get_metadata_files(basename)['clean']
+    abort_if(not name.valid, 'Cannot convert ' + filename + ' to a valid '\
+        + 'testcase name, got: ' + name.bare + '.testcase')
 
-    # Separate the ids and the file extension
-    ids = clean_name.split(',')
-    
-    # Count the number of ids
-    id_cnt = len(ids)
-
-    return id_cnt-1
+    return name.ancestor_cnt
 
 def get_metadata_files(testcase, deleted=False):
     """ @brief Takes a testcase and generates a list of metadata files 
@@ -544,46 +672,12 @@ def get_metadata_files(testcase, deleted=False):
 
     @endcode"""
 
-    basename = path.basename(testcase)
-    dirname = path.dirname(testcase)
-
-    if 'pm_map' in basename:
-        basename = basename.replace('pm_map_', '')
-    elif 'map' in basename:
-        basename = basename.replace('map_', '')
-    elif '.pm_pool.tar.gz' in basename:
-        basename = basename.replace('.pm_pool.tar.gz', '.testcase')
-    elif '.pm_pool' in basename:
-        basename = basename.replace('.pm_pool', '.testcase')
-    elif '.crash_site.tar.gz' in basename:
-        basename = basename.replace('.crash_site.tar.gz', '.testcase')
-    elif '.crash_site' in basename:
-        basename = basename.replace('.crash_site', '.testcase')
-    elif '.min' in basename:
-        basename = basename.replace('.min', '')
-
-    abort_if(not is_tc(basename), 'Cannot convert ' + testcase + ' to a valid '\
-        + 'testcase name, got: ' + basename)
-
-    bare_name = basename.replace('.testcase', '')
-
-    result = {
-        'testcase':         path.join(dirname, basename),
-        'clean':            path.join(dirname, bare_name),
-        'min_testcase':     path.join(dirname, bare_name + '.min.testcase'),
-        'pm_map':           path.join(dirname, 'pm_map_' + basename),
-        'map':              path.join(dirname, 'map_' + basename),
-        'deleted':          path.join(dirname, bare_name + '.deleted'),
-        'crash_site':       path.join(dirname, bare_name + '.crash_site'),
-        'crash_cmpr_site':  path.join(dirname, bare_name + '.crash_site.tar.gz'),
-        'pm_pool':          path.join(dirname, bare_name + '.pm_pool'),
-        'pm_cmpr_pool':     path.join(dirname, bare_name + '.pm_pool.tar.gz'),
-    }
-
-    if not deleted:
-        del result['deleted']
+    name = tc_name(testcase)
 
-    return result
+    abort_if(not name.valid, 'Cannot convert ' + testcase + ' to a valid '\
+        + 'testcase name, got: ' + name.bare + '.testcase')
+
+    return name.metadata(path.dirname(testcase), deleted)
 
 def get_parent_img(testcasepath, dir, get, isparent=False, verbose=True):
     """ Returns the name of the testcase parent image, CS or complete present
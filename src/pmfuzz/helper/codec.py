@@ -0,0 +1,258 @@
+"""
+@file       codec.py
+@details    In-process compression codecs for PM images and crash sites
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+Images are stored as a single member tar stream compressed with one of the
+codecs below. The codec of an existing archive is detected from its magic
+bytes, so archives written by `tar czf` (older output directories) and by any
+of the codecs can always be read back irrespective of the configured codec.
+"""
+
+import gzip
+import os
+import tarfile
+
+from abc import ABC
+from abc import abstractmethod
+from os import path
+
+from helper import common
+from helper import fileio
+from helper.prettyprint import *
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+class Codec(ABC):
+    """ @class Base class for a compression codec """
+
+    name            = None
+    magic           = None
+    min_level       = None
+    max_level       = None
+    default_level   = None
+
+    def __init__(self, level=None, threads=0):
+        """ @brief Create a codec
+
+        @param level Compression level, uses the codec's default if None
+        @param threads Number of compression threads, 0 disables threading, -1
+               uses all the cores (if supported by the codec) """
+
+        if level == None:
+            level = self.default_level
+
+        common.abort_if(level < self.min_level or level > self.max_level,
+            'Illegal compression level %d for %s, should ∈ [%d,%d]' \
+            % (level, self.name, self.min_level, self.max_level))
+
+        self.level      = level
+        self.threads    = threads
+
+    @classmethod
+    def available(cls):
+        """ @brief Checks if the library for this codec is installed
+        @return bool """
+        return True
+
+    @abstractmethod
+    def writer(self, fileobj):
+        """ @brief Wraps fileobj into a compressed stream
+        @return Writable file like object """
+
+    @abstractmethod
+    def reader(self, fileobj):
+        """ @brief Wraps a compressed fileobj into a decompressed stream
+        @return Readable file like object """
+
+    @abstractmethod
+    def tar_flags(self):
+        """ @brief Flags for GNU tar to handle archives of this codec
+        @return List of str """
+
+    def __str__(self):
+        return '%s (level %d)' % (self.name, self.level)
+
+class GzipCodec(Codec):
+    """ @class gzip codec, compatible with `tar czf` """
+
+    name            = 'gzip'
+    magic           = b'\x1f\x8b'
+    min_level       = 1
+    max_level       = 9
+    default_level   = 6
+
+    def writer(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='wb',
+            compresslevel=self.level, mtime=0)
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    def tar_flags(self):
+        return ['-z']
+
+class ZstdCodec(Codec):
+    """ @class zstd codec, supports multi-threaded compression """
+
+    name            = 'zstd'
+    magic           = b'\x28\xb5\x2f\xfd'
+    min_level       = 1
+    max_level       = 22
+    default_level   = 3
+
+    @classmethod
+    def available(cls):
+        return zstandard != None
+
+    def writer(self, fileobj):
+        cctx = zstandard.ZstdCompressor(level=self.level,
+            threads=self.threads)
+        return cctx.stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj,
+            closefd=False)
+
+    def tar_flags(self):
+        return ['--zstd']
+
+class Lz4Codec(Codec):
+    """ @class lz4 frame codec, fastest (de)compression """
+
+    name            = 'lz4'
+    magic           = b'\x04\x22\x4d\x18'
+    min_level       = 0
+    max_level       = 16
+    default_level   = 0
+
+    @classmethod
+    def available(cls):
+        return lz4 != None
+
+    def writer(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode='wb',
+            compression_level=self.level)
+
+    def reader(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode='rb')
+
+    def tar_flags(self):
+        return ['-I', 'lz4']
+
+CODECS = {codec.name: codec for codec in [GzipCodec, ZstdCodec, Lz4Codec]}
+
+def get_codec(name='gzip', level=None, threads=0):
+    """ @brief Returns a codec by name, falls back to gzip if the library for
+    the codec is not installed
+
+    @param name Name of the codec, one of CODECS
+    @param level Compression level, codec's default if None
+    @param threads Number of compression threads
+    @return Codec object """
+
+    common.abort_if(name not in CODECS, 'Unknown codec %s, should be one of '\
+        % name + ', '.join(CODECS))
+
+    codec = CODECS[name]
+
+    if not codec.available():
+        printw('Codec %s is not installed, falling back to gzip' % name)
+        codec, level = GzipCodec, None
+
+    return codec(level, threads)
+
+def from_cfg(cfg):
+    """ @brief Returns the codec configured in pmfuzz.compression, configs
+    without the key use gzip to stay compatible with `tar czf`
+    @return Codec object """
+
+    cmpr_cfg = cfg['pmfuzz'].get('compression', {'codec': 'gzip'})
+
+    return get_codec(
+        name    = cmpr_cfg.get('codec', 'gzip'),
+        level   = cmpr_cfg.get('level', None),
+        threads = cmpr_cfg.get('threads', 0),
+    )
+
+def detect(fpath):
+    """ @brief Detects the codec of a compressed file using its magic bytes
+
+    @param fpath Path to the compressed file
+    @return Codec object """
+
+    with open(fpath, 'rb') as obj:
+        header = obj.read(4)
+
+    for codec in CODECS.values():
+        if header.startswith(codec.magic):
+            common.abort_if(not codec.available(),
+                'Codec %s needed to read %s is not installed' \
+                % (codec.name, fpath))
+            return codec()
+
+    common.abort('Unknown compression format for ' + fpath)
+
+def compress_file(src, dest, codec, arcname=None, fileobj=None):
+    """ @brief Compresses a single file to a tar stream
+
+    @param src Path of the file to compress
+    @param dest Path of the compressed file
+    @param codec Codec object to use
+    @param arcname Name of the file in the archive, basename of src if None
+    @param fileobj Readable object for the content of src, src is read
+           skipping its holes if None
+    @return None """
+
+    if arcname == None:
+        arcname = path.basename(src)
+
+    with open(dest, 'wb') as raw, codec.writer(raw) as stream:
+        with tarfile.open(fileobj=stream, mode='w|',
+                format=tarfile.GNU_FORMAT) as tar:
+            tarinfo = tar.gettarinfo(src, arcname=arcname)
+
+            if fileobj == None:
+                with fileio.SparseReader(src) as src_obj:
+                    tar.addfile(tarinfo, src_obj)
+            else:
+                tar.addfile(tarinfo, fileobj)
+
+def decompress_file(src, dest_dir):
+    """ @brief Extracts all the files from a compressed tar stream written by
+    compress_file() or `tar czf`
+
+    @param src Path to the compressed file
+    @param dest_dir Directory to extract the files in
+    @return List of path of the extracted files """
+
+    codec = detect(src)
+    result = []
+
+    with open(src, 'rb') as raw, codec.reader(raw) as stream:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                common.abort_if(not member.isfile(),
+                    'Unexpected member %s in %s' % (member.name, src))
+
+                # Members are always extracted directly in dest_dir, zero
+                # blocks are left as holes
+                dest = path.join(dest_dir, path.basename(member.name))
+                fileio.write_sparse(tar.extractfile(member), dest, member.size)
+
+                os.chmod(dest, member.mode)
+                os.utime(dest, (member.mtime, member.mtime))
+
+                result.append(dest)
+
+    return result
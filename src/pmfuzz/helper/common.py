@@ -17,9 +17,11 @@
 from datetime import datetime as dt
 from datetime import date
 from os import path
-from shutil import copy2
+from shutil import copystat
 from typing import List, Dict, Set
 
+from helper import codec as pmcodec
+from helper import fileio
 from helper.prettyprint import *
 
 PM_IMG_MRK = '__POOL_IMAGE__'
@@ -30,14 +32,21 @@
 PERSIST_IMG_MRK_DELETE  = '1'
 
 def pid_alive(pid):        
-    """ Check For the existence of a unix pid. """
+    """ Check For the existence of a unix pid. A missing (0) or negative pid 
+    is never alive, kill() would signal a process group instead. A process
+    owned by another user is alive. """
+
+    if pid <= 0:
+        return False
 
     try:
         os.kill(pid, 0)
-    except OSError:
+    except ProcessLookupError:
         return False
-    else:
-        return True
+    except PermissionError:
+        pass
+
+    return True
 
 def fmt_stacktrace_ln(line):
     tokens = line.split(',')
@@ -54,11 +63,14 @@ def fmt_stacktrace_ln(line):
     return tokens[0] + ':' + tokens[1] + tokens[2]
 
 def copypreserve(src, dst):
-    """ Preserves metadata on copy """
+    """ Preserves metadata on copy, holes in src are preserved in dst. Uses a
+    reflink or copy_file_range() when possible, see fileio.sparse_copy() """
     
     abort_if(os.path.isdir(dst), 
         f'Destination {dst} should not be a directory')
-    copy2(src, dst)
+
+    fileio.sparse_copy(src, dst)
+    copystat(src, dst)
 
 def abort(msg=None, excode=1, tb_fmt=None):
     # print("stack received = ", traceback.format_stack()[-2].split('\n'))
@@ -111,7 +123,7 @@ def ask_yn(question, force_resp=None):
     return (resp == 'y')
 
 def exec_shell(cmd, stdin=None, stdout=None, stderr=None,
-        env=None, cwd=None, wait=False, timeout=None):
+        env=None, cwd=None, wait=False, timeout=None, handle=False):
     """ @brief Executes a given command with different options 
     
     @param cmd List of string for the command to execute
@@ -122,9 +134,11 @@ def exec_shell(cmd, stdin=None, stdout=None, stderr=None,
     @param cwd Str representing the path of the directory to start the process in
     @param wait Bool indicating to wait for the process to complete execution
     @param timeout int timeout for the process in seconds
+    @param handle Bool indicating to return the subprocess.Popen object 
+           instead of the pid if not waiting
 
-    @return int with holding the pid of the process if not waiting, None 
-            otherwise
+    @return int with holding the pid of the process (or the Popen object if 
+            handle is set) if not waiting, None otherwise
     """
 
     if timeout != None and float(timeout) < 1:
@@ -163,7 +177,10 @@ def exec_shell(cmd, stdin=None, stdout=None, stderr=None,
             pass
     else:
         result = exec_f(cmd, env=env, stdin=stdin, stdout=stdout, \
-            stderr=stderr, preexec_fn=os.setpgrp, close_fds=True).pid
+            stderr=stderr, preexec_fn=os.setpgrp, close_fds=True)
+
+        if not handle:
+            result = result.pid
 
     return result
 
@@ -226,53 +243,48 @@ def remove_files(file_list, verbose, warn=False, force=False):
         elif not force:
             abort('File ' + file + ' does not exists')
 
-def get_compress_cmd(src, dest, verbose):
+def get_compress_cmd(src, dest, verbose, codec=None):
     src_dir = path.dirname(src)
     src_file = path.basename(src)
 
-    cmd = ['tar', 'vczf', dest, '-C', src_dir, src_file]
+    if codec == None:
+        codec = pmcodec.GzipCodec()
+
+    cmd = ['tar', 'vcf', dest] + codec.tar_flags() + ['-C', src_dir, src_file]
 
     return cmd
 
-def compress(src, dest, verbose, level=6, extra_params=[]):
+def compress(src, dest, verbose, level=6, codec=None, arcname=None):
     """ Compresses a file from src to dest 
     @param src Full path to the source to compress
     @param dest Full path to the destination compressed file
     @param verbose Verbose logging to stdout
-    @param level Compression level to use, should belong to [1,9]
+    @param level Compression level to use for gzip, ignored if codec is set
+    @param codec Codec object (see helper/codec.py) to use, gzip if None
+    @param arcname Name of the file in the archive, basename of src if None
     @return None
     """
 
-    cmd = get_compress_cmd(src, dest, verbose) + extra_params
+    if codec == None:
+        codec = pmcodec.GzipCodec(level)
 
     if verbose:
-        printv('Compressing ' + src + ' -> ' + dest)
-        printv('Cmd: ' + ' '.join(cmd))
-
-    abort_if(level < 1 or level > 9, 
-        'Illegal compression level %d, should ∈ [1,9]' % level)
-
-    env = {
-        'GZIP': '-' + str(level),
-    }
+        printv('Compressing ' + src + ' -> ' + dest + ' using ' + str(codec))
 
-    subprocess.run(
-        cmd, 
-        env     = env,
-        check   = True, 
-        stdout  = subprocess.PIPE, 
-        stderr  = subprocess.PIPE,
-    )
+    pmcodec.compress_file(src, dest, codec, arcname=arcname)
 
 def get_decompress_cmd(src, dest, verbose):
     dest_dir = path.dirname(dest)
 
-    cmd = ['tar', 'xzf', src, '-C', dest_dir]
+    codec = pmcodec.detect(src)
+
+    cmd = ['tar', 'xf', src] + codec.tar_flags() + ['-C', dest_dir]
 
     return cmd    
 
 def decompress(src, dest, verbose, verify=False):
-    """ Deompresses a file from src to dest 
+    """ Deompresses a file from src to dest, the codec is detected from the
+    contents of src
     @param src Path to the compressed file
     @param dest Path to the decompressed file
     @param verbose Path to the compressed file
@@ -281,21 +293,10 @@ def decompress(src, dest, verbose, verify=False):
     @return None
     """
 
-    cmd = get_decompress_cmd(src, dest, verbose)
-
     if verbose:
         printv('Decompressing ' + src + ' -> ' + dest)
-        printv('Cmd: ' + ' '.join(cmd))
         
-    subprocess.run(
-        cmd, 
-        check   = True, 
-        stdout  = subprocess.PIPE, 
-        stderr  = subprocess.PIPE,
-        env     = {
-            'GZIP':'-f'
-        },
-    )
+    pmcodec.decompress_file(src, path.dirname(dest))
 
     if verify:
         abort_if(not os.path.isfile(dest), 'Dest %s was not created' % dest)
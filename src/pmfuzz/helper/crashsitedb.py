@@ -0,0 +1,227 @@
+"""
+@file       crashsitedb.py
+@details    Store for the hashes of the crash sites
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+Maps the clean name of every crash site to the hash of its contents. Backed
+by SQLite in WAL mode so multiple PMFuzz processes can write to it
+concurrently and inserts do not rewrite the complete store. Hashes saved by
+older versions of PMFuzz in the pickledb JSON file (@crashsitehashes.db) are
+migrated on first use.
+
+The store also keeps the verdict of testing a crash site (see
+Stage.validate_crash_sites()) keyed on the hash of the crash site and the
+testcase it was tested with, so crash sites with the same contents are only
+tested once.
+"""
+
+import json
+import os
+import sqlite3
+
+from os import path
+
+from helper.common import abort
+from helper.prettyprint import *
+
+class CrashSiteDB:
+    """ @class Persistent crash site name -> hash store """
+
+    DB_NAME         = '@crashsites.sqlite'
+    LEGACY_DB_NAME  = '@crashsitehashes.db'
+
+    def __init__(self, outdir, verbose=False):
+        """ @brief Create a crash site DB for a PMFuzz output directory
+
+        @param outdir PMFuzz output directory, the store is saved here
+        @param verbose Verbose logging to stdout """
+
+        self.db_f       = path.join(outdir, self.DB_NAME)
+        self.legacy_f   = path.join(outdir, self.LEGACY_DB_NAME)
+        self.verbose    = verbose
+
+        self._conn      = None
+        self._pid       = None
+
+    @property
+    def conn(self):
+        """ @brief Connection to the store, reopened in forked children since
+        SQLite connections cannot be shared across processes """
+
+        if self._conn == None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_f, timeout=60,
+                isolation_level=None)
+            self._pid = os.getpid()
+
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+
+            # seq records the order in which the crash sites were first seen
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS crash_sites (
+                    seq     INTEGER PRIMARY KEY,
+                    name    TEXT    NOT NULL UNIQUE,
+                    digest  TEXT    NOT NULL
+                )''')
+            self._conn.execute('''CREATE INDEX IF NOT EXISTS digest_idx
+                    ON crash_sites (digest, seq)''')
+
+            # name is the crash site the verdict was found with
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS verdicts (
+                    digest      TEXT    NOT NULL,
+                    tester      TEXT    NOT NULL,
+                    name        TEXT    NOT NULL,
+                    success     INTEGER NOT NULL,
+                    exit_code   INTEGER,
+                    PRIMARY KEY (digest, tester)
+                )''')
+
+            self._migrate()
+
+        return self._conn
+
+    def _migrate(self):
+        """ @brief One time import of the hashes from the pickledb file """
+
+        if not path.isfile(self.legacy_f):
+            return
+
+        with self._conn:
+            # Take the write lock so only one process migrates
+            self._conn.execute('BEGIN IMMEDIATE')
+
+            if not path.isfile(self.legacy_f):
+                return
+
+            try:
+                with open(self.legacy_f, 'r') as obj:
+                    legacy = json.load(obj)
+            except ValueError as e:
+                abort('Unable to read %s: %s' % (self.legacy_f, str(e)))
+                return
+
+            self._set_many(legacy.items())
+            os.rename(self.legacy_f, self.legacy_f + '.migrated')
+
+        printi('Migrated %d crash site hashes from %s' \
+            % (len(legacy), self.legacy_f))
+
+    def _set_many(self, items):
+        self._conn.executemany('''INSERT INTO crash_sites (name, digest)
+                VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET digest=excluded.digest''',
+                items)
+
+    def set_many(self, items):
+        """ @brief Inserts or updates multiple crash sites in one transaction
+
+        @param items Iterable of (name, digest)
+        @return None """
+
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN')
+            self._set_many(items)
+
+    def set(self, name, digest):
+        """ @brief Inserts or updates a single crash site
+        @return None """
+
+        self.set_many([(name, digest)])
+
+    def get(self, name):
+        """ @brief Returns the hash of a crash site
+        @return str or None if the crash site is not in the store """
+
+        row = self.conn.execute('SELECT digest FROM crash_sites WHERE name=?',
+            (name,)).fetchone()
+
+        return None if row == None else row[0]
+
+    def first_seen(self, digest):
+        """ @brief Returns the first crash site seen with a hash
+        @return str or None if no crash site has this hash """
+
+        row = self.conn.execute('''SELECT name FROM crash_sites
+                WHERE digest=? ORDER BY seq LIMIT 1''', (digest,)).fetchone()
+
+        return None if row == None else row[0]
+
+    def duplicates(self, names):
+        """ @brief Finds duplicate crash sites in a set of crash sites, the
+        crash site seen first is kept for each hash
+
+        @param names Iterable of crash site names
+        @return Tuple (list of names to drop, list of names missing from the
+                store, number of unique hashes) """
+
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('''CREATE TEMP TABLE IF NOT EXISTS candidates (
+                    name TEXT PRIMARY KEY)''')
+            conn.execute('DELETE FROM candidates')
+            conn.executemany('INSERT OR IGNORE INTO candidates VALUES (?)',
+                ((name,) for name in names))
+
+            missing = [row[0] for row in conn.execute('''SELECT c.name
+                    FROM candidates c LEFT JOIN crash_sites cs
+                    ON c.name = cs.name WHERE cs.name IS NULL''')]
+
+            to_drop = [row[0] for row in conn.execute('''
+                    SELECT cs.name FROM crash_sites cs
+                    JOIN candidates c ON c.name = cs.name
+                    WHERE cs.seq NOT IN (
+                        SELECT MIN(cs2.seq) FROM crash_sites cs2
+                        JOIN candidates c2 ON c2.name = cs2.name
+                        GROUP BY cs2.digest)''')]
+
+            unique = conn.execute('''SELECT COUNT(DISTINCT cs.digest)
+                    FROM crash_sites cs
+                    JOIN candidates c ON c.name = cs.name''').fetchone()[0]
+
+            conn.execute('DELETE FROM candidates')
+
+        return (to_drop, missing, unique)
+
+    def set_verdicts(self, items, tester):
+        """ @brief Saves the verdicts of testing crash sites in one
+        transaction, the first verdict of a hash is kept
+
+        @param items Iterable of (digest, name, success, exit_code)
+        @param tester Testcase the crash sites were tested with
+        @return None """
+
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('''INSERT OR IGNORE INTO verdicts
+                    (digest, tester, name, success, exit_code)
+                    VALUES (?, ?, ?, ?, ?)''',
+                ((digest, tester, name, int(bool(success)), exit_code) \
+                    for digest, name, success, exit_code in items))
+
+    def get_verdicts(self, digests, tester):
+        """ @brief Returns the saved verdicts of crash site hashes
+
+        @param digests Iterable of hashes
+        @param tester Testcase the crash sites were tested with
+        @return dict of digest -> (name, success, exit_code) for the hashes
+                with a verdict """
+
+        digests = list(digests)
+        result = {}
+
+        # Stay below SQLite's limit on the number of variables
+        for i in range(0, len(digests), 500):
+            chunk = digests[i:i+500]
+            rows = self.conn.execute('''SELECT digest, name, success,
+                    exit_code FROM verdicts
+                    WHERE tester=? AND digest IN (%s)'''
+                    % ','.join('?'*len(chunk)), [tester] + chunk)
+
+            for digest, name, success, exit_code in rows:
+                result[digest] = (name, bool(success), exit_code)
+
+        return result
@@ -0,0 +1,368 @@
+"""
+@file       fileio.py
+@details    Sparse file aware I/O for PM images
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+PM pools are mostly holes or zeros, routines here only read the data extents
+of a file (found using SEEK_DATA/SEEK_HOLE) and treat everything else as
+zeros. On file systems without SEEK_DATA/SEEK_HOLE support, the complete file
+is treated as a single data extent.
+"""
+
+import errno
+import fcntl
+import hashlib
+import io
+import os
+
+from multiprocessing import Array
+
+SEEK_DATA   = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE   = getattr(os, 'SEEK_HOLE', 4)
+
+HASH_BS     = 64*1024           # Block size for sparse hash, do not change
+COPY_BS     = 1024*1024         # Max size of a single read while copying
+
+ZERO_BLK    = bytes(COPY_BS)
+
+FICLONE     = 0x40049409        # _IOW(0x94, 9, int) from linux/fs.h
+
+# Copy methods used by sparse_copy(), in the order they are tried
+COPY_REFLINK    = 0
+COPY_RANGE      = 1
+COPY_USER       = 2
+COPY_METHODS    = ['reflink', 'copy_file_range', 'userspace']
+
+# Errors that make a copy method fall back to the next one
+_FALLBACK_ERRNOS = [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTTY, errno.EBADF, errno.EPERM]
+
+# [calls, bytes moved, bytes copied] for each copy method. Lives in shared
+# memory so copies done by forked workers are counted too, see 
+# _get_copy_stats().
+_copy_stats = None
+
+def data_extents(fd, size=None):
+    """ @brief Generates the data extents of an open file
+
+    @param fd File descriptor of the file
+    @param size Size of the file, read from the fd if None
+    @return Generator of (start, end) offsets, end is exclusive """
+
+    if size == None:
+        size = os.fstat(fd).st_size
+
+    try:
+        os.lseek(fd, 0, SEEK_HOLE)
+    except OSError:
+        # No SEEK_HOLE support, everything is data
+        if size > 0:
+            yield (0, size)
+        return
+
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as e:
+            # No data after pos
+            if e.errno == errno.ENXIO:
+                return
+            raise
+
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+
+        if start >= end:
+            return
+
+        yield (start, end)
+        pos = end
+
+def is_zero(buf):
+    """ @brief Checks if a buffer contains only zeros
+    @return bool """
+
+    return buf == ZERO_BLK[:len(buf)]
+
+def sparse_sha256(fpath):
+    """ @brief Returns a sha256 sum of a file that does not depend on the
+    layout of holes in the file
+
+    The hash is the sha256 over the file size followed by (block index, block
+    data) for every 64 KiB block that contains a non-zero byte. A block that
+    is a hole and a block of zeros hash the same, so two files with the same
+    contents always have the same hash. The value is different from
+    sha256sum() of the same file.
+
+    @param fpath Path of the file
+    @return str """
+
+    sha256 = hashlib.sha256()
+
+    with open(fpath, 'rb') as obj:
+        fd = obj.fileno()
+        size = os.fstat(fd).st_size
+
+        sha256.update(size.to_bytes(8, 'little'))
+
+        next_blk = 0
+        for start, end in data_extents(fd, size):
+            blk = max(start // HASH_BS, next_blk)
+
+            while blk*HASH_BS < end:
+                block = os.pread(fd, HASH_BS, blk*HASH_BS)
+
+                if not is_zero(block):
+                    sha256.update(blk.to_bytes(8, 'little'))
+                    sha256.update(block)
+
+                blk += 1
+
+            next_blk = blk
+
+    return sha256.hexdigest()
+
+def _get_copy_stats():
+    """ @brief Returns the copy counters, they are allocated on the first 
+    copy, the first read or before the first fork, whichever comes first, so
+    the parent and its workers share them
+    @return multiprocessing.Array """
+
+    global _copy_stats
+
+    if _copy_stats == None:
+        _copy_stats = Array('q', 3*len(COPY_METHODS))
+
+    return _copy_stats
+
+os.register_at_fork(before=_get_copy_stats)
+
+def _record_copy(method, moved, size):
+    stats = _get_copy_stats()
+
+    with stats.get_lock():
+        stats[3*method + 0] += 1
+        stats[3*method + 1] += moved
+        stats[3*method + 2] += size
+
+def copy_stats(reset=False):
+    """ @brief Returns the number of copies and bytes moved by each copy 
+    method since the start (or the last reset), across all processes
+
+    @param reset Resets the counters after reading them
+    @return dict of method name -> {'calls', 'moved', 'copied'}, 'copied'
+            is the total size of the files, moved - copied is the I/O saved"""
+
+    result = {}
+    stats = _get_copy_stats()
+
+    with stats.get_lock():
+        for method, name in enumerate(COPY_METHODS):
+            result[name] = {
+                'calls':    stats[3*method + 0],
+                'moved':    stats[3*method + 1],
+                'copied':   stats[3*method + 2],
+            }
+
+        if reset:
+            for i in range(len(stats)):
+                stats[i] = 0
+
+    return result
+
+def _copy_range(src_fd, dst_fd, start, end):
+    """ @brief Copies [start, end) using copy_file_range(), stops early if 
+    copy_file_range() is not supported for these files
+    @return Tuple (bytes copied, True if the copy stopped early) """
+
+    pos = start
+    while pos < end:
+        try:
+            cnt = os.copy_file_range(src_fd, dst_fd, end - pos, pos, pos)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+
+            return (pos - start, True)
+
+        if cnt == 0:
+            break
+
+        pos += cnt
+
+    return (pos - start, False)
+
+def _copy_user(src_fd, dst_fd, start, end):
+    """ @brief Copies [start, end) through userspace, zero blocks are skipped
+    @return Number of bytes written """
+
+    written = 0
+    pos = start
+
+    while pos < end:
+        buf = os.pread(src_fd, min(COPY_BS, end - pos), pos)
+
+        if len(buf) == 0:
+            break
+
+        if not is_zero(buf):
+            written += os.pwrite(dst_fd, buf, pos)
+
+        pos += len(buf)
+
+    return written
+
+def sparse_copy(src, dst):
+    """ @brief Copies the contents of src to dst without copying the metadata
+
+    Tries to reflink (FICLONE) the complete file first, which only works on
+    the same CoW file system (e.g., XFS, btrfs). Otherwise copies the data 
+    extents of src using copy_file_range(), and if that is unsupported 
+    (e.g., across file systems on old kernels), through userspace. Holes in
+    src are left as holes in dst in all the cases.
+
+    @param src Path of the source file
+    @param dst Path of the destination file, truncated if it exists
+    @return Tuple (method, bytes moved), method is one of COPY_* """
+
+    with open(src, 'rb') as src_obj, open(dst, 'wb') as dst_obj:
+        src_fd, dst_fd = src_obj.fileno(), dst_obj.fileno()
+        size = os.fstat(src_fd).st_size
+
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+            _record_copy(COPY_REFLINK, 0, size)
+            return (COPY_REFLINK, 0)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+
+        method = COPY_RANGE
+        if not hasattr(os, 'copy_file_range'):
+            method = COPY_USER
+
+        moved = 0
+        for start, end in data_extents(src_fd, size):
+            if method == COPY_RANGE:
+                cnt, unsupported = _copy_range(src_fd, dst_fd, start, end)
+                moved += cnt
+
+                if not unsupported:
+                    continue
+
+                # Continue from where copy_file_range() stopped
+                method = COPY_USER
+                start += cnt
+
+            moved += _copy_user(src_fd, dst_fd, start, end)
+
+        os.ftruncate(dst_fd, size)
+
+    _record_copy(method, moved, size)
+    return (method, moved)
+
+def write_sparse(fileobj, dst, size):
+    """ @brief Writes size bytes from a stream to dst, skipping zero blocks to
+    create holes
+
+    @param fileobj Readable file object
+    @param dst Path of the destination file, truncated if it exists
+    @param size Number of bytes to read from the stream
+    @return Number of bytes written to dst """
+
+    written = 0
+
+    with open(dst, 'wb') as dst_obj:
+        dst_fd = dst_obj.fileno()
+
+        pos = 0
+        while pos < size:
+            buf = fileobj.read(min(COPY_BS, size - pos))
+
+            if len(buf) == 0:
+                break
+
+            if not is_zero(buf):
+                written += os.pwrite(dst_fd, buf, pos)
+
+            pos += len(buf)
+
+        os.ftruncate(dst_fd, pos)
+
+    return written
+
+class SparseReader(io.RawIOBase):
+    """ @class Read only file object that returns zeros for holes without
+    reading them from the file system, e.g., for compressing PM images """
+
+    def __init__(self, fpath):
+        self._obj       = open(fpath, 'rb')
+        self._fd        = self._obj.fileno()
+        self.size       = os.fstat(self._fd).st_size
+        self.extents    = list(data_extents(self._fd, self.size))
+        self._pos       = 0
+        self._ext_idx   = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buf):
+        if self._pos >= self.size:
+            return 0
+
+        mv = memoryview(buf).cast('B')
+        cnt = min(len(mv), self.size - self._pos, COPY_BS)
+
+        # Skip the extents that end before the current position
+        while self._ext_idx < len(self.extents) \
+                and self.extents[self._ext_idx][1] <= self._pos:
+            self._ext_idx += 1
+
+        if self._ext_idx == len(self.extents) \
+                or self.extents[self._ext_idx][0] > self._pos:
+            # In a hole
+            hole_end = self.size
+            if self._ext_idx < len(self.extents):
+                hole_end = self.extents[self._ext_idx][0]
+
+            cnt = min(cnt, hole_end - self._pos)
+            mv[:cnt] = ZERO_BLK[:cnt]
+        else:
+            cnt = min(cnt, self.extents[self._ext_idx][1] - self._pos)
+            cnt = os.preadv(self._fd, [mv[:cnt]], self._pos)
+
+        self._pos += cnt
+        return cnt
+
+    def read(self, size=-1):
+        """ @brief Unlike RawIOBase.read(), only returns less than size bytes
+        at the end of the file, tarfile expects this """
+
+        if size == None or size < 0:
+            size = self.size - self._pos
+
+        buf = bytearray(max(0, min(size, self.size - self._pos)))
+        mv = memoryview(buf)
+
+        done = 0
+        while done < len(buf):
+            cnt = self.readinto(mv[done:])
+
+            # File was truncated after opening
+            if cnt == 0:
+                break
+
+            done += cnt
+
+        return bytes(buf[:done])
+
+    def close(self):
+        if not self.closed:
+            self._obj.close()
+        super().close()
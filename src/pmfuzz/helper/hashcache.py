@@ -0,0 +1,154 @@
+"""
+@file       hashcache.py
+@details    Persistent cache for file digests
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+Digests are saved in an SQLite index under the PMFuzz output directory and
+are keyed on the (device, inode, algorithm) of the file. A cached digest is
+only used if the size, mtime_ns and ctime_ns of the file still match, so a
+modified or replaced file is always hashed again. The mtime alone is not
+enough: copystat() (e.g., copypreserve()) sets the mtime of a new file to the
+source's and the inode of a removed map is often reused for a map of the same
+size. The ctime cannot be set and changes on every write.
+
+A row that fails the check is replaced or deleted. The path a digest was 
+computed for is saved as well, prune() drops the rows of files that were
+removed or whose inode now belongs to a different file.
+"""
+
+import os
+import sqlite3
+import time
+
+from os import path
+
+from helper import fileio
+from helper.common import sha256sum
+
+# Supported hash algorithms
+ALGOS = {
+    'sha256':           sha256sum,
+    'sparse_sha256':    fileio.sparse_sha256,
+}
+
+# Files changed (ctime) in the last RACY_WINDOW seconds are hashed but not 
+# cached: ctime uses a coarse clock, so a file rewritten (or a reused inode) 
+# with the same size within a tick would otherwise return a stale digest.
+RACY_WINDOW = 2 # sec
+
+class HashCache:
+    """ @class Memoizes file digests in an on disk index """
+
+    DB_NAME = '@hashcache.db'
+
+    def __init__(self, outdir):
+        """ @brief Create a hash cache for a PMFuzz output directory
+
+        @param outdir PMFuzz output directory, the index is saved here """
+
+        self.db_f   = path.join(outdir, self.DB_NAME)
+        self.hits   = 0
+        self.misses = 0
+
+        self._conn  = None
+        self._pid   = None
+
+    @property
+    def conn(self):
+        """ @brief Connection to the index, reopened in forked children since
+        SQLite connections cannot be shared across processes """
+
+        if self._conn == None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_f, timeout=60,
+                isolation_level=None)
+            self._pid = os.getpid()
+
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+
+            # Indexes from older versions have no ctime_ns or path, they are
+            # only a cache and are dropped
+            cols = [row[1] for row in \
+                        self._conn.execute('PRAGMA table_info(hashes)')]
+            if len(cols) > 0 and \
+                    ('ctime_ns' not in cols or 'path' not in cols):
+                self._conn.execute('DROP TABLE IF EXISTS hashes')
+
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                    dev         INTEGER NOT NULL,
+                    ino         INTEGER NOT NULL,
+                    algo        TEXT    NOT NULL,
+                    size        INTEGER NOT NULL,
+                    mtime_ns    INTEGER NOT NULL,
+                    ctime_ns    INTEGER NOT NULL,
+                    path        TEXT    NOT NULL,
+                    digest      TEXT    NOT NULL,
+                    PRIMARY KEY (dev, ino, algo)
+                )''')
+
+        return self._conn
+
+    def digest(self, fpath, algo='sha256'):
+        """ @brief Returns the digest of a file, reads the file only if the
+        cached digest is missing or stale
+
+        @param fpath Path of the file
+        @param algo Hash algorithm, one of ALGOS
+        @return str """
+
+        st = os.stat(fpath)
+        key = (st.st_dev, st.st_ino, algo)
+
+        row = self.conn.execute('SELECT size, mtime_ns, ctime_ns, digest '
+                'FROM hashes WHERE dev=? AND ino=? AND algo=?', key).fetchone()
+
+        if row != None and row[:3] \
+                == (st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+            self.hits += 1
+            return row[3]
+
+        self.misses += 1
+        result = ALGOS[algo](fpath)
+
+        if st.st_ctime_ns < (time.time() - RACY_WINDOW) * 1e9:
+            self.conn.execute('INSERT OR REPLACE INTO hashes '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    key + (st.st_size, st.st_mtime_ns, st.st_ctime_ns, 
+                        path.abspath(fpath), result))
+        elif row != None:
+            # Stale and the new digest is not cached
+            self.conn.execute('DELETE FROM hashes '
+                    'WHERE dev=? AND ino=? AND algo=?', key)
+
+        return result
+
+    def prune(self):
+        """ @brief Drops the digests of the files that were removed or whose
+        inode was reused by another file since they were cached
+        @return Number of digests dropped """
+
+        stale = []
+
+        for dev, ino, fpath in self.conn.execute('SELECT dev, ino, path '
+                'FROM hashes').fetchall():
+            try:
+                st = os.stat(fpath)
+            except FileNotFoundError:
+                stale.append((dev, ino))
+                continue
+
+            if (st.st_dev, st.st_ino) != (dev, ino):
+                stale.append((dev, ino))
+
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('DELETE FROM hashes WHERE dev=? AND ino=?', stale)
+
+        return len(stale)
+
+    def __str__(self):
+        return 'HashCache(%s, hits=%d, misses=%d)' \
+            % (self.db_f, self.hits, self.misses)
@@ -0,0 +1,270 @@
+"""
+@file       imgcache.py
+@details    Cache of decompressed parent images
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+A parent image can have hundreds of children, and every child (its stage 2
+run, failure injection or coverage run) used to decompress the parent image
+again. ImageCache keeps the decompressed images in a directory under
+pmfuzz.img_loc and hands out a private copy of the cached image to every
+user, using a reflink when the file system supports it (see
+fileio.sparse_copy()). A hardlink is never used, the target writes to the
+image it is given.
+
+The cache is shared by all PMFuzz processes using the same img_loc. Its index
+(index.json) is only read and written with an exclusive flock on index.lock
+held, every cached image has its own lock held while it is decompressed so an
+image is only decompressed once. An image being copied from is referenced by
+the pid of the copying process and is never evicted. Unreferenced images are
+evicted in LRU order once the cache grows beyond its size limit.
+
+Images are keyed on the path, size and mtime of the compressed image, so a
+replaced image is decompressed again.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+from os import path
+from shutil import rmtree
+
+from helper import codec
+from helper.common import abort_if, copypreserve, pid_alive, decompress as \
+                            _decompress
+from helper.prettyprint import *
+
+class ImageCache:
+    """ @class Size bounded LRU cache of decompressed images """
+
+    DIR_NAME    = 'pmfuzz-img-cache'
+    INDEX_NAME  = 'index.json'
+    LOCK_NAME   = 'index.lock'
+    IMG_EXT     = '.img'
+
+    COUNTERS    = ['hits', 'misses', 'bytes_saved', 'evictions']
+
+    def __init__(self, rootdir, max_size, verbose=False):
+        """ @brief Create a cache, the directory is created if needed
+
+        @param rootdir Directory to keep the images in
+        @param max_size Max disk usage of the cached images in bytes """
+
+        self.rootdir    = rootdir
+        self.max_size   = max_size
+        self.verbose    = verbose
+
+        self.index_f    = path.join(rootdir, self.INDEX_NAME)
+        self.lock_f     = path.join(rootdir, self.LOCK_NAME)
+
+        os.makedirs(rootdir, exist_ok=True)
+
+    @classmethod
+    def from_cfg(cls, cfg, verbose=False):
+        """ @brief Creates the cache configured by pmfuzz.img_cache, under
+        pmfuzz.img_loc
+
+        @param cfg Config object
+        @return ImageCache or None if the cache is disabled or the config has
+                no pmfuzz.img_cache """
+
+        cache_cfg = cfg['pmfuzz'].get('img_cache', {'enable': False})
+        if not cache_cfg.get('enable', False):
+            return None
+
+        return cls(path.join(cfg['pmfuzz']['img_loc'], cls.DIR_NAME),
+                    int(cache_cfg.get('max_size', 4096))*1024*1024, verbose)
+
+    @contextmanager
+    def _index(self):
+        """ @brief Locks the index and yields it as a dict, the index is
+        saved when the context exits without an exception """
+
+        with open(self.lock_f, 'a') as lock_obj:
+            fcntl.flock(lock_obj.fileno(), fcntl.LOCK_EX)
+
+            try:
+                with open(self.index_f, 'r') as obj:
+                    index = json.load(obj)
+            except (FileNotFoundError, ValueError):
+                index = {'entries': {}}
+
+            for counter in self.COUNTERS:
+                index.setdefault(counter, 0)
+
+            yield index
+
+            tmp_f = self.index_f + '.tmp'
+            with open(tmp_f, 'w') as obj:
+                json.dump(index, obj)
+
+            os.replace(tmp_f, self.index_f)
+
+    @contextmanager
+    def _entry_lock(self, key):
+        """ @brief Holds the lock of an image while it is decompressed """
+
+        with open(path.join(self.rootdir, key + '.lock'), 'a') as lock_obj:
+            fcntl.flock(lock_obj.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _key(self, src):
+        stat = os.stat(src)
+        ident = '%s:%d:%d' % (path.abspath(src), stat.st_size,
+                    stat.st_mtime_ns)
+
+        return hashlib.sha1(ident.encode()).hexdigest()[:20]
+
+    def _img_path(self, key):
+        return path.join(self.rootdir, key + self.IMG_EXT)
+
+    def _fill(self, src, key):
+        """ @brief Decompresses an image into the cache
+        @return None """
+
+        tmpdir = tempfile.mkdtemp(prefix='fill-', dir=self.rootdir)
+
+        try:
+            files = codec.decompress_file(src, tmpdir)
+            abort_if(len(files) != 1, 'Expected one image in %s, found %d' \
+                % (src, len(files)))
+
+            os.replace(files[0], self._img_path(key))
+        finally:
+            rmtree(tmpdir)
+
+    def _evict(self, index):
+        """ @brief Removes the least recently used unreferenced images till
+        the cache fits in max_size
+        @return None """
+
+        entries = index['entries']
+
+        for entry in entries.values():
+            entry['refs'] = {pid: cnt for pid, cnt in entry['refs'].items() \
+                                if pid_alive(int(pid))}
+
+        total = sum(entry['disk'] for entry in entries.values())
+        lru = sorted(entries, key=lambda key: entries[key]['used'])
+
+        for key in lru:
+            if total <= self.max_size:
+                break
+
+            if len(entries[key]['refs']) > 0:
+                continue
+
+            for fpath in [self._img_path(key), 
+                    path.join(self.rootdir, key + '.lock')]:
+                try:
+                    os.remove(fpath)
+                except FileNotFoundError:
+                    pass
+
+            total -= entries[key]['disk']
+            del entries[key]
+            index['evictions'] += 1
+
+            if self.verbose:
+                printv('Evicted %s from the image cache' % key)
+
+    def _ref(self, entry, delta):
+        pid = str(os.getpid())
+        entry['refs'][pid] = entry['refs'].get(pid, 0) + delta
+
+        if entry['refs'][pid] <= 0:
+            del entry['refs'][pid]
+
+    def get(self, src, dest):
+        """ @brief Decompresses a compressed image to dest, the image is only
+        decompressed if it is not in the cache yet
+
+        @param src Path to the compressed image, should contain one file
+        @param dest Path to the decompressed image, truncated if it exists
+        @return None """
+
+        key = self._key(src)
+        img_f = self._img_path(key)
+
+        filled = False
+
+        # Retried if another process evicts the image right after this one
+        # decompressed it
+        while True:
+            with self._index() as index:
+                if path.isfile(img_f):
+                    stat = os.stat(img_f)
+
+                    entry = index['entries'].setdefault(key, {'refs': {}})
+                    entry.update({
+                        'size':     stat.st_size,
+                        'disk':     stat.st_blocks*512,
+                        'used':     time.time(),
+                    })
+                    self._ref(entry, 1)
+
+                    if filled:
+                        index['misses'] += 1
+                        self._evict(index)
+                    else:
+                        index['hits'] += 1
+                        index['bytes_saved'] += stat.st_size
+
+                    break
+
+            with self._entry_lock(key):
+                # Another process may have filled it while this one waited
+                if not path.isfile(img_f):
+                    self._fill(src, key)
+                    filled = True
+
+        try:
+            copypreserve(img_f, dest)
+        finally:
+            with self._index() as index:
+                entry = index['entries'].get(key, None)
+                if entry != None:
+                    self._ref(entry, -1)
+
+        if self.verbose:
+            printv('Image %s -> %s (%s)' % (src, dest,
+                'decompressed' if filled else 'cached'))
+
+    def stats(self, reset=False):
+        """ @brief Returns the counters of the cache across all processes
+
+        @param reset Resets the counters after reading them
+        @return dict with hits, misses, bytes_saved (bytes not decompressed
+                again), evictions, images and disk (bytes used) """
+
+        with self._index() as index:
+            result = {counter: index[counter] for counter in self.COUNTERS}
+            result['images'] = len(index['entries'])
+            result['disk'] = sum(entry['disk'] \
+                                for entry in index['entries'].values())
+
+            if reset:
+                for counter in self.COUNTERS:
+                    index[counter] = 0
+
+        return result
+
+def decompress(cache, src, dest, verbose):
+    """ @brief Decompresses src to dest using the cache, if any
+
+    @param cache ImageCache or None to always decompress src
+    @param src Path to the compressed image
+    @param dest Path to the decompressed image, should have the name of the
+           file in src if cache is None
+    @return None """
+
+    if cache == None:
+        _decompress(src, dest, verbose)
+    else:
+        cache.get(src, dest)
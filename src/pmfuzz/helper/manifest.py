@@ -0,0 +1,165 @@
+"""
+@file       manifest.py
+@details    Cached listing of the dedup directories
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+A DirManifest holds the set of file names in a directory and the subsets of
+it selected by name_handler's classifiers (e.g., nh.is_tc). The directory is
+only listed again if its mtime changes, files added or removed by PMFuzz
+itself are recorded in place using add()/discard().
+
+The mtime has a coarse granularity on some file systems, a file created in
+the same tick as the last listing does not change it. A listing taken within
+RACY_WINDOW of the directory's mtime is not trusted and the directory is
+listed once more after RACY_WINDOW has passed.
+
+add()/discard() record the mtime left by this process' own change if it is
+recent, so copying files into the directory does not list it again. A change
+made by another process around the same time is hidden by this, the
+directory is listed once more after RACY_WINDOW to find it.
+"""
+
+import os
+import time
+
+# Listings taken less than RACY_WINDOW seconds after the directory's mtime
+# are verified later, same as helper.hashcache
+RACY_WINDOW = 2 # sec
+
+class DirManifest:
+    """ @class Set of files in a directory with classified views """
+
+    # Manifests shared by every object working on the same directory
+    _manifests = {}
+
+    def __init__(self, dirpath):
+        self.dirpath    = dirpath
+        self.generation = 0     # Incremented on every change to the names
+
+        self._names     = set()
+        self._views     = {}    # classifier -> set of names
+        self._mtime     = None
+        self._racy      = False # Names need to be verified after the window
+
+    @classmethod
+    def get(cls, dirpath):
+        """ @brief Returns the manifest for a directory, the manifest is
+        created on the first call and shared for the lifetime of the process
+
+        @param dirpath Path to the directory
+        @return DirManifest """
+
+        dirpath = os.path.realpath(dirpath)
+
+        if dirpath not in cls._manifests:
+            cls._manifests[dirpath] = DirManifest(dirpath)
+
+        return cls._manifests[dirpath]
+
+    def _refresh(self):
+        """ @brief Lists the directory again if it was modified or if the
+        last listing was racy and RACY_WINDOW has passed since """
+
+        mtime = os.stat(self.dirpath).st_mtime_ns
+        recent = time.time_ns() - mtime < RACY_WINDOW*10**9
+
+        if mtime == self._mtime and (not self._racy or recent):
+            return
+
+        names = set(os.listdir(self.dirpath))
+        self._mtime = mtime
+        self._racy = recent
+
+        if names != self._names:
+            self._names = names
+            self._views = {}
+            self.generation += 1
+
+    @property
+    def names(self):
+        """ @brief Set of file names in the directory, should not be modified
+        @return set of str """
+
+        self._refresh()
+        return self._names
+
+    def view(self, classifier):
+        """ @brief Set of file names in the directory for which classifier
+        returns True, should not be modified
+
+        @param classifier Function that maps a file name to a bool, e.g.,
+               nh.is_cmpr_crash_site
+        @return set of str """
+
+        self._refresh()
+
+        if classifier not in self._views:
+            self._views[classifier] \
+                = set(name for name in self._names if classifier(name))
+
+        return self._views[classifier]
+
+    def paths(self, classifier):
+        """ @brief Sorted complete paths of the files selected by classifier
+        @return list of str """
+
+        return [os.path.join(self.dirpath, name) \
+                    for name in sorted(self.view(classifier))]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def _record_mtime(self):
+        """ @brief Takes the directory's mtime after a change made by this
+        process, an mtime older than RACY_WINDOW cannot come from that change
+        and is left for the next access to list the directory """
+
+        mtime = os.stat(self.dirpath).st_mtime_ns
+
+        if mtime != self._mtime \
+                and time.time_ns() - mtime < RACY_WINDOW*10**9:
+            self._mtime = mtime
+            self._racy = True
+
+    def add(self, name):
+        """ @brief Records a file created in the directory by this process,
+        should be called after creating the file
+
+        @param name Name of the file
+        @return None """
+
+        # Never listed, the next access lists the directory anyway
+        if self._mtime == None:
+            return
+
+        self._record_mtime()
+
+        self._names.add(name)
+        for classifier, view in self._views.items():
+            if classifier(name):
+                view.add(name)
+
+        self.generation += 1
+
+    def discard(self, name):
+        """ @brief Records a file removed from the directory by this process,
+        should be called after removing the file
+
+        @param name Name of the file
+        @return None """
+
+        if self._mtime == None:
+            return
+
+        self._record_mtime()
+
+        self._names.discard(name)
+        for view in self._views.values():
+            view.discard(name)
+
+        self.generation += 1
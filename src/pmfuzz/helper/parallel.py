@@ -4,10 +4,23 @@
 import os
 import sys
 import tempfile
+import time
 import traceback
 
 from helper.common import *
+from multiprocessing import Pipe
 from multiprocessing import Process
+from multiprocessing import connection
+
+# Set in the processes started by Parallel and WorkerPool
+_in_worker = False
+
+def in_worker():
+    """ @brief Checks if this process was started by Parallel or WorkerPool,
+    for callers that should not start more processes from a worker
+    @return bool """
+
+    return _in_worker
 
 class Parallel:
     """ @class Runs a function in parallel """
@@ -16,8 +29,13 @@ class Parallel:
     FAILURE_EXIT = 0
     FAILURE_CONT = 1
 
+    # Flags for waiting on children
+    WAIT_SPIN  = 0
+    WAIT_EVENT = 1
+
     def __init__(self, func, cores, transparent_io=False, 
-            failure_mode=FAILURE_CONT, name='', verbose=False):
+            failure_mode=FAILURE_CONT, name='', verbose=False, 
+            wait_mode=WAIT_EVENT):
         """ @brief Initialize parallel object
         
         @param func Function to execute
@@ -28,7 +46,11 @@ def __init__(self, func, cores, transparent_io=False,
                processes run fails, possible options:\n 
                *FAILURE_EXIT*: Exit on failure (exit code != 0)\n 
                *FAILURE_CONT*: Ignore failure and continue execution
-        @param verbose Enable verbose mode """
+        @param verbose Enable verbose mode
+        @param wait_mode Specifies how the scheduler waits for a child to 
+               complete, possible options:\n
+               *WAIT_EVENT*: Block on the child process sentinels\n
+               *WAIT_SPIN*: Poll the children in a busy loop """
 
         abort_if(cores < 1, 'Core count should be a non-zero positive integer')
 
@@ -40,6 +62,12 @@ def __init__(self, func, cores, transparent_io=False,
         self.name = name
         self.failure_mode = failure_mode
         self.verbose = verbose
+        self.wait_mode = wait_mode
+
+        # Time (sec) the scheduler spent blocked without using the CPU, and 
+        # the total time it spent waiting for the children
+        self.idle_time = 0.0
+        self.wait_time = 0.0
 
     def alive_cnt(self):
         """@brief Returns the total number of processes alive 
@@ -81,6 +109,9 @@ def _wrapper(self, *args, **kwargs):
         @param **kwargs
         @return None"""
 
+        global _in_worker
+        _in_worker = True
+
         pid = os.getpid()
 
         # Create a temporary file
@@ -127,6 +158,32 @@ def _wrapper(self, *args, **kwargs):
         if self.verbose:
             printv('%s: Completed execution' % self.name)
 
+    def _block(self):
+        """ @brief Blocks until atleast one of the children exits 
+        @return None """
+
+        sentinels = [process.sentinel for process in self.pobjs]
+
+        start = time.time()
+        connection.wait(sentinels)
+        self.idle_time += time.time() - start
+
+    def _wait_for(self, cond):
+        """ @brief Waits for the children while cond() is true
+        @param cond Function returning a bool value
+        @return None """
+
+        start = time.time()
+
+        if self.wait_mode == Parallel.WAIT_EVENT:
+            while cond():
+                self._block()
+        else:
+            while cond():
+                pass
+
+        self.wait_time += time.time() - start
+
     def run(self, params):
         """ @brief Runs a single instance of the function with the suplied 
         parameters
@@ -134,8 +191,7 @@ def run(self, params):
         @return None """
 
         # If processes are already at capacity, wait
-        while (self.alive_cnt() == self.cores):
-            pass
+        self._wait_for(lambda: self.alive_cnt() >= self.cores)
 
         proc = Process(target=self._wrapper, args=params)
         proc.start()
@@ -155,7 +211,351 @@ def alive(self):
 
         return result
     
+    @property
+    def sched_stats(self):
+        """ @brief Time the scheduler spent waiting for the children
+        @return dict with the idle (blocked) and the total waiting time in 
+                seconds """
+
+        return {'idle': self.idle_time, 'waiting': self.wait_time}
+    
     def wait(self):
         """ @brief Wait for all jobs to complete """
-        while self.alive:
-            pass
\ No newline at end of file
+
+        if self.wait_mode == Parallel.WAIT_EVENT:
+            self._wait_for(lambda: self.alive_cnt() > 0)
+        else:
+            self._wait_for(lambda: self.alive)
+
+        if self.verbose:
+            printv('%s: Scheduler idle for %.3fs of %.3fs waiting' \
+                % (self.name, self.idle_time, self.wait_time))
+
+class WorkerPool:
+    """ @class Runs a function on a set of long lived worker processes 
+
+    Unlike Parallel, the workers are forked once and reused for all the jobs,
+    jobs are sent to the workers in chunks and the return value of each job 
+    is sent back to the parent over a pipe.
+
+    #### Usage
+
+    \\code{python}
+        with WorkerPool(sha256sum, 4, chunksize=16) as pool:
+            for args, digest in pool.imap_unordered([[f] for f in files]):
+                ...
+    \\endcode
+    """
+
+    def __init__(self, func, cores, chunksize=1, capture_io=False,
+            failure_mode=Parallel.FAILURE_CONT, name='', verbose=False):
+        """ @brief Initialize the worker pool, workers are started on the 
+        first call to map() or imap_unordered()
+
+        @param func Function to execute
+        @param cores Number of worker processes to use
+        @param chunksize Number of jobs sent to a worker at a time
+        @param capture_io Boolean indicating if the output of every job should
+               be redirected to a log file instead of stdout and stderr
+        @param failure_mode Specifies behaviour of the pool if a job fails, 
+               possible options:\\n
+               *FAILURE_EXIT*: Exit on failure\\n
+               *FAILURE_CONT*: Ignore failure, the job returns None
+        @param verbose Enable verbose mode """
+
+        abort_if(cores < 1, 'Core count should be a non-zero positive integer')
+        abort_if(chunksize < 1, 'Chunk size should be a non-zero positive '\
+            + 'integer')
+
+        self.func = func
+        self.cores = cores
+        self.chunksize = chunksize
+        self.capture_io = capture_io
+        self.failure_mode = failure_mode
+        self.name = name
+        self.verbose = verbose
+
+        # Maps a worker process to the parent's end of its pipe
+        self.workers = {}
+
+    def _run_job(self, args):
+        """ @brief Runs a single job in the worker, optionally capturing its 
+        output to a log file
+        @param args List of arguments for the function
+        @return Return value of the function """
+
+        if not self.capture_io:
+            return self.func(*args)
+
+        fd, fname = tempfile.mkstemp(
+            prefix='pmfuzz-worker-%d.out.' % os.getpid())
+
+        if self.verbose:
+            printi('%s: Writing output to %s args = %s' \
+                % (self.name, fname, str(args)))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        stdout_bak = sys.stdout
+        stderr_bak = sys.stderr
+
+        with open(fd, 'w') as f:
+            sys.stdout = f
+            sys.stderr = f
+
+            try:
+                return self.func(*args)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                sys.stdout = stdout_bak
+                sys.stderr = stderr_bak
+
+    def _worker(self, conn):
+        """ @brief Main loop of a worker, receives chunks of (index, args) and
+        sends back a list of (index, success, result) for every chunk 
+        @param conn Worker's end of the pipe
+        @return None """
+
+        global _in_worker
+        _in_worker = True
+
+        while True:
+            try:
+                chunk = conn.recv()
+            except EOFError:
+                break
+
+            # Parent is done with this worker
+            if chunk == None:
+                break
+
+            results = []
+            for idx, args in chunk:
+                try:
+                    results.append((idx, True, self._run_job(args)))
+                except Exception as e:
+                    results.append((idx, False, traceback.format_exc()))
+
+            conn.send(results)
+
+        conn.close()
+
+    def _start_worker(self):
+        """ @brief Forks a new worker 
+        @return Process object for the worker """
+
+        parent_conn, child_conn = Pipe()
+
+        proc = Process(target=self._worker, args=(child_conn,))
+        proc.start()
+        child_conn.close()
+
+        self.workers[proc] = parent_conn
+
+        return proc
+
+    def start(self):
+        """ @brief Starts all the workers that are not running 
+        @return None """
+
+        while len(self.workers) < self.cores:
+            self._start_worker()
+
+    def close(self):
+        """ @brief Stops all the workers after their current chunk
+        @return None """
+
+        for proc, conn in self.workers.items():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        
+        for proc, conn in self.workers.items():
+            proc.join()
+            conn.close()
+            proc.close()
+
+        self.workers = {}
+
+    def _failed(self, idx, reason):
+        """ @brief Handles a failed job according to the failure mode 
+        @return None """
+
+        msg = '%s: Job %d failed: %s' % (self.name, idx, reason)
+
+        if self.failure_mode == Parallel.FAILURE_EXIT:
+            abort(msg)
+        else:
+            printw(msg)
+
+    def _replace_worker(self, proc):
+        """ @brief Replaces a worker that exited or can no longer be reached
+        @return None """
+
+        if proc.is_alive():
+            proc.kill()
+        proc.join()
+
+        self.workers[proc].close()
+        del self.workers[proc]
+        proc.close()
+        self._start_worker()
+
+    def _drain(self, busy):
+        """ @brief Waits for the busy workers to finish their chunks and 
+        discards the results
+        @param busy Dict of worker to the chunk it is running
+        @return None """
+
+        while busy:
+            conns = {self.workers[proc]: proc for proc in busy}
+            sentinels = {proc.sentinel: proc for proc in busy}
+
+            for ready in connection.wait(list(conns) + list(sentinels)):
+                if ready in conns:
+                    proc = conns[ready]
+                    if proc not in busy:
+                        continue
+
+                    try:
+                        ready.recv()
+                    except EOFError:
+                        # Worker died, handled through the sentinel
+                        continue
+
+                    del busy[proc]
+
+                elif sentinels[ready] in busy:
+                    proc = sentinels[ready]
+                    del busy[proc]
+                    self._replace_worker(proc)
+
+    def _imap(self, jobs):
+        """ @brief Runs the function on every job and yields the results as 
+        the jobs complete.
+
+        @param jobs List of list of arguments to call the function with
+        @return Generator of tuple (index of the job, result) """
+
+        self.start()
+
+        indexed = list(enumerate(jobs))
+        chunks = [indexed[i:i+self.chunksize] \
+                    for i in range(0, len(indexed), self.chunksize)]
+        chunks.reverse()
+
+        # Chunk held by each busy worker
+        busy = {}
+
+        try:
+            while chunks or busy:
+                # Hand out a chunk to every idle worker
+                for proc in list(self.workers):
+                    if proc in busy or not chunks:
+                        continue
+
+                    # Died while idle, e.g., killed by the OOM killer
+                    if not proc.is_alive():
+                        self._replace_worker(proc)
+                        continue
+
+                    chunk = chunks.pop()
+                    try:
+                        self.workers[proc].send(chunk)
+                    except (BrokenPipeError, OSError):
+                        # Died after the check, the chunk goes to another 
+                        # worker
+                        chunks.append(chunk)
+                        self._replace_worker(proc)
+                        continue
+
+                    busy[proc] = chunk
+
+                # Every idle worker was replaced, hand out to the new ones
+                if not busy:
+                    continue
+
+                conns = {self.workers[proc]: proc for proc in busy}
+                sentinels = {proc.sentinel: proc for proc in busy}
+
+                for ready in connection.wait(list(conns) + list(sentinels)):
+                    if ready in conns:
+                        proc = conns[ready]
+
+                        # Worker already replaced through its sentinel
+                        if proc not in busy:
+                            continue
+
+                        try:
+                            results = ready.recv()
+                        except EOFError:
+                            # Worker died, handled through the sentinel
+                            continue
+                    
+                        del busy[proc]
+
+                        for idx, success, result in results:
+                            if not success:
+                                self._failed(idx, result)
+                                result = None
+
+                            yield idx, result
+
+                    elif sentinels[ready] in busy:
+                        # Worker exited without returning the results
+                        proc = sentinels[ready]
+                        chunk = busy.pop(proc)
+                        pid, hr_code = proc.pid, \
+                            translate_exit_code(proc.exitcode)
+
+                        # Replace the dead worker
+                        self._replace_worker(proc)
+
+                        for idx, _ in chunk:
+                            self._failed(idx, 'Worker with PID %d exited: %s' \
+                                % (pid, hr_code[0]))
+                            yield idx, None
+        finally:
+            # Generator abandoned by the caller, results of the chunks still
+            # in flight must not reach the next call
+            self._drain(busy)
+
+    def imap_unordered(self, iterable):
+        """ @brief Runs the function on every element of iterable and yields 
+        the results as the jobs complete.
+
+        @param iterable Iterable of list of arguments to call the function 
+               with
+        @return Generator of tuple (args, result), result is None for failed
+                jobs """
+
+        jobs = list(iterable)
+
+        for idx, result in self._imap(jobs):
+            yield jobs[idx], result
+
+    def map(self, iterable):
+        """ @brief Runs the function on every element of iterable 
+
+        @param iterable Iterable of list of arguments to call the function 
+               with
+        @return List of results in the order of iterable, result is None for
+                failed jobs """
+
+        jobs = list(iterable)
+        results = [None]*len(jobs)
+
+        for idx, result in self._imap(jobs):
+            results[idx] = result
+
+        return results
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -7,11 +7,52 @@
 """
 from datetime import timedelta
 from os import path
+import ast
+import atexit
+import heapq
+import json
+import os
 import time
 
 from helper.prettyprint import *
 from helper import common
 
+def parse_ptimer(content):
+    """ @brief Parses the contents of a .ptimer file without executing it
+
+    @param content str written by PTimer, e.g., "{'start': 0, 'length': 0}"
+    @return dict with the keys 'start' and 'length'
+
+    >>> parse_ptimer("{'start': 1600000000.5, 'length': 60}")
+    {'start': 1600000000.5, 'length': 60}
+    """
+
+    state = ast.literal_eval(content.strip())
+
+    common.abort_if(not isinstance(state, dict) \
+        or set(state.keys()) != {'start', 'length'}, 
+        'Invalid timer state: ' + repr(content))
+
+    return state
+
+def fmt_elapsed(start):
+    """ @brief Human readable time elapsed since start
+    @return str """
+
+    time_elapsed = int(time.time() - start)
+    return "{:0>8}".format(str(timedelta(seconds=time_elapsed)))
+
+def fmt_progress_bar(start, length, width=20):
+    """ @brief Progress bar for the fraction of length elapsed since start
+    @return str """
+
+    time_elapsed = int(time.time() - start)
+    ratio_done = time_elapsed/float(length)
+    if ratio_done > 1:
+        ratio_done = 1
+
+    return ('▉'*int(ratio_done*width)).ljust(width, '░')
+
 class PTimer:
     """ @brief Persitent timer for preserving timer across invocations 
 
@@ -37,7 +78,10 @@ def __init__(self, timer_dir:str, name_prefix:str='', verbose:bool=False):
         self.name_prefix    = name_prefix
 
         self.read()
-        self._sync()
+
+        # Create the file for a new timer
+        if not path.isfile(self.timer_path):
+            self._sync()
 
     def read(self):
         """ @brief Read the state from disk, no changes to self.state if not 
@@ -45,8 +89,7 @@ def read(self):
 
         if path.isfile(self.timer_path):
             with open(self.timer_path, 'r') as fobj:
-                #! Warn: Executes arbitrary code from the file
-                self.state = eval(fobj.read())
+                self.state = parse_ptimer(fobj.read())
 
     def _sync(self):
         """ @brief Writes the state to disk """
@@ -81,6 +124,17 @@ def expired(self):
 
         return  time_elapsed > self.state['length']
     
+    def deadline(self):
+        """ @brief Time at which the countdown completes
+        
+        @return Deadline as returned by time.time(), None if the timer was 
+                never started """
+
+        if self.is_new():
+            return None
+
+        return self.state['start'] + self.state['length']
+    
     def clear(self) -> None:
         """ @brief Clears the persistent state 
 
@@ -103,19 +157,14 @@ def elapsed_hr(self):
         """ @brief Converts elapsed time to a human readable string 
         @return Human readable string representation of the elapsed time """
         
-        time_elapsed = int(time.time() - self.state['start'])
-        return "{:0>8}".format(str(timedelta(seconds=time_elapsed)))
+        return fmt_elapsed(self.state['start'])
 
     def elapsed_pb(self, width=20):
         """ @brief Converts elapsed time to a progress bar 
         @return Human readable string representation of the elapsed time """
         
-        time_elapsed = int(time.time() - self.state['start'])
-        ratio_done = time_elapsed/float(self.state['length'])
-        if ratio_done > 1:
-            ratio_done = 1
-
-        return ('▉'*int(ratio_done*width)).ljust(width, '░')
+        return fmt_progress_bar(self.state['start'], self.state['length'], 
+            width)
 
     def is_new(self):
         """ Checks if the timer hasn't been run yet. This could be a completely 
@@ -153,4 +202,339 @@ def name_prefix(self):
     
     @name_prefix.setter
     def name_prefix(self, value):
-        self._name_prefix = value
\ No newline at end of file
+        self._name_prefix = value
+
+class TimerStore:
+    """ @brief Persistent store for all the timers of a directory, e.g., the 
+    timers of the testcases and crash sites of a stage 2 iteration
+
+    All the timers are kept in memory and saved to a single JSON file in the
+    directory by flush(). Changes only mark the store dirty, so a scheduling
+    pass that starts many timers writes the file once; stores returned by
+    get() are also flushed when the process exits. Running timers are also
+    kept in a min-heap of deadlines for each tag, so finding the timers that
+    expired costs O(expired log n) instead of reading every timer. Timers 
+    left in .ptimer files by older versions of PMFuzz are imported on first
+    use.
+
+    #### Usage
+
+    \code{python}
+        timers = TimerStore.get(dirpath)
+        timers.timer('id=000001').start_new(60)
+        ...
+        for name in timers.pop_expired():
+            print(name + ' completed')
+    \endcode
+    """
+
+    # Filename of the store in the directory
+    STORE_FNAME = '@timers.json'
+
+    # Stores shared by every object working on the same directory
+    _stores = {}
+
+    def __init__(self, store_dir:str, verbose:bool=False):
+        common.abort_if(not path.isdir(store_dir), 
+                        '%s is not a directory.' % store_dir)
+
+        self.store_dir  = store_dir
+        self.store_path = path.join(store_dir, TimerStore.STORE_FNAME)
+        self.verbose    = verbose
+
+        self._timers    = {}    # name -> {'start', 'length', 'tag'}
+        self._heaps     = {}    # tag -> heap of (deadline, name)
+        self._running   = {}    # tag -> set of names
+        self._dirty     = False # Changed since the last save()
+
+        self._load()
+
+    @classmethod
+    def get(cls, store_dir:str, verbose:bool=False):
+        """ @brief Returns the store for a directory, the store is created on
+        the first call and shared for the lifetime of the process
+
+        @param store_dir Directory to keep the timers in
+        @return TimerStore """
+
+        key = path.realpath(store_dir)
+
+        if key not in cls._stores:
+            if len(cls._stores) == 0:
+                atexit.register(cls.flush_all)
+
+            cls._stores[key] = TimerStore(store_dir, verbose)
+
+        return cls._stores[key]
+
+    def _load(self):
+        if path.isfile(self.store_path):
+            with open(self.store_path, 'r') as obj:
+                try:
+                    self._timers = json.load(obj)['timers']
+                except (ValueError, KeyError) as e:
+                    common.abort('Unable to read timers from %s: %s' \
+                        % (self.store_path, str(e)))
+        else:
+            self._migrate()
+
+        for name, state in self._timers.items():
+            if state['start'] != 0:
+                self._push(name)
+
+    def _migrate(self):
+        """ @brief Imports the timers saved in .ptimer files """
+
+        ptimer_files = [path.join(self.store_dir, fname) \
+                            for fname in os.listdir(self.store_dir) \
+                                if fname.endswith(PTimer.TIMER_FNAME)]
+        
+        for ptimer_f in ptimer_files:
+            name = path.basename(ptimer_f)[:-len(PTimer.TIMER_FNAME)]
+
+            with open(ptimer_f, 'r') as obj:
+                state = parse_ptimer(obj.read())
+
+            state['tag'] = None
+            self._timers[name] = state
+
+        if len(ptimer_files) > 0:
+            self.save()
+
+            for ptimer_f in ptimer_files:
+                os.remove(ptimer_f)
+
+            printi('Migrated %d timers to %s' \
+                % (len(ptimer_files), self.store_path))
+
+    def save(self):
+        """ @brief Atomically writes all the timers to the store file
+        @return None """
+
+        tmp_path = self.store_path + '.tmp'
+        with open(tmp_path, 'w') as obj:
+            json.dump({'version': 1, 'timers': self._timers}, obj)
+
+        os.replace(tmp_path, self.store_path)
+        self._dirty = False
+
+    def flush(self):
+        """ @brief Saves the timers if they changed since the last save
+        @return None """
+
+        if self._dirty:
+            self.save()
+
+    @classmethod
+    def flush_all(cls):
+        """ @brief Saves every store returned by get() that has changes
+        @return None """
+
+        for store in cls._stores.values():
+            store.flush()
+
+    def _push(self, name):
+        state = self._timers[name]
+        tag = state['tag']
+
+        if tag not in self._heaps:
+            self._heaps[tag] = []
+            self._running[tag] = set()
+
+        heapq.heappush(self._heaps[tag], 
+            (state['start'] + state['length'], name))
+        self._running[tag].add(name)
+
+    def _is_stale(self, tag, deadline, name):
+        """ @brief Checks if a heap entry belongs to a timer that was cleared
+        or restarted after the entry was pushed
+        @return bool """
+
+        state = self._timers.get(name, None)
+
+        return state == None or state['tag'] != tag or state['start'] == 0 \
+                or state['start'] + state['length'] != deadline
+
+    def _expire(self, tag, now):
+        """ @brief Moves timers of tag past their deadline out of the running
+        set
+        @return list of names """
+
+        result = []
+        heap = self._heaps.get(tag, [])
+
+        while len(heap) > 0 and heap[0][0] < now:
+            deadline, name = heapq.heappop(heap)
+
+            if self._is_stale(tag, deadline, name):
+                continue
+
+            self._running[tag].discard(name)
+            result.append(name)
+
+        return result
+
+    def timer(self, name:str):
+        """ @brief Returns the timer with a name, a new timer is not saved 
+        until it is started
+
+        @param name Name of the timer, e.g., the clean name of a testcase
+        @return StoredTimer """
+
+        return StoredTimer(self, name)
+
+    def state(self, name:str):
+        """ @brief Returns the state of a timer
+        @return dict with the keys 'start', 'length' and 'tag' """
+
+        return self._timers.get(name, {'start': 0, 'length': 0, 'tag': None})
+
+    def start_new(self, name:str, length, tag=None):
+        """ @brief Resets and starts a timer with a new countdown
+
+        @param name Name of the timer
+        @param length Timer countdown value in seconds
+        @param tag Group of the timer (e.g., 'tc' or 'cs') for running(), 
+               pop_expired() and next_deadline()
+        @return None """
+
+        self._timers[name] = {'start': time.time(), 'length': length, 
+                                'tag': tag}
+        self._push(name)
+        self._dirty = True
+
+    def set_length(self, name:str, length):
+        """ @brief Changes the countdown of a started timer without
+        restarting it, e.g., to extend or cut a run. A timer that expired
+        before is running again if the new deadline is in the future.
+
+        @param name Name of the timer
+        @param length New countdown value in seconds from the original start
+        @return None """
+
+        state = self._timers[name]
+        common.abort_if(state['start'] == 0, 'Timer %s not started' % name)
+
+        state['length'] = length
+        self._push(name)
+        self._dirty = True
+
+    def clear(self, name:str):
+        """ @brief Removes a timer, it is reported as new after this 
+        @return None """
+
+        state = self._timers.pop(name, None)
+        if state != None:
+            self._running.get(state['tag'], set()).discard(name)
+            self._dirty = True
+
+    def untagged(self):
+        """ @brief Returns the names of the timers without a tag, e.g., the
+        timers imported from .ptimer files
+        @return list of names """
+
+        return [name for name, state in self._timers.items() \
+                    if state['tag'] == None]
+
+    def set_tag(self, name:str, tag):
+        """ @brief Moves a timer to a different tag
+        @return None """
+
+        state = self._timers[name]
+        self._running.get(state['tag'], set()).discard(name)
+
+        state['tag'] = tag
+        if state['start'] != 0:
+            self._push(name)
+
+        self._dirty = True
+
+    def pop_expired(self, tag=None):
+        """ @brief Returns the timers of a tag that expired since the last 
+        call, every timer is returned only once per process, timers that 
+        expired before the store was loaded are returned on the first call
+
+        @param tag Group of the timers
+        @return list of names """
+
+        return self._expire(tag, time.time())
+
+    def running(self, tag=None):
+        """ @brief Returns the timers of a tag that are started and have not
+        expired yet, should not be modified
+        @return set of names """
+
+        now = time.time()
+        running = self._running.get(tag, set())
+
+        # Timers past their deadline that were not popped yet
+        heap = self._heaps.get(tag, [])
+        if len(heap) > 0 and heap[0][0] < now:
+            running = set(name for name in running \
+                            if self.state(name)['start'] \
+                                + self.state(name)['length'] >= now)
+
+        return running
+
+    def next_deadline(self, tags=None):
+        """ @brief Returns the earliest deadline of the running timers, 
+        timers that expired but were not popped yet count as well
+
+        @param tags List of tags to consider, all if None
+        @return Deadline as returned by time.time() or None if no timer is 
+                running """
+
+        result = None
+
+        for tag, heap in self._heaps.items():
+            if tags != None and tag not in tags:
+                continue
+
+            while len(heap) > 0 and self._is_stale(tag, *heap[0]):
+                heapq.heappop(heap)
+
+            if len(heap) > 0 and (result == None or heap[0][0] < result):
+                result = heap[0][0]
+
+        return result
+
+class StoredTimer:
+    """ @brief Handle to a timer in a TimerStore with the same interface as
+    PTimer """
+
+    def __init__(self, store:TimerStore, name:str):
+        self.store  = store
+        self.name   = name
+
+    @property
+    def state(self):
+        return self.store.state(self.name)
+
+    def start_new(self, length, tag=None) -> None:
+        """ @brief Resets and starts the timer with a new countdown 
+        @return None"""
+
+        self.store.start_new(self.name, length, tag)
+
+    def clear(self) -> None:
+        self.store.clear(self.name)
+
+    def is_new(self):
+        return self.state['start'] == 0
+
+    def expired(self):
+        state = self.state
+        return (time.time() - state['start']) > state['length']
+
+    def deadline(self):
+        if self.is_new():
+            return None
+
+        return self.state['start'] + self.state['length']
+
+    def elapsed_hr(self):
+        return fmt_elapsed(self.state['start'])
+
+    def elapsed_pb(self, width=20):
+        return fmt_progress_bar(self.state['start'], self.state['length'], 
+            width)
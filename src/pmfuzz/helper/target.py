@@ -7,6 +7,7 @@
 """
 import handlers.name_handler as nh
 
+from helper import codec
 from helper.common import abort
 from helper.common import abort_if
 from helper.common import compress
@@ -109,7 +110,7 @@ def gen_img(self, dest_dir, compress_img=True, img_path=None):
             dest = path.join(dest_dir, path.basename(img_path))
             dest = nh.get_metadata_files(dest)['pm_cmpr_pool']
 
-            compress(src, dest, verbose)
+            compress(src, dest, verbose, codec=codec.from_cfg(cfg))
             remove(src)
             
             if verbose:
@@ -5,8 +5,13 @@
 
 SPDX-license-identifier: BSD-3-Clause
 """
+import collections
 import os
+import selectors
+import signal
+import subprocess
 import tempfile
+import time
 
 from io import StringIO
 from itertools import chain
@@ -14,11 +19,188 @@
 
 from helper.common import *
 from handlers import name_handler as nh
+from helper.manifest import DirManifest
+
+# Parsed fuzzer_stats files of the most recently read AFL result directories,
+# afl_dir -> {stats file -> ((mtime_ns, size), parsed stats)}
+_stats_cache    = collections.OrderedDict()
+STATS_CACHE_SZ  = 8
+
+# Fields renamed by newer AFL versions, new name -> name used by PMFuzz's AFL
+_STATS_ALIASES  = {
+    'corpus_count':     'paths_total',
+    'saved_crashes':    'unique_crashes',
+    'saved_hangs':      'unique_hangs',
+}
 
 def get_fuzzer_stats(outdir):
     result = (chain.from_iterable(glob(x[0] + '/fuzzer_stats', recursive=True) for x in os.walk(outdir)))
     return result
 
+def parse_fuzzer_stats(content):
+    """ @brief Parses the contents of an AFL fuzzer_stats file, numeric values
+    are converted to int or float and the trailing '%' of percentages is 
+    dropped
+
+    @param content str with the contents of the file
+    @return dict of field -> value
+
+    >>> stats = parse_fuzzer_stats('execs_done   : 1200\\nstability    : 99.50%\\n'
+    ...     'command_line : afl-fuzz -i in -o out\\n')
+    >>> stats['execs_done'], stats['stability'], stats['command_line']
+    (1200, 99.5, 'afl-fuzz -i in -o out')
+    """
+
+    result = {}
+
+    for line in content.splitlines():
+        key, sep, value = line.partition(':')
+        if sep == '':
+            continue
+
+        key, value = key.strip(), value.strip()
+        key = _STATS_ALIASES.get(key, key)
+
+        num = value[:-1] if value.endswith('%') else value
+        try:
+            result[key] = int(num)
+        except ValueError:
+            try:
+                result[key] = float(num)
+            except ValueError:
+                result[key] = value
+
+    return result
+
+def _read_fuzzer_stats(cache, stats_f):
+    """ @brief Returns the parsed stats file, only reads the file if it 
+    changed since the last read
+    @return dict or None if the file does not exist """
+
+    try:
+        st = os.stat(stats_f)
+    except FileNotFoundError:
+        cache.pop(stats_f, None)
+        return None
+
+    key = (st.st_mtime_ns, st.st_size)
+    if stats_f in cache and cache[stats_f][0] == key:
+        return cache[stats_f][1]
+
+    try:
+        with open(stats_f, 'r') as obj:
+            stats = parse_fuzzer_stats(obj.read())
+    except FileNotFoundError:
+        return None
+
+    cache[stats_f] = (key, stats)
+    return stats
+
+def fuzzer_stats_files(afl_dir):
+    """ @brief Lists the fuzzer_stats files of all the AFL instances in a 
+    result directory, works for both stage 1 (<afl_dir>/<fuzzer>/fuzzer_stats)
+    and stage 2 (<afl_dir>/<testcase>/master_fuzzer/fuzzer_stats)
+
+    @param afl_dir AFL result directory of a stage (nh.AFL_DIR_NM)
+    @return list of str """
+
+    result = []
+
+    for name in sorted(DirManifest.get(afl_dir).names):
+        instance_d = os.path.join(afl_dir, name)
+
+        for stats_f in [os.path.join(instance_d, 'fuzzer_stats'),
+                os.path.join(instance_d, 'master_fuzzer', 'fuzzer_stats')]:
+            if os.path.isfile(stats_f):
+                result.append(stats_f)
+                break
+
+    return result
+
+def is_pid_alive(pid):
+    """ @brief Checks if a process exists, same as afl-whatsup's check, see
+    helper.common.pid_alive()
+    @return bool """
+
+    return pid_alive(pid)
+
+def get_stage_stats(afl_dir, now=None):
+    """ @brief Aggregates the fuzzer_stats of every AFL instance of a stage,
+    files are only parsed again if they changed since the last call
+
+    Execs/sec is computed as afl-whatsup does: execs_done over the runtime
+    of an instance, summed over the instances that are still running.
+
+    @param afl_dir AFL result directory of a stage (nh.AFL_DIR_NM)
+    @param now Current time for computing the runtime, time.time() if None
+    @return dict with keys 'instances', 'alive', 'execs_done', 
+            'execs_per_sec', 'paths_total', 'unique_crashes', 'unique_hangs'
+            and 'stability' (mean over the instances reporting it, None if
+            no instance reports it) """
+
+    if now == None:
+        now = time.time()
+
+    afl_dir = os.path.realpath(afl_dir)
+    if afl_dir not in _stats_cache:
+        _stats_cache[afl_dir] = {}
+        if len(_stats_cache) > STATS_CACHE_SZ:
+            _stats_cache.popitem(last=False)
+    _stats_cache.move_to_end(afl_dir)
+
+    cache = _stats_cache[afl_dir]
+
+    result = {
+        'instances':        0,
+        'alive':            0,
+        'execs_done':       0,
+        'execs_per_sec':    0.0,
+        'paths_total':      0,
+        'unique_crashes':   0,
+        'unique_hangs':     0,
+        'stability':        None,
+    }
+
+    stability = []
+    for stats_f in fuzzer_stats_files(afl_dir):
+        stats = _read_fuzzer_stats(cache, stats_f)
+        if stats == None:
+            continue
+
+        result['instances'] += 1
+        for key in ['execs_done', 'paths_total', 'unique_crashes', 
+                'unique_hangs']:
+            result[key] += stats.get(key, 0)
+
+        if 'stability' in stats:
+            stability.append(stats['stability'])
+
+        if is_pid_alive(stats.get('fuzzer_pid', 0)):
+            result['alive'] += 1
+
+            runtime = now - stats.get('start_time', now)
+            if runtime > 0:
+                result['execs_per_sec'] += stats.get('execs_done', 0)/runtime
+
+    if len(stability) > 0:
+        result['stability'] = sum(stability)/len(stability)
+
+    return result
+
+def fmt_stage_stats(stats):
+    """ @brief Formats the result of get_stage_stats() for printing
+    @return str """
+
+    stability = 'n/a'
+    if stats['stability'] != None:
+        stability = '%.2f%%' % stats['stability']
+
+    return ('%d/%d fuzzers alive, %.0f execs/sec, %d execs, %d paths, '
+        '%d crashes, %d hangs, stability %s') % (stats['alive'], 
+        stats['instances'], stats['execs_per_sec'], stats['execs_done'],
+        stats['paths_total'], stats['unique_crashes'], stats['unique_hangs'],
+        stability)
+
 def gen_afl_cmd(indir:str, outdir:str, cfg:dict, tgtcmd:list, slave:bool=False, 
                 coreid:int=0, persist_tgt:bool=False, verbose:bool=False):
     """ @brief Generates an AFL command using configuration and parameters 
@@ -149,9 +331,228 @@ def gen_tgt_img(tgtcmd:list, cfg, verbose:bool=False):
     stdin.close()
     os.close(fd)
 
+class AFLSupervisor:
+    """ @class Tracks the AFL instances launched by this process
+
+    Every instance is keyed by its fuzzer directory (<outdir>/<fuzzer name>)
+    and kept as a Popen object and, if the kernel supports it, a pidfd. The
+    pidfds are registered with a selector so reap() only touches the instances
+    that exited, and signals sent through a pidfd cannot reach a recycled pid.
+    Instances belong to a group (e.g., Stage2.TIMER_TC), the number of running
+    instances of a group and the instances that exited without being stopped
+    are kept up to date by reap().
+
+    Instances started by an earlier PMFuzz process are not children of this
+    one and are not tracked, callers fall back to the pid file for them.
+    """
+
+    # Max time to wait for a new instance to write its fuzzer_stats
+    START_TIMEOUT   = 60    # sec
+    START_POLL      = 0.05  # sec
+
+    _supervisor = None
+
+    @classmethod
+    def get(cls):
+        """ @brief Returns the supervisor of this process, a forked child gets
+        a new one since it cannot wait for its parent's children
+        @return AFLSupervisor """
+
+        if cls._supervisor == None or cls._supervisor._pid != os.getpid():
+            cls._supervisor = AFLSupervisor()
+
+        return cls._supervisor
+
+    def __init__(self):
+        self._pid       = os.getpid()
+        self.selector   = selectors.DefaultSelector()
+
+        # fuzzer dir -> {'popen', 'pidfd', 'group', 'stopped'}
+        self._procs     = {}
+        self._polled    = set()     # Running fuzzer dirs without a pidfd
+        self._running   = collections.defaultdict(set)  # group -> fuzzer dirs
+
+        # group -> {fuzzer dir -> exit code} of the instances that exited 
+        # without stop()
+        self._failed    = collections.defaultdict(dict)
+
+    @staticmethod
+    def _key(fuzzer_dir):
+        return os.path.abspath(fuzzer_dir)
+
+    def launch(self, fuzzer_dir, cmd, env, stdout, stderr, group=None):
+        """ @brief Starts an AFL instance and tracks it
+
+        @param fuzzer_dir Directory the instance writes to, i.e., the -o 
+               directory joined with the fuzzer name
+        @param cmd List of str with the afl-fuzz command
+        @param env Environment of the instance
+        @param stdout File handler for the instance's stdout
+        @param stderr File handler for the instance's stderr
+        @param group Group of the instance, used by running_count() and 
+               failures()
+        @return int with the pid of the instance """
+
+        key = self._key(fuzzer_dir)
+        self._forget(key)
+
+        popen = exec_shell(cmd=cmd, stdout=stdout, stderr=stderr, env=env,
+                    handle=True)
+
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(popen.pid)
+            except OSError:
+                pidfd = None
+
+        self._procs[key] = {'popen': popen, 'pidfd': pidfd, 'group': group,
+                            'stopped': False}
+        self._running[group].add(key)
+        self._failed[group].pop(key, None)
+
+        if pidfd != None:
+            self.selector.register(pidfd, selectors.EVENT_READ, key)
+        else:
+            self._polled.add(key)
+
+        return popen.pid
+
+    def _forget(self, key):
+        """ @brief Stops tracking an instance, it is not signalled """
+
+        proc = self._procs.pop(key, None)
+        if proc == None:
+            return
+
+        if proc['pidfd'] != None:
+            self.selector.unregister(proc['pidfd'])
+            os.close(proc['pidfd'])
+
+        self._polled.discard(key)
+        self._running[proc['group']].discard(key)
+
+    def _on_exit(self, key):
+        proc = self._procs[key]
+        exit_code = proc['popen'].wait()
+
+        self._forget(key)
+
+        if not proc['stopped']:
+            printw('AFL instance %s (pid %d) exited with code %d' \
+                % (key, proc['popen'].pid, exit_code))
+            self._failed[proc['group']][key] = exit_code
+
+        return not proc['stopped']
+
+    def reap(self):
+        """ @brief Collects the exit status of the instances that exited, 
+        does not block
+        @return list of fuzzer dirs that exited without being stopped """
+
+        exited = [key.data for key, _ in self.selector.select(0)]
+        exited += [key for key in self._polled \
+                    if self._procs[key]['popen'].poll() != None]
+
+        return [key for key in exited if self._on_exit(key)]
+
+    def wait_started(self, fuzzer_dir, timeout=START_TIMEOUT):
+        """ @brief Waits for an instance to write its fuzzer_stats, which AFL
+        does once it bound to a core and ran the initial inputs
+
+        @param fuzzer_dir Directory passed to launch()
+        @param timeout Max time to wait, an instance still running after the 
+               timeout is considered started
+        @return bool, False if the instance exited before writing its 
+                fuzzer_stats """
+
+        key = self._key(fuzzer_dir)
+        proc = self._procs.get(key, None)
+        if proc == None:
+            return not self.failed(key)
+
+        stats_f = os.path.join(key, 'fuzzer_stats')
+        deadline = time.time() + timeout
+
+        while not os.path.isfile(stats_f):
+            try:
+                proc['popen'].wait(timeout=self.START_POLL)
+            except subprocess.TimeoutExpired:
+                if time.time() > deadline:
+                    printw('%s did not write fuzzer_stats in %d seconds' \
+                        % (key, timeout))
+                    break
+                continue
+
+            self._on_exit(key)
+            return False
+
+        return True
+
+    def stop(self, fuzzer_dir, sig=signal.SIGTERM):
+        """ @brief Signals a tracked instance, its exit is reaped later and 
+        not reported as a failure
+
+        @param fuzzer_dir Directory passed to launch()
+        @param sig Signal to send
+        @return bool, False if the instance is not tracked by this process """
+
+        key = self._key(fuzzer_dir)
+        proc = self._procs.get(key, None)
+        if proc == None:
+            return False
+
+        proc['stopped'] = True
+        self._running[proc['group']].discard(key)
+
+        try:
+            if proc['pidfd'] != None:
+                signal.pidfd_send_signal(proc['pidfd'], sig)
+            else:
+                proc['popen'].send_signal(sig)
+        except ProcessLookupError:
+            # Exited but not reaped yet
+            pass
+
+        return True
+
+    def tracks(self, fuzzer_dir):
+        """ @brief Checks if an instance was launched by this process and has 
+        not been reaped yet
+        @return bool """
+
+        return self._key(fuzzer_dir) in self._procs
+
+    def failed(self, fuzzer_dir):
+        """ @brief Checks if an instance exited without being stopped
+        @return bool """
+
+        key = self._key(fuzzer_dir)
+        return any(key in failed for failed in self._failed.values())
+
+    def running_count(self, group=None):
+        """ @brief Number of instances of a group that are running and were 
+        not stopped, as of the last reap()
+        @return int """
+
+        return len(self._running[group])
+
+    def failures(self, group=None):
+        """ @brief Instances of a group that exited without being stopped, as
+        of the last reap(), should not be modified
+        @return dict of fuzzer dir -> exit code """
+
+        return self._failed[group]
+
 def run_afl(indir:str, outdir:str, tgtcmd:list, cfg:dict, cores:int=1, 
-            verbose:bool=False, persist_tgt=False, dry_run=False, gen_img=True):
-    """ @brief Run AFL """
+            verbose:bool=False, persist_tgt=False, dry_run=False, gen_img=True,
+            group=None):
+    """ @brief Run AFL, the instances are tracked by AFLSupervisor under 
+    group. Returns once every instance wrote its fuzzer_stats or exited, the
+    callers check AFLSupervisor.failures() for instances that did not start.
+    """
+
+    supervisor = AFLSupervisor.get()
 
     pids = []
     for coreid in range(cores):
@@ -198,19 +599,23 @@ def run_afl(indir:str, outdir:str, tgtcmd:list, cfg:dict, cores:int=1,
             printv('\tWriting testcases to:      ' + outdir)
 
         if not dry_run:
-            pid = exec_shell(cmd=cmd, stdout=tf, stderr=tf, env=env)
+            fuzzer_dir = os.path.join(outdir, fuzzer_name)
+
+            pid = supervisor.launch(fuzzer_dir, cmd, env, stdout=tf, 
+                        stderr=tf, group=group)
             pids.append(pid)
             printi('Writing output to: '+ tf.name + ' for core ' + str(coreid) + ' (' + fuzzer_name + '), pid = ' + str(pid))
             
-            # Wait 5 seconds between invocations to avoid multiple afl binding
-            # to a single core
-            if coreid != 0:
-                time.sleep(5)
-            else:
-                time.sleep(1)
-
-            # Write the PID to file 'pid'
-            pid_f = os.path.join(outdir, fuzzer_name, 'pid')
+            # Wait for the instance to start before the next one, avoids 
+            # multiple afl binding to a single core
+            if not supervisor.wait_started(fuzzer_dir):
+                printw('AFL failed to start for %s, output in %s' \
+                    % (fuzzer_dir, tf.name))
+                continue
+
+            # Write the PID to file 'pid', used for the instances left running
+            # by an earlier PMFuzz process
+            pid_f = os.path.join(fuzzer_dir, 'pid')
                 
             with open(pid_f, 'w') as fobj:
                 fobj.write(str(pid))
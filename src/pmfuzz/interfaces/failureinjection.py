@@ -6,17 +6,38 @@
 SPDX-license-identifier: BSD-3-Clause
 """
 import os
+import queue
+import select
+import signal
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+
+from glob import glob
+from os import path
 
 import handlers.name_handler as nh
 
 from helper.common import abort
 from helper.common import abort_if
+from helper.common import copypreserve
 from helper.common import exec_shell
 from helper.common import translate_exit_code
 from helper.prettyprint import printv
+from helper.prettyprint import printw
+
+# Control and status descriptors of the AFL runtime's fork server, 
+# FORKSRV_FD in AFL's config.h
+FORKSRV_FD      = 198
+
+FSRV_TIMEOUT    = 10    # sec, max time for the fork server to respond
+RUN_TIMEOUT     = 30    # sec, same as the runs of run_failure_inj()
+
+# FI_IMG_SUFFIX of the fork servers, the crash sites of a run are renamed to
+# the suffix run_failure_inj() would use once the run completes
+FSRV_SUFFIX     = 'fsrv'
 
 def get_failure_inj_env(cfg, create):
     env:dict = {}
@@ -43,10 +64,12 @@ def gen_failure_inj_cmd(cfg, tgtcmd, imgpath, create, verbose=False):
     return (env, cmd)
 
 def run_failure_inj(cfg, tgtcmd, imgpath, testcase_f, clean_name, 
-        create, verbose=False):
+        create, verbose=False, stats_f=None):
     """ @brief Run failure injection on an image 
     @param create If true, inject the failure to the process of creating the
                   image
+    @param stats_f If set, libpmfuzz appends the latency of every crash site
+                   dump to this file, see read_dump_stats()
     @return None"""
 
     if not create and not os.path.isfile(imgpath):
@@ -55,6 +78,9 @@ def run_failure_inj(cfg, tgtcmd, imgpath, testcase_f, clean_name,
     env, cmd = gen_failure_inj_cmd(cfg, cfg.tgtcmd, imgpath, create, verbose)
     env.update({"FI_IMG_SUFFIX": clean_name.replace('.testcase', '')})
 
+    if stats_f != None:
+        env.update({"FI_DUMP_STATS": stats_f})
+
     if verbose:
         printv('Failure Injection:')
         printv('%20s : %s' % ('env', str(env)))
@@ -82,4 +108,429 @@ def run_failure_inj(cfg, tgtcmd, imgpath, testcase_f, clean_name,
     descr_str, success = translate_exit_code(exit_code)
     if not success:
         abort('Failure injection for pid %d failed: %s' \
-            % (os.getpid(), descr_str))
\ No newline at end of file
+            % (os.getpid(), descr_str))
+
+def read_dump_stats(stats_f, exits=False):
+    """ @brief Reads the crash site dumps libpmfuzz appended to a 
+    FI_DUMP_STATS file
+
+    @param stats_f Path to the file
+    @param exits Return the lines libpmfuzz appends when a run exits instead
+           of the dumps, their failure_id is the number of failure points and
+           ns the time since pmfuzz_init()
+    @return List of dicts with the keys failure_id, method, bytes and ns """
+
+    result = []
+
+    with open(stats_f, 'r') as obj:
+        for line in obj:
+            fields = line.split()
+            if len(fields) != 4:
+                printw('Ignoring invalid line in %s: %s' \
+                    % (stats_f, line.strip()))
+                continue
+
+            if (fields[1] == 'exit') != exits:
+                continue
+
+            result.append({
+                'failure_id':   int(fields[0]),
+                'method':       fields[1],
+                'bytes':        int(fields[2]),
+                'ns':           int(fields[3]),
+            })
+
+    return result
+
+def batch_workers(cfg, cores):
+    """ @brief Number of fork servers to generate crash sites with, set using
+    pmfuzz.failure_injection.batch
+
+    @param cores Cores available to the caller
+    @return int, 0 if batched failure injection is disabled """
+
+    batch_cfg = cfg['pmfuzz']['failure_injection'].get('batch', 
+                    {'enable': False})
+
+    if not batch_cfg.get('enable', False):
+        return 0
+
+    workers = batch_cfg.get('workers', 0)
+    return max(1, cores if workers == 0 else min(workers, cores))
+
+def _crash_site_prefix(imgpath):
+    """ @brief Prefix libpmfuzz uses for the crash sites of an image, the
+    path up to the first .pm_pool or .crash_site """
+
+    result = imgpath
+    for ext in ['.' + nh.PM_IMG_EXT, '.' + nh.CRASH_SITE_EXT]:
+        idx = result.find(ext)
+        if idx != -1:
+            result = result[:idx]
+
+    return result
+
+def _move_fd(fd, target):
+    """ @brief dup2()s fd to target
+
+    @return Tuple (duplicate of the descriptor that was at target or None,
+            its inheritable flag) for _restore_fd() """
+
+    try:
+        saved = (os.dup(target), os.get_inheritable(target))
+    except OSError:
+        saved = (None, False)
+
+    os.dup2(fd, target)
+    return saved
+
+def _restore_fd(target, saved):
+    """ @brief Undoes _move_fd() """
+
+    saved_fd, inheritable = saved
+    if saved_fd == None:
+        os.close(target)
+    else:
+        os.dup2(saved_fd, target, inheritable)
+        os.close(saved_fd)
+
+class ForkServer:
+    """ @class Target started once and forked by the AFL runtime's fork
+    server for every run
+
+    The target reads the testcase from its stdin, a file rewritten before
+    every run. The forked children share the file offset with the fork 
+    server, so the offset is reset before every run, same as afl-fuzz. """
+
+    def __init__(self, cmd, env, input_f, out_obj):
+        """ @brief Create a fork server, see start()
+
+        @param cmd Target command
+        @param env Environment of the target
+        @param input_f Path to the file to pass the testcases in
+        @param out_obj File object for the target's stdout and stderr """
+
+        self.cmd        = cmd
+        self.env        = env
+        self.input_f    = input_f
+        self.out_obj    = out_obj
+
+        self.proc       = None
+        self.input_obj  = None
+        self.ctl_w      = None
+        self.st_r       = None
+
+    def start(self, timeout=FSRV_TIMEOUT):
+        """ @brief Starts the target and waits for the fork server. The pipes
+        are moved to FORKSRV_FD in this process till the target starts, so 
+        this should not be called while other threads are running.
+
+        @return bool, False if the target exited or did not start a fork 
+                server """
+
+        ctl_r, self.ctl_w = os.pipe()
+        self.st_r, st_w = os.pipe()
+
+        self.input_obj = open(self.input_f, 'w+b')
+
+        fsrv_fds = (FORKSRV_FD, FORKSRV_FD + 1)
+        saved = [_move_fd(ctl_r, fsrv_fds[0]), _move_fd(st_w, fsrv_fds[1])]
+
+        try:
+            # The target inherits only its stdio and the two pipes
+            self.proc = subprocess.Popen(self.cmd, env=self.env, 
+                stdin=self.input_obj, stdout=self.out_obj, 
+                stderr=subprocess.STDOUT, start_new_session=True, 
+                close_fds=True, pass_fds=fsrv_fds)
+        finally:
+            for fd, saved_fd in zip(fsrv_fds, saved):
+                _restore_fd(fd, saved_fd)
+
+            os.close(ctl_r)
+            os.close(st_w)
+
+        if self._read(timeout) == None:
+            self.stop()
+            return False
+
+        return True
+
+    def _read(self, timeout):
+        """ @brief Reads a 32 bit value from the status pipe
+        @return int or None on timeout or if the fork server exited """
+
+        ready, _, _ = select.select([self.st_r], [], [], timeout)
+        if len(ready) == 0:
+            return None
+
+        buf = os.read(self.st_r, 4)
+        if len(buf) != 4:
+            return None
+
+        return struct.unpack('i', buf)[0]
+
+    def run(self, testcase_f, timeout=RUN_TIMEOUT):
+        """ @brief Runs the target once on a testcase
+
+        @param testcase_f Path to the testcase
+        @return Exit code as returned by subprocess (negative for signals),
+                None if the run timed out
+        @throws OSError if the fork server is gone """
+
+        with open(testcase_f, 'rb') as obj:
+            data = obj.read()
+
+        self.input_obj.seek(0)
+        self.input_obj.truncate()
+        self.input_obj.write(data)
+        self.input_obj.flush()
+        os.lseek(self.input_obj.fileno(), 0, os.SEEK_SET)
+
+        os.write(self.ctl_w, struct.pack('I', 0))
+
+        pid = self._read(FSRV_TIMEOUT)
+        if pid == None or pid <= 0:
+            raise OSError('Fork server of %s is not responding' % self.cmd[0])
+
+        status = self._read(timeout)
+        if status == None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+            if self._read(FSRV_TIMEOUT) == None:
+                raise OSError('Fork server of %s did not reap %d' \
+                    % (self.cmd[0], pid))
+
+            return None
+
+        # Same as os.waitstatus_to_exitcode(), which needs python 3.9
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+
+        return os.WEXITSTATUS(status)
+
+    def stop(self):
+        """ @brief Kills the fork server and closes all the descriptors
+        @return None """
+
+        if self.proc != None and self.proc.poll() == None:
+            self.proc.kill()
+            self.proc.wait()
+
+        for fd in [self.ctl_w, self.st_r]:
+            if fd != None:
+                os.close(fd)
+
+        if self.input_obj != None:
+            self.input_obj.close()
+
+        self.ctl_w, self.st_r, self.input_obj = None, None, None
+
+class _BatchWorker:
+    """ @class Replays testcases on one image using a fork server, falls back
+    to run_failure_inj() if the target does not start a fork server """
+
+    def __init__(self, cfg, tgtcmd, parent_img, imgpath, create, verbose):
+        self.cfg        = cfg
+        self.tgtcmd     = tgtcmd
+        self.parent_img = parent_img
+        self.imgpath    = imgpath
+        self.create     = create
+        self.verbose    = verbose
+
+        self.prefix     = _crash_site_prefix(imgpath)
+        self.fsrv       = None
+
+        fd, self.input_f = tempfile.mkstemp(prefix='pmfuzz-fsrv-input-')
+        os.close(fd)
+        fd, self.out_f = tempfile.mkstemp(prefix='pmfuzz-fsrv-out-')
+        os.close(fd)
+
+    def _fsrv_files(self):
+        return glob(self.prefix + '.' + FSRV_SUFFIX + '.*')
+
+    def _reset_img(self):
+        """ @brief Restores the image and removes the crash sites left by a 
+        failed fork server start or a killed run """
+
+        if self.create:
+            if path.isfile(self.imgpath):
+                os.remove(self.imgpath)
+        else:
+            copypreserve(self.parent_img, self.imgpath)
+
+        for fpath in self._fsrv_files():
+            os.remove(fpath)
+
+    def start(self):
+        """ @brief Starts the fork server, should be called before any 
+        worker thread is started, see ForkServer.start()
+        @return bool, False if the target did not start a fork server """
+
+        env, cmd = gen_failure_inj_cmd(self.cfg, self.tgtcmd, self.imgpath, 
+                    self.create, self.verbose)
+        env.update({'FI_IMG_SUFFIX': FSRV_SUFFIX, 'AFL_NO_SNAPSHOT': '1'})
+
+        if self.verbose:
+            printv('Batched failure injection:')
+            printv('%20s : %s' % ('env', str(env)))
+            printv('%20s : %s' % ('cmd', ' '.join(cmd)))
+            printv('%20s : %s' % ('output', self.out_f))
+
+        self._reset_img()
+
+        self.out_obj = open(self.out_f, 'w')
+        self.fsrv = ForkServer(cmd, env, self.input_f, self.out_obj)
+
+        if not self.fsrv.start():
+            self.fsrv = None
+            return False
+
+        return True
+
+    def _run(self, testcase_f, clean_name):
+        self._reset_img()
+
+        if self.fsrv == None:
+            run_failure_inj(self.cfg, self.tgtcmd, self.imgpath, testcase_f,
+                clean_name, self.create, self.verbose)
+            return 0
+
+        exit_code = self.fsrv.run(testcase_f)
+
+        # Name the crash sites the way run_failure_inj() does
+        suffix = clean_name.replace('.testcase', '')
+        for fpath in self._fsrv_files():
+            os.replace(fpath, self.prefix + '.' + suffix \
+                + fpath[len(self.prefix) + len(FSRV_SUFFIX) + 1:])
+
+        return exit_code
+
+    def loop(self, jobs, results):
+        """ @brief Runs the testcases from jobs till it gets None, puts 
+        (testcase_f, clean_name, imgpath, exit code) to results for every run
+        and None once done, exceptions are put to results as is """
+
+        try:
+            while True:
+                job = jobs.get()
+                if job == None:
+                    break
+
+                testcase_f, clean_name = job
+                exit_code = self._run(testcase_f, clean_name)
+                results.put((testcase_f, clean_name, self.imgpath, exit_code))
+        except BaseException as e:
+            results.put(e)
+        finally:
+            self.stop()
+            results.put(None)
+
+    def stop(self):
+        if self.fsrv != None:
+            self.fsrv.stop()
+            self.fsrv = None
+
+        self.out_obj.close()
+
+        for fpath in self._fsrv_files():
+            os.remove(fpath)
+
+        if not self.create and path.isfile(self.imgpath):
+            os.remove(self.imgpath)
+
+        os.remove(self.input_f)
+        if not self.verbose:
+            os.remove(self.out_f)
+
+def run_failure_inj_batch(cfg, tgtcmd, parent_img, testcases, imgpaths, 
+        create=False, verbose=False):
+    """ @brief Runs failure injection on many testcases using one parent
+    image, with a fork server per image in imgpaths
+
+    Every worker restores its image from parent_img before every run, so the
+    crash sites of a testcase are the same as run_failure_inj() generates
+    using a copy of parent_img at the worker's image path. All the fork
+    servers are started before the worker threads. Targets that do not start
+    a fork server (i.e., not built with the AFL LLVM runtime) are run once 
+    per testcase using run_failure_inj() in the calling thread, exec_shell()
+    should not be used from threads.
+
+    @param parent_img Path to the uncompressed image to inject failures in,
+           ignored if create is set
+    @param testcases List of (path to testcase, clean name)
+    @param imgpaths List of image paths, one per worker, the crash sites 
+           are named after these images
+    @param create If true, inject the failure to the process of creating the
+                  image
+    @return Generator of (testcase path, clean name, image path) in the order
+            the runs complete, the worker threads are joined once it is 
+            exhausted. Callers should not fork (e.g., using Parallel) before
+            that. """
+
+    abort_if(len(imgpaths) == 0, 'Need at least one image path')
+    abort_if(not create and not path.isfile(parent_img), 
+        'Image path %s does not exist' % str(parent_img))
+
+    workers = [_BatchWorker(cfg, tgtcmd, parent_img, imgpath, create, 
+                verbose) for imgpath in imgpaths[:max(1, len(testcases))]]
+
+    # Start all the fork servers before any thread
+    started = [worker.start() for worker in workers]
+
+    if not all(started):
+        printw('%s did not start a fork server, running the testcases one '
+            'at a time' % tgtcmd[0])
+
+        for worker in workers[1:]:
+            worker.stop()
+
+        try:
+            for testcase_f, clean_name in testcases:
+                workers[0]._run(testcase_f, clean_name)
+                yield (testcase_f, clean_name, workers[0].imgpath)
+        finally:
+            workers[0].stop()
+
+        return
+
+    jobs = queue.Queue()
+    results = queue.Queue()
+
+    for job in testcases:
+        jobs.put(job)
+
+    threads = []
+    for worker in workers:
+        jobs.put(None)
+
+        thread = threading.Thread(target=worker.loop, args=(jobs, results), 
+                    daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    running = len(threads)
+    while running > 0:
+        result = results.get()
+
+        if result == None:
+            running -= 1
+            continue
+
+        if isinstance(result, BaseException):
+            abort('Batched failure injection failed: ' + str(result))
+            continue
+
+        testcase_f, clean_name, imgpath, exit_code = result
+
+        descr_str, success = translate_exit_code(exit_code)
+        if not success:
+            abort('Failure injection for %s failed: %s' \
+                % (testcase_f, descr_str))
+
+        yield (testcase_f, clean_name, imgpath)
+
+    for thread in threads:
+        thread.join()
@@ -15,7 +15,8 @@
 from os import path
 
 from handlers import name_handler as nh 
-from helper.common import abort, abort_if, exec_shell, decompress
+from helper import imgcache
+from helper.common import abort, abort_if, exec_shell
 from helper.prettyprint import *
 
 class Lcov:
@@ -27,6 +28,7 @@ def __init__(self, tc_dirs, img_dirs, cfg, empty_img, verbose):
         self.cfg = cfg
         self.verbose = verbose
         self.empty_img = self.cfg['lcov']['empty_img']
+        self.img_cache = imgcache.ImageCache.from_cfg(cfg, verbose)
 
         abort_if(len(tc_dirs) != len(img_dirs), '')
 
@@ -156,11 +158,13 @@ def execute_tcs(self, tc_dir, img_dir):
             
             img_cmpr = img.endswith('.tar.gz')
             if img_cmpr:
-                decompress(img, '/mnt/pmem0/', verbose=self.verbose)
-                img = path.join(
+                img_dest = path.join(
                     '/mnt/pmem0/',
                     path.basename(nh.get_metadata_files(img)['pm_pool'])
                 )
+                imgcache.decompress(self.img_cache, img, img_dest, 
+                    self.verbose)
+                img = img_dest
 
             self.run_tgt(tc, img)
 
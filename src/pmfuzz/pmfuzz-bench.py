@@ -0,0 +1,639 @@
+#! /usr/bin/env python3
+"""
+@file       pmfuzz-bench.py
+@details    Micro-benchmarks for PMFuzz's hot paths
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+"""
+
+import argparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from os import path
+from shutil import copy2
+
+import core.whatsup as wu
+import handlers.name_handler as nh
+
+from core import cmin
+from helper import codec
+from helper import common
+from helper import fileio
+from helper.config import Config
+from helper.prettyprint import *
+from interfaces import afl
+from interfaces import failureinjection as finj
+
+PROG_NAME   = common.get_version()['name']
+VERSION_STR = common.get_version()['version']
+AUTHORS_STR = common.get_version()['authors']
+DESC_STR    = PROG_NAME + ': A Persistent Memory Fuzzer, version ' \
+            + VERSION_STR + ' by ' + AUTHORS_STR
+
+MiB = 1024*1024
+
+def bench_codec(args):
+    """ @brief Measures compression ratio and throughput of every codec on
+    a set of PM images
+
+    @param args Parsed arguments
+    @return None """
+
+    imgs = args.imgs
+    common.abort_if(len(imgs) == 0, 'No images to benchmark')
+
+    total_sz = sum(path.getsize(img) for img in imgs)
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-bench-codec-', dir=args.tmpdir)
+
+    print('%d images, %.2f MiB' % (len(imgs), total_sz/MiB))
+    print('%-6s %5s %10s %12s %12s' \
+        % ('codec', 'level', 'ratio', 'comp MiB/s', 'decomp MiB/s'))
+
+    try:
+        for name in codec.CODECS:
+            cdc = codec.get_codec(name, threads=args.threads)
+            cmpr_sz = 0
+            comp_t, decomp_t = 0.0, 0.0
+
+            for img in imgs:
+                cmpr = path.join(tmpdir, path.basename(img) + '.tar.gz')
+                dest = path.join(tmpdir, path.basename(img))
+
+                start = time.perf_counter()
+                common.compress(img, cmpr, False, codec=cdc)
+                comp_t += time.perf_counter() - start
+
+                cmpr_sz += path.getsize(cmpr)
+
+                start = time.perf_counter()
+                common.decompress(cmpr, dest, False)
+                decomp_t += time.perf_counter() - start
+
+                os.remove(cmpr)
+                os.remove(dest)
+
+            print('%-6s %5d %10.2f %12.2f %12.2f' % (name, cdc.level,
+                total_sz/max(cmpr_sz, 1), total_sz/MiB/comp_t,
+                total_sz/MiB/decomp_t))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_sparse(args):
+    """ @brief Compares the sparse aware hash and copy to the dense versions
+    on a set of PM images
+
+    @param args Parsed arguments
+    @return None """
+
+    imgs = args.imgs
+    common.abort_if(len(imgs) == 0, 'No images to benchmark')
+
+    total_sz = sum(path.getsize(img) for img in imgs)
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-bench-sparse-', dir=args.tmpdir)
+    dest = path.join(tmpdir, 'copy')
+
+    def timeit(func):
+        start = time.perf_counter()
+        for img in imgs:
+            func(img)
+        return time.perf_counter() - start
+
+    print('%d images, %.2f MiB' % (len(imgs), total_sz/MiB))
+    print('%-16s %12s' % ('op', 'MiB/s'))
+
+    try:
+        results = [
+            ('sha256sum',       timeit(common.sha256sum)),
+            ('sparse_sha256',   timeit(fileio.sparse_sha256)),
+            ('copy2',           timeit(lambda img: copy2(img, dest))),
+            ('sparse_copy',     timeit(lambda img: fileio.sparse_copy(img, 
+                                                                    dest))),
+        ]
+
+        for name, secs in results:
+            print('%-16s %12.2f' % (name, total_sz/MiB/secs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+class LegacyNames:
+    """ @class Name handling as it was before TestcaseName, reparses the name
+    on every call. Only used as the baseline for bench_names(). """
+
+    @staticmethod
+    def is_tc(filename, all=False):
+        basename = path.basename(filename)
+        return re.search(nh.TC_REGEX, basename) != None \
+            or (all and re.search(nh.TC_MIN_REGEX, basename) != None)
+
+    @staticmethod
+    def get_metadata_files(testcase, deleted=False):
+        basename = path.basename(testcase)
+        dirname = path.dirname(testcase)
+
+        for old, new in [('pm_map_', ''), ('map_', ''), 
+                ('.pm_pool.tar.gz', '.testcase'), ('.pm_pool', '.testcase'), 
+                ('.crash_site.tar.gz', '.testcase'), 
+                ('.crash_site', '.testcase'), ('.min', '')]:
+            if old.strip('_') in basename:
+                basename = basename.replace(old, new)
+                break
+
+        common.abort_if(not LegacyNames.is_tc(basename), 
+            'Invalid name ' + testcase)
+
+        bare_name = basename.replace('.testcase', '')
+
+        result = {'testcase': path.join(dirname, basename),
+                  'clean': path.join(dirname, bare_name)}
+        for key, ext in [('min_testcase', '.min.testcase'), 
+                ('deleted', '.deleted'), ('crash_site', '.crash_site'),
+                ('crash_cmpr_site', '.crash_site.tar.gz'), 
+                ('pm_pool', '.pm_pool'), ('pm_cmpr_pool', '.pm_pool.tar.gz')]:
+            result[key] = path.join(dirname, bare_name + ext)
+        result['pm_map'] = path.join(dirname, 'pm_map_' + basename)
+        result['map'] = path.join(dirname, 'map_' + basename)
+
+        if not deleted:
+            del result['deleted']
+
+        return result
+
+    @staticmethod
+    def get_lineage(tc_name):
+        tc_name = path.basename(tc_name)
+        tc_name = LegacyNames.get_metadata_files(tc_name)['clean']
+
+        return [int(tkn.split('.')[0].split('=')[1]) \
+                    for tkn in tc_name.split(',')]
+
+    @staticmethod
+    def ancestor_cnt(filename):
+        basename = path.basename(filename)
+        clean_name = LegacyNames.get_metadata_files(basename)['clean']
+
+        return len(clean_name.split(',')) - 1
+
+    @staticmethod
+    def get_testcase_parent(testcase):
+        basename = path.basename(testcase)
+        ext = nh.get_extension(basename)
+        clean_name = basename.replace(ext, '')
+        ids = re.split(r',|\.', clean_name)
+        delims = [char for char in clean_name if char in ['.', ',']]
+
+        result = ''
+        if len(ids) > 1:
+            result = ids[0]
+            for delim, elem in zip(delims, ids[1:-1]):
+                result += delim + elem
+            result += ext
+        return result
+
+def bench_names(args):
+    """ @brief Compares the memoized TestcaseName based name handling to the
+    old reparse on every call functions on a synthetic corpus, both in speed
+    and in the results returned for every name
+
+    @param args Parsed arguments
+    @return None """
+
+    rnd = random.Random(args.seed)
+
+    def gen_name():
+        ids = []
+        for _ in range(rnd.randint(1, 5)):
+            ids.append('id=%06d' % rnd.randrange(1000000) \
+                + ''.join('.id=%06d' % rnd.randrange(1000000) \
+                    for _ in range(rnd.randint(0, 1))))
+
+        prefix, ext = rnd.choice([('', '.testcase'), ('', '.min.testcase'), 
+            ('map_', '.testcase'), ('pm_map_', '.testcase'), 
+            ('', '.pm_pool.tar.gz'), ('', '.crash_site.tar.gz')])
+
+        return '/results/@dedup/' + prefix + ','.join(ids) + ext
+
+    unique = [gen_name() for _ in range(args.unique)]
+    corpus = [rnd.choice(unique) for _ in range(args.count)]
+
+    ops = [
+        ('get_lineage',         LegacyNames.get_lineage,     nh.get_lineage),
+        ('ancestor_cnt',        LegacyNames.ancestor_cnt,    nh.ancestor_cnt),
+        ('get_testcase_parent', LegacyNames.get_testcase_parent,
+                                                    nh.get_testcase_parent),
+        ('get_metadata_files',  LegacyNames.get_metadata_files,
+                                                    nh.get_metadata_files),
+        ('is_tc',               LegacyNames.is_tc,           nh.is_tc),
+    ]
+
+    print('%d names, %d unique' % (len(corpus), len(unique)))
+    print('%-20s %12s %12s %8s %6s %10s' % ('op', 'legacy Kop/s', 
+        'new Kop/s', 'speedup', 'hits', 'mismatch'))
+
+    # Names are parsed on the first use by any of the functions
+    nh._parse_name.cache_clear()
+
+    for name, legacy, new in ops:
+        start = time.perf_counter()
+        for fname in corpus:
+            legacy(fname)
+        legacy_t = time.perf_counter() - start
+
+        # Corpora with more unique names than NAME_CACHE_SZ mostly miss
+        before = nh._parse_name.cache_info()
+        start = time.perf_counter()
+        for fname in corpus:
+            new(fname)
+        new_t = time.perf_counter() - start
+        after = nh._parse_name.cache_info()
+        calls = after.hits + after.misses - before.hits - before.misses
+        hits = (after.hits - before.hits) / max(1, calls)
+
+        # Checked after timing to keep the results out of the measurement
+        mismatch = sum(1 for fname in unique if legacy(fname) != new(fname))
+
+        print('%-20s %12.1f %12.1f %7.1fx %5.0f%% %10d' % (name, 
+            len(corpus)/legacy_t/1e3, len(corpus)/new_t/1e3, legacy_t/new_t,
+            hits*100, mismatch))
+
+def bench_maps(args):
+    """ @brief Compares the batched numpy map merge to merging bitarrays one
+    map at a time on a directory of coverage maps
+
+    @param args Parsed arguments
+    @return None """
+
+    import bitarray
+
+    names = sorted(filter(nh.is_map, os.listdir(args.dir)))
+    paths = [path.join(args.dir, name) for name in names]
+    common.abort_if(len(paths) == 0, 'No maps in ' + args.dir)
+
+    def legacy():
+        cumulative = None
+        for fpath in paths:
+            with open(fpath, 'rb') as obj:
+                cur = bitarray.bitarray()
+                cur.fromfile(obj)
+
+            cumulative = cur if cumulative == None else cumulative|cur
+
+        return sum(1 for byte in cumulative.tobytes() if byte != 0)
+
+    def new():
+        return wu.count_tuples(wu.merge_map_files(paths, batch=args.batch))
+
+    print('%d maps' % len(paths))
+    print('%-10s %12s %10s' % ('impl', 'maps/s', 'tuples'))
+
+    for name, func in [('bitarray', legacy), ('numpy', new)]:
+        start = time.perf_counter()
+        tuples = func()
+        secs = time.perf_counter() - start
+
+        print('%-10s %12.0f %10d' % (name, len(paths)/secs, tuples))
+
+def bench_cmin(args):
+    """ @brief Times the native corpus minimizer and afl-cmin (afl.cmin in
+    the config) on a dedup directory, afl-cmin only runs if a config is given.
+    The two minimizers do not implement the same algorithm (see core.cmin),
+    only their run times are comparable.
+
+    @param args Parsed arguments
+    @return None """
+
+    tcs = sorted(path.join(args.dir, name) for name in os.listdir(args.dir) \
+            if nh.is_tc(name))
+    common.abort_if(len(tcs) == 0, 'No testcases in ' + args.dir)
+
+    print('%d testcases' % len(tcs))
+    print('%-8s %10s %8s' % ('impl', 'secs', 'kept'))
+
+    start = time.perf_counter()
+    kept, missing = cmin.minimize(tcs)
+    secs = time.perf_counter() - start
+
+    print('%-8s %10.2f %8d' % ('native', secs, len(kept) + len(missing)))
+    if len(missing) > 0:
+        print('%d testcases have no PM map, dedup runs afl-cmin on them' \
+            % len(missing))
+
+    if args.config == None:
+        return
+
+    cfg = Config(args.config, False)
+    cfg.parse()
+
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-bench-cmin-', dir=args.tmpdir)
+    indir = path.join(tmpdir, 'in')
+    mapdir = path.join(tmpdir, 'maps')
+
+    try:
+        for dirpath in [indir, mapdir, path.join(tmpdir, '@temp')]:
+            os.makedirs(dirpath)
+
+        # Dedup copies the testcases and the maps before running afl-cmin
+        start = time.perf_counter()
+        for tc in tcs:
+            copy2(tc, indir)
+            metadata = nh.get_metadata_files(tc)
+            for map_f in [metadata['map'], metadata['pm_map']]:
+                if path.isfile(map_f):
+                    copy2(map_f, mapdir)
+
+        outdir = afl.run_afl_cmin(indir, tmpdir, cfg.tgtcmd, cfg, 
+                    mapdir=mapdir)
+        secs = time.perf_counter() - start
+
+        kept_afl = set(os.listdir(outdir))
+        print('%-8s %10.2f %8d' % ('afl', secs, len(kept_afl)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_finj(args):
+    """ @brief Compares generating crash sites one run per testcase to the
+    fork servers of finj.run_failure_inj_batch() on the testcases in a 
+    directory, using the same parent image
+
+    @param args Parsed arguments
+    @return None """
+
+    cfg = Config(args.config, False)
+    cfg.parse()
+
+    tcs = sorted(path.join(args.dir, name) for name in os.listdir(args.dir) \
+            if not name.startswith('.'))[:args.count]
+    common.abort_if(len(tcs) == 0, 'No testcases in ' + args.dir)
+
+    testcases = [(tc, nh.clean_tc_name(path.basename(tc))) for tc in tcs]
+
+    print('%d testcases, %d workers' % (len(tcs), args.workers))
+    print('%-8s %10s %10s %8s' % ('impl', 'secs', 'tc/s', 'sites'))
+
+    def count_sites(dirpath):
+        return sum(1 for name in os.listdir(dirpath) \
+                    if name.endswith('.' + nh.CRASH_SITE_EXT))
+
+    def report(impl, secs, dirpath):
+        print('%-8s %10.2f %10.2f %8d' % (impl, secs, len(tcs)/secs,
+            count_sites(dirpath)))
+
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-bench-finj-', dir=args.tmpdir)
+    img_name = 'bench.' + nh.PM_IMG_EXT
+
+    try:
+        # One run per testcase, each with a fresh copy of the parent
+        serial_dir = path.join(tmpdir, 'serial')
+        os.makedirs(serial_dir)
+        img = path.join(serial_dir, img_name)
+
+        start = time.perf_counter()
+        for tc, clean_name in testcases:
+            common.copypreserve(args.img, img)
+            finj.run_failure_inj(cfg, cfg.tgtcmd, img, tc, clean_name, 
+                create=False)
+        report('serial', time.perf_counter() - start, serial_dir)
+
+        # Fork servers, one directory per worker
+        imgpaths = []
+        for worker in range(args.workers):
+            dirpath = path.join(tmpdir, 'batch-%d' % worker)
+            os.makedirs(dirpath)
+            imgpaths.append(path.join(dirpath, img_name))
+
+        start = time.perf_counter()
+        for _ in finj.run_failure_inj_batch(cfg, cfg.tgtcmd, args.img, 
+                testcases, imgpaths):
+            pass
+        secs = time.perf_counter() - start
+
+        sites = sum(count_sites(path.dirname(img)) for img in imgpaths)
+        print('%-8s %10.2f %10.2f %8d' % ('batch', secs, len(tcs)/secs, 
+            sites))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_exec(args):
+    """ @brief Measures the execs/sec of a target, e.g., src/example, once per
+    libpmfuzz build directory, to compare builds of libpmfuzz.so
+
+    @param args Parsed arguments
+    @return None """
+
+    env = dict(os.environ)
+    for var in args.env:
+        common.abort_if('=' not in var, 'Expected KEY=VALUE, got ' + var)
+        key, val = var.split('=', 1)
+        env[key] = val
+
+    cmd = [args.target] + args.args
+    lib_dirs = args.lib_dir if len(args.lib_dir) > 0 else [None]
+
+    print('%s, %d runs' % (' '.join(cmd), args.runs))
+    print('%-40s %10s %10s %8s' % ('libpmfuzz', 'secs', 'execs/s', 'speedup'))
+
+    base = None
+    for lib_dir in lib_dirs:
+        run_env = dict(env)
+        if lib_dir != None:
+            run_env['LD_LIBRARY_PATH'] = ':'.join(filter(None, 
+                [path.abspath(lib_dir), env.get('LD_LIBRARY_PATH', '')]))
+
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            exit_code = subprocess.call(cmd, env=run_env, 
+                            stdout=subprocess.DEVNULL, 
+                            stderr=subprocess.DEVNULL)
+            common.abort_if(exit_code != 0, '%s exited with %d' \
+                % (args.target, exit_code))
+        secs = time.perf_counter() - start
+
+        rate = args.runs/secs
+        base = rate if base == None else base
+
+        print('%-40s %10.2f %10.1f %7.2fx' % (str(lib_dir), secs, rate, 
+            rate/base))
+
+def bench_fpoints(args):
+    """ @brief Runs failure injection (FI_MODE from the config, e.g., 
+    IMG_GEN) on the testcases in a directory and reports the failure points
+    per second reported by libpmfuzz
+
+    @param args Parsed arguments
+    @return None """
+
+    cfg = Config(args.config, False)
+    cfg.parse()
+
+    tcs = sorted(path.join(args.dir, name) for name in os.listdir(args.dir) \
+            if not name.startswith('.'))[:args.count]
+    common.abort_if(len(tcs) == 0, 'No testcases in ' + args.dir)
+
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-bench-fpoints-', dir=args.tmpdir)
+    img = path.join(tmpdir, 'bench.' + nh.PM_IMG_EXT)
+    stats_f = path.join(tmpdir, 'stats')
+
+    try:
+        start = time.perf_counter()
+        for tc in tcs:
+            if args.img != None:
+                common.copypreserve(args.img, img)
+
+            finj.run_failure_inj(cfg, cfg.tgtcmd, img, tc, 
+                nh.clean_tc_name(path.basename(tc)), create=args.img == None,
+                stats_f=stats_f)
+
+            # Only the stats are needed
+            for name in os.listdir(tmpdir):
+                if name.endswith('.' + nh.CRASH_SITE_EXT):
+                    os.remove(path.join(tmpdir, name))
+        secs = time.perf_counter() - start
+
+        exits = finj.read_dump_stats(stats_f, exits=True)
+        dumps = finj.read_dump_stats(stats_f)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    common.abort_if(len(exits) == 0, 'libpmfuzz reported no run, is the '
+        'target linked with a libpmfuzz that supports FI_DUMP_STATS?')
+
+    points = sum(run['failure_id'] for run in exits)
+    run_secs = sum(run['ns'] for run in exits)/1e9
+    dump_secs = sum(dump['ns'] for dump in dumps)/1e9
+
+    print('%d testcases, %d runs reported, %d failure points, %d dumps' \
+        % (len(tcs), len(exits), points, len(dumps)))
+    print('%-24s %10s %14s' % ('', 'secs', 'points/s'))
+    print('%-24s %10.2f %14.1f' % ('wall', secs, points/secs))
+    print('%-24s %10.2f %14.1f' % ('after pmfuzz_init()', run_secs, 
+        points/max(run_secs, 1e-9)))
+    print('%-24s %10.2f %14.1f' % ('without dumps', run_secs - dump_secs,
+        points/max(run_secs - dump_secs, 1e-9)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog=PROG_NAME, description=DESC_STR,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    subparsers = parser.add_subparsers(dest='bench', required=True,
+                        help='benchmark to run')
+
+    # Codec benchmark
+    codec_p = subparsers.add_parser('codec',
+                        help='compare image compression codecs')
+    codec_p.add_argument('imgs', type=str, nargs='+',
+                        help='uncompressed PM images to compress')
+    codec_p.add_argument('--threads', type=int, default=0,
+                        help='compression threads for codecs that support it')
+    codec_p.add_argument('--tmpdir', type=str, default=None,
+                        help='directory for temporary files')
+    codec_p.set_defaults(func=bench_codec)
+
+    # Sparse I/O benchmark
+    sparse_p = subparsers.add_parser('sparse',
+                        help='compare sparse aware and dense hash/copy')
+    sparse_p.add_argument('imgs', type=str, nargs='+',
+                        help='uncompressed PM images')
+    sparse_p.add_argument('--tmpdir', type=str, default=None,
+                        help='directory for temporary files')
+    sparse_p.set_defaults(func=bench_sparse)
+
+    # Name handling benchmark
+    names_p = subparsers.add_parser('names',
+                        help='compare memoized and legacy name parsing')
+    names_p.add_argument('--count', type=int, default=1000000,
+                        help='number of names to process per operation')
+    names_p.add_argument('--unique', type=int, default=1000000,
+                        help='number of unique names in the corpus')
+    names_p.add_argument('--seed', type=int, default=0,
+                        help='seed for generating the corpus')
+    names_p.set_defaults(func=bench_names)
+
+    # Coverage map merge benchmark
+    maps_p = subparsers.add_parser('maps',
+                        help='compare numpy and bitarray coverage map merge')
+    maps_p.add_argument('dir', type=str,
+                        help='directory with map_* files, e.g., @dedup')
+    maps_p.add_argument('--batch', type=int, default=wu.MAP_BATCH,
+                        help='maps read per batch')
+    maps_p.set_defaults(func=bench_maps)
+
+    # Corpus minimization benchmark
+    cmin_p = subparsers.add_parser('cmin',
+                        help='compare native corpus minimization and afl-cmin')
+    cmin_p.add_argument('dir', type=str,
+                        help='directory with testcases and maps, e.g., @dedup')
+    cmin_p.add_argument('--config', type=str, default=None,
+                        help='PMFuzz config to run afl-cmin with')
+    cmin_p.add_argument('--tmpdir', type=str, default=None,
+                        help='directory for temporary files')
+    cmin_p.set_defaults(func=bench_cmin)
+
+    # Failure injection benchmark
+    finj_p = subparsers.add_parser('finj',
+                        help='compare serial and fork server crash site '
+                            'generation')
+    finj_p.add_argument('config', type=str,
+                        help='PMFuzz config of the target')
+    finj_p.add_argument('img', type=str,
+                        help='uncompressed parent image')
+    finj_p.add_argument('dir', type=str,
+                        help='directory with the testcases to replay')
+    finj_p.add_argument('--workers', type=int, default=1,
+                        help='fork servers to use')
+    finj_p.add_argument('--count', type=int, default=100,
+                        help='max testcases to replay')
+    finj_p.add_argument('--tmpdir', type=str, default=None,
+                        help='directory for temporary files')
+    finj_p.set_defaults(func=bench_finj)
+
+    # Failure point rate benchmark
+    fpoints_p = subparsers.add_parser('fpoints',
+                        help='measure failure points/sec of failure '
+                            'injection over a corpus')
+    fpoints_p.add_argument('config', type=str,
+                        help='PMFuzz config of the target, sets FI_MODE')
+    fpoints_p.add_argument('dir', type=str,
+                        help='directory with the testcases to run')
+    fpoints_p.add_argument('--img', type=str, default=None,
+                        help='uncompressed image to run the testcases on, '
+                            'the image is created by the target if not set')
+    fpoints_p.add_argument('--count', type=int, default=100,
+                        help='max testcases to run')
+    fpoints_p.add_argument('--tmpdir', type=str, default=None,
+                        help='directory for temporary files')
+    fpoints_p.set_defaults(func=bench_fpoints)
+
+    # Target exec rate benchmark
+    exec_p = subparsers.add_parser('exec',
+                        help='compare the execs/sec of a target across '
+                            'libpmfuzz builds')
+    exec_p.add_argument('target', type=str,
+                        help='target binary, e.g., src/example/example built '
+                            'with LIBS=-lpmfuzz')
+    exec_p.add_argument('args', type=str, nargs='*',
+                        help='arguments of the target, e.g., the number of PM '
+                            'accesses for src/example')
+    exec_p.add_argument('--lib-dir', type=str, action='append', default=[],
+                        help='directory with a libpmfuzz.so build, the first '
+                            'one is the baseline, can be repeated')
+    exec_p.add_argument('--env', type=str, action='append', default=[],
+                        help='KEY=VALUE to set for the target, can be '
+                            'repeated')
+    exec_p.add_argument('--runs', type=int, default=1000,
+                        help='executions per build')
+    exec_p.set_defaults(func=bench_exec)
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
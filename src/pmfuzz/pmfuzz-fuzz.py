@@ -64,9 +64,11 @@
 import textwrap
 
 from core import pmfuzz
+from core.coverage import CoverageAccumulator
 from handlers import name_handler as nh
 from helper import common
 from helper.config import Config
+from helper.manifest import DirManifest
 from helper.prettyprint import *
 
 from core import whatsup as wu
@@ -162,13 +164,19 @@ def collect_statistics(cfg, args):
 
     # Keeps track of if the tracking has started
     started = False
+
+    # Union of the maps seen so far, created once @info exists
+    cov = None
     while True:
         try:
             pmfuzz_d        = args.outdir
             pmfuzzdir_list  = os.listdir(pmfuzz_d)
+
+            if cov == None and '@info' in pmfuzzdir_list:
+                cov = CoverageAccumulator(pmfuzz_d)
     
             stages = {}
-            dedupdir_list = []
+            dedup_mf = None
             for d in pmfuzzdir_list:
                 if d.startswith('stage'):
                     stage, iter_id = nh.get_stage_inf(d)
@@ -178,7 +186,7 @@ def collect_statistics(cfg, args):
                     
                     stages[stage].append(iter_id)
                 elif d == '@dedup':
-                    dedupdir_list = os.listdir(os.path.join(pmfuzz_d, d))
+                    dedup_mf = DirManifest.get(os.path.join(pmfuzz_d, d))
 
             tc_total_inc    = 0
             tc_total_inc_pm = 0
@@ -195,14 +203,19 @@ def collect_statistics(cfg, args):
                     wu.record_stage_transitions(args, stage_max, iterid_max)
                     last_stage, last_iterid = stage_max, iterid_max
 
-            tc_total    = len(list(filter(nh.is_tc, dedupdir_list))) \
-                            + tc_total_inc
-            pm_tc_total = len(list(filter(nh.is_pm_map, dedupdir_list))) \
-                            + tc_total_inc_pm
-            total_paths = wu.get_total_paths(pmfuzz_d, stage_max, iterid_max)
+            tc_total    = tc_total_inc
+            pm_tc_total = tc_total_inc_pm
+            if dedup_mf != None:
+                tc_total    += len(dedup_mf.view(nh.is_tc))
+                pm_tc_total += len(dedup_mf.view(nh.is_pm_map))
+
+            total_paths = wu.get_total_paths(pmfuzz_d, stage_max, iterid_max,
+                            cov)
             total_pm_paths \
-                = wu.get_total_pm_paths(pmfuzz_d, stage_max, iterid_max)
-            exec_rate = wu.get_exec_rate(cfg, pmfuzz_d)
+                = wu.get_total_pm_paths(pmfuzz_d, stage_max, iterid_max, cov)
+
+            if cov != None:
+                cov.save()
             exec_rate = wu.get_exec_rate(cfg, pmfuzz_d)
             master_q_tc_total = wu.get_mqueue_population(cfg, pmfuzz_d)
 
@@ -1,9 +1,45 @@
 import doctest
+import errno
+import os
+import signal
+import subprocess
 import sys
+import time
+import types
 
+import shutil
+import tempfile
+
+import core.whatsup as wu
+import numpy as np
+import helper.hashcache as hashcache
+import helper.manifest as manifest_mod
+import helper.ptimer as ptimer
+import interfaces.afl as afl
+import interfaces.failureinjection as finj
 import handlers.name_handler as nh
 
+from os import path
+
+from core import cmin
+from core.coverage import CoverageAccumulator
+from core.eventloop import EventLoop
+from core.turnover import Turnover
+from helper import codec
+from helper import fileio
+from helper.crashsitedb import CrashSiteDB
+from helper.hashcache import HashCache
+from helper.imgcache import ImageCache
+from helper.manifest import DirManifest
+from helper.common import compress
+from helper.common import decompress
 from helper.parallel import Parallel
+from helper.parallel import WorkerPool
+from helper.parallel import in_worker
+from helper.ptimer import TimerStore
+from stages import scheduler
+from stages.dedup import Dedup
+from stages.stage import Stage
 
 def test_parallel():
     def dummy(val1, val2):
@@ -18,13 +54,1133 @@ def dummy(val1, val2):
 
     return (0, 1)
 
+def test_parallel_wait_modes():
+    def dummy(secs):
+        time.sleep(secs)
+
+    failures = 0
+    for wait_mode in [Parallel.WAIT_EVENT, Parallel.WAIT_SPIN]:
+        prl_obj = Parallel(dummy, 2, wait_mode=wait_mode)
+
+        for i in range(4):
+            prl_obj.run([0.1])
+
+        prl_obj.wait()
+
+        stats = prl_obj.sched_stats
+        if prl_obj.alive or stats['waiting'] <= 0:
+            failures += 1
+        
+        # Only the event based scheduler should be idle while waiting
+        if wait_mode == Parallel.WAIT_EVENT and stats['idle'] <= 0:
+            failures += 1
+        if wait_mode == Parallel.WAIT_SPIN and stats['idle'] != 0:
+            failures += 1
+
+    return (failures, 2)
+
+def test_worker_pool():
+    def square(val):
+        if val == 3:
+            raise ValueError('Failing on purpose')
+        return (os.getpid(), val*val)
+
+    failures = 0
+    with WorkerPool(square, 2, chunksize=3) as pool:
+        results = pool.map([[i] for i in range(10)])
+        unordered = {args[0]: res \
+                        for args, res in pool.imap_unordered([[i] for i in range(4)])}
+
+    # Failed job returns None, others return in order
+    if [r[1] if r != None else None for r in results] \
+            != [0, 1, 4, None, 16, 25, 36, 49, 64, 81]:
+        failures += 1
+
+    # Workers are reused across jobs
+    if len(set(r[0] for r in results if r != None)) > 2:
+        failures += 1
+
+    if len(unordered) != 4:
+        failures += 1
+
+    # Workers know they were started by a WorkerPool, this process does not
+    with WorkerPool(in_worker, 1) as pool:
+        if pool.map([[]]) != [True] or in_worker():
+            failures += 1
+
+    def slow_echo(val):
+        time.sleep(0.05*val)
+        return val
+
+    # Results still in flight when a caller stops iterating are dropped
+    with WorkerPool(slow_echo, 2) as pool:
+        for _ in pool.imap_unordered([[i] for i in range(4)]):
+            break
+
+        if pool.map([[10 + i] for i in range(3)]) != [10, 11, 12]:
+            failures += 1
+
+        # Workers that died while idle are replaced on the next call
+        for proc in list(pool.workers):
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+
+        if pool.map([[i] for i in range(3)]) != [0, 1, 2] \
+                or len(pool.workers) != 2:
+            failures += 1
+
+    return (failures, 6)
+
+def test_codecs():
+    """ Round trips a sparse image through every codec and through a tar czf 
+    archive from older output directories """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-codec-')
+
+    try:
+        src = path.join(tmpdir, 'pmfuzz-tmp-img-abcdefgh.id=000001.pm_pool')
+        with open(src, 'wb') as obj:
+            obj.write(os.urandom(4096))
+            obj.seek(1024*1024)
+            obj.write(b'end')
+
+        with open(src, 'rb') as obj:
+            expected = obj.read()
+
+        for name in codec.CODECS:
+            outdir = tempfile.mkdtemp(dir=tmpdir)
+            cmpr = path.join(tmpdir, name + '.tar.gz')
+            dest = path.join(outdir, 'id=000001.pm_pool')
+
+            compress(src, cmpr, False, codec=codec.get_codec(name), 
+                arcname=path.basename(dest))
+            decompress(cmpr, dest, False, verify=True)
+
+            with open(dest, 'rb') as obj:
+                if obj.read() != expected:
+                    failures += 1
+
+        # Archives created using tar should still be readable
+        outdir = tempfile.mkdtemp(dir=tmpdir)
+        cmpr = path.join(tmpdir, 'legacy.tar.gz')
+        subprocess.run(['tar', 'czf', cmpr, '-C', tmpdir, path.basename(src)],
+            check=True)
+        decompress(cmpr, path.join(outdir, path.basename(src)), False)
+
+        with open(path.join(outdir, path.basename(src)), 'rb') as obj:
+            if obj.read() != expected:
+                failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, len(codec.CODECS) + 1)
+
+def test_sparse_io():
+    """ Sparse hash should not depend on holes, sparse copy should preserve 
+    the contents """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-sparse-')
+
+    try:
+        sparse = path.join(tmpdir, 'sparse.pm_pool')
+        dense = path.join(tmpdir, 'dense.pm_pool')
+        copy = path.join(tmpdir, 'copy.pm_pool')
+
+        with open(sparse, 'wb') as obj:
+            obj.write(b'head')
+            obj.seek(8*1024*1024)
+            obj.write(os.urandom(100000))
+            obj.truncate(32*1024*1024)
+
+        with open(sparse, 'rb') as src, open(dense, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+        if fileio.sparse_sha256(sparse) != fileio.sparse_sha256(dense):
+            failures += 1
+
+        fileio.copy_stats(reset=True)
+        fileio.sparse_copy(dense, copy)
+        with open(copy, 'rb') as copy_obj, open(sparse, 'rb') as sparse_obj:
+            if copy_obj.read() != sparse_obj.read():
+                failures += 1
+
+        # Exactly one copy using any of the methods
+        stats = fileio.copy_stats()
+        if sum(stat['calls'] for stat in stats.values()) != 1 \
+                or sum(stat['copied'] for stat in stats.values()) \
+                    != path.getsize(sparse):
+            failures += 1
+
+        # copy_file_range() failing partway through an extent, the rest of
+        # the extent is copied through userspace
+        partial = path.join(tmpdir, 'partial.pm_pool')
+        with open(partial, 'wb') as obj:
+            obj.write(os.urandom(64*1024))
+
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        copy_user = fileio._copy_user
+        ficlone = fileio.FICLONE
+        user_starts = []
+
+        def partial_range(src_fd, dst_fd, count, offset_src, offset_dst):
+            if len(user_starts) == 0 and offset_src == 0:
+                return copy_file_range(src_fd, dst_fd, min(count, 1024), 
+                    offset_src, offset_dst)
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        def record_user(src_fd, dst_fd, start, end):
+            user_starts.append(start)
+            return copy_user(src_fd, dst_fd, start, end)
+
+        try:
+            fileio.FICLONE = 0      # Not an ioctl, reflink fails with ENOTTY
+            fileio._copy_user = record_user
+            if copy_file_range != None:
+                os.copy_file_range = partial_range
+
+            method, moved = fileio.sparse_copy(partial, copy)
+        finally:
+            fileio.FICLONE = ficlone
+            fileio._copy_user = copy_user
+            if copy_file_range != None:
+                os.copy_file_range = copy_file_range
+
+        with open(copy, 'rb') as copy_obj, open(partial, 'rb') as src_obj:
+            if copy_obj.read() != src_obj.read() \
+                    or method != fileio.COPY_USER or moved != 64*1024 \
+                    or (copy_file_range != None and user_starts[0] != 1024):
+                failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 4)
+
+def test_hash_cache():
+    """ Unchanged files should be read only once, modified or replaced files
+    again """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-hashcache-')
+    racy_window = hashcache.RACY_WINDOW
+
+    try:
+        fpath = path.join(tmpdir, 'id=000001.map')
+        with open(fpath, 'wb') as obj:
+            obj.write(b'map')
+
+        # Files changed just now are never cached
+        cache = HashCache(tmpdir)
+        cache.digest(fpath)
+        cache.digest(fpath)
+        if cache.misses != 2:
+            failures += 1
+
+        # The ctime of the test files cannot be set, cache them anyway
+        hashcache.RACY_WINDOW = -60
+
+        old = time.time() - 60
+        os.utime(fpath, (old, old))
+
+        HashCache(tmpdir).digest(fpath)
+
+        cache = HashCache(tmpdir)
+        first = cache.digest(fpath)
+        if cache.hits != 1 or cache.misses != 0:
+            failures += 1
+
+        with open(fpath, 'wb') as obj:
+            obj.write(b'new map')
+        os.utime(fpath, (old, old + 1))
+
+        if cache.digest(fpath) == first or cache.misses != 1:
+            failures += 1
+
+        # Same size and mtime, e.g., replaced using copypreserve()
+        second = cache.digest(fpath)
+        time.sleep(0.05)
+        with open(fpath, 'wb') as obj:
+            obj.write(b'MAP map')
+        os.utime(fpath, (old, old + 1))
+
+        if cache.digest(fpath) == second:
+            failures += 1
+
+        # Digests of removed files and of replaced inodes are pruned
+        other = path.join(tmpdir, 'id=000002.map')
+        for fname in [other, fpath + '.tmp']:
+            with open(fname, 'wb') as obj:
+                obj.write(b'other map')
+            os.utime(fname, (old, old))
+
+        cache.digest(other)
+        cache.digest(fpath)
+        os.remove(other)
+        os.replace(fpath + '.tmp', fpath)
+
+        rows = lambda: cache.conn.execute('SELECT COUNT(*) FROM hashes')\
+                        .fetchone()[0]
+        before = rows()
+        pruned = cache.prune()
+        cache.digest(fpath)
+
+        if before != 2 or pruned != 2 or rows() != 1 or cache.prune() != 0:
+            failures += 1
+    finally:
+        hashcache.RACY_WINDOW = racy_window
+        shutil.rmtree(tmpdir)
+
+    return (failures, 5)
+
+def test_crash_site_db():
+    """ Legacy hashes should be migrated, duplicates and verdicts should keep
+    the crash site seen first """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-csdb-')
+
+    try:
+        with open(path.join(tmpdir, CrashSiteDB.LEGACY_DB_NAME), 'w') as obj:
+            obj.write('{"id=000001.cs_1": "aa", "id=000001.cs_2": "bb"}')
+
+        db = CrashSiteDB(tmpdir)
+        db.set_many([('id=000002.cs_1', 'aa'), ('id=000002.cs_2', 'cc')])
+
+        if db.get('id=000001.cs_2') != 'bb' \
+                or db.first_seen('aa') != 'id=000001.cs_1':
+            failures += 1
+
+        names = ['id=000002.cs_1', 'id=000001.cs_1', 'id=000002.cs_2', 'x']
+        to_drop, missing, unique = db.duplicates(names)
+        if to_drop != ['id=000002.cs_1'] or missing != ['x'] or unique != 2:
+            failures += 1
+
+        db.set_verdicts([('aa', 'a.cs_1', True, 0), ('bb', 'b.cs_1', False, 1)],
+            'tester')
+        db.set_verdicts([('aa', 'a.cs_2', False, -11)], 'tester')
+        verdicts = db.get_verdicts(['aa', 'bb', 'cc'], 'tester')
+        if verdicts != {'aa': ('a.cs_1', True, 0), 'bb': ('b.cs_1', False, 1)}\
+                or db.get_verdicts(['aa'], 'other') != {}:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 3)
+
+def test_validate_crash_sites():
+    """ Crash sites should be run once per content hash, known verdicts should
+    be skipped and crashes with interesting signals reported as bugs """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-validate-')
+    runs_f = path.join(tmpdir, 'runs')
+
+    class StubCfg(dict):
+        def __call__(self, key):
+            return 'tester'
+
+    # Appends to a file to count the runs made by WorkerPool workers as well
+    def test_cs(tester_f, cspath):
+        with open(runs_f, 'a') as obj:
+            obj.write(cspath + '\n')
+
+        with open(cspath, 'rb') as obj:
+            crash = obj.read().startswith(b'crash')
+
+        return (not crash, -11 if crash else 0, ['target', cspath], {})
+
+    def run_count():
+        with open(runs_f, 'r') as obj:
+            return len(obj.read().split())
+
+    def gen_cs(name, content):
+        cspath = path.join(tmpdir, name + '.crash_site')
+        with open(cspath, 'wb') as obj:
+            obj.write(content)
+        return cspath
+
+    try:
+        open(runs_f, 'w').close()
+
+        stage = Stage.__new__(Stage)
+        stage.outdir = tmpdir
+        stage.verbose = False
+        stage.cores = 1
+        stage.cfg = StubCfg(pmfuzz={'failure_injection': {}})
+        stage.crash_site_db = CrashSiteDB(tmpdir)
+        stage.hash_cache = HashCache(tmpdir)
+        stage._test_crash_site = test_cs
+
+        batch = [gen_cs('id=000001', b'ok'), gen_cs('id=000002', b'ok'),
+            gen_cs('id=000003', b'crash'), gen_cs('id=000004', b'crash')]
+        stage.validate_crash_sites(batch)
+
+        with open(path.join(tmpdir, '@bugs.db'), 'r') as obj:
+            bugs = obj.read()
+
+        if run_count() != 2 or bugs.count('[record]') != 1 \
+                or 'imgpath=' + batch[2] not in bugs:
+            failures += 1
+
+        # Known verdicts are not tested again
+        stage.validate_crash_sites(batch)
+        if run_count() != 2:
+            failures += 1
+
+        # Same in WorkerPool workers
+        stage.cores = 2
+        batch = [gen_cs('id=000005', b'new'), gen_cs('id=000006', b'new'),
+            gen_cs('id=000007', b'other')]
+        stage.validate_crash_sites(batch)
+
+        if run_count() != 4:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 3)
+
+def test_dir_manifest():
+    """ Manifest should track its own additions and detect external ones, 
+    even in the same mtime tick """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-manifest-')
+
+    try:
+        manifest = DirManifest.get(tmpdir)
+        if len(manifest.view(nh.is_tc)) != 0:
+            failures += 1
+
+        open(path.join(tmpdir, 'id=000001.testcase'), 'w').close()
+        manifest.add('id=000001.testcase')
+
+        open(path.join(tmpdir, 'id=000002.testcase'), 'w').close()
+        os.utime(tmpdir, ns=(0, 0))
+
+        if manifest.view(nh.is_tc) \
+                != {'id=000001.testcase', 'id=000002.testcase'}:
+            failures += 1
+
+        # Created in the same mtime tick as the last listing, found once 
+        # the listing is out of the racy window
+        tick = time.time_ns() - manifest_mod.RACY_WINDOW*10**9 + 10**8
+        os.utime(tmpdir, ns=(tick, tick))
+        manifest.view(nh.is_tc)
+        open(path.join(tmpdir, 'id=000003.testcase'), 'w').close()
+        os.utime(tmpdir, ns=(tick, tick))
+        time.sleep(0.2)
+
+        if 'id=000003.testcase' not in manifest.view(nh.is_tc):
+            failures += 1
+
+        # Created by another process along with one recorded using add()
+        os.utime(tmpdir, ns=(1, 1))
+        manifest.view(nh.is_tc)
+        open(path.join(tmpdir, 'id=000004.testcase'), 'w').close()
+        open(path.join(tmpdir, 'id=000005.testcase'), 'w').close()
+        os.utime(tmpdir, ns=(2, 2))
+        manifest.add('id=000005.testcase')
+
+        if 'id=000004.testcase' not in manifest.view(nh.is_tc):
+            failures += 1
+
+        # Files copied in by this process do not list the directory again
+        os.utime(tmpdir, ns=(3, 3))
+        manifest.names
+
+        listdir = os.listdir
+        listings = []
+        def count_listdir(dirpath):
+            listings.append(dirpath)
+            return listdir(dirpath)
+
+        try:
+            os.listdir = count_listdir
+            for i in range(100):
+                name = 'id=%06d.testcase' % (10 + i)
+                open(path.join(tmpdir, name), 'w').close()
+                manifest.add(name)
+
+                if name not in manifest:
+                    failures += 1
+                    break
+        finally:
+            os.listdir = listdir
+
+        if len(listings) != 0:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 5)
+
+def test_whatsup_maps():
+    """ Merged maps should match a byte-wise OR of the map files """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-maps-')
+
+    try:
+        maps = []
+        for i in range(5):
+            m = bytearray(64)
+            m[i*3] = i + 1
+            m[(i*7) % 64] |= 0x80
+            maps.append(m)
+
+            with open(path.join(tmpdir, 'map_id=%06d.testcase' % i), 'wb') \
+                    as obj:
+                obj.write(m)
+
+        expected = bytearray(64)
+        for m in maps:
+            for j in range(64):
+                expected[j] |= m[j]
+
+        merged = wu.get_cumulative_map(tmpdir, nh.is_map, wu.same_name)
+        if bytes(merged) != bytes(expected):
+            failures += 1
+
+        # Small batches should not change the result
+        paths = sorted(path.join(tmpdir, f) for f in os.listdir(tmpdir))
+        if bytes(wu.merge_map_files(paths, batch=2)) != bytes(expected):
+            failures += 1
+
+        if wu.count_tuples(wu.combine_maps(None, merged, None)) \
+                != sum(1 for b in expected if b != 0) \
+                or wu.count_tuples(wu.combine_maps(None)) != 0:
+            failures += 1
+
+        # A map still being copied is zero padded, a removed one is skipped
+        partial = path.join(tmpdir, 'partial')
+        with open(partial, 'wb') as obj:
+            obj.write(maps[4][:10])
+
+        if bytes(wu.merge_map_files([partial, path.join(tmpdir, 'removed')] \
+                + paths, batch=2)) != bytes(expected):
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 4)
+
+def test_coverage_accumulator():
+    """ Accumulator should fold new maps, skip incomplete ones, rebuild on 
+    removal and restore from its checkpoint """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-cov-')
+    dedup_d = path.join(tmpdir, '@dedup')
+
+    def write_map(i, size=32):
+        m = bytearray(32)
+        m[i] = 1
+        with open(path.join(dedup_d, 'map_id=%06d.testcase' % i), 'wb') as obj:
+            obj.write(m[:size])
+
+    def tuples(cov):
+        return wu.count_tuples(wu.get_cumulative_map(dedup_d, nh.is_map, 
+            wu.same_name, cov))
+
+    try:
+        os.makedirs(path.join(tmpdir, '@info'))
+        os.makedirs(dedup_d)
+
+        cov = CoverageAccumulator(tmpdir)
+        for i in range(3):
+            write_map(i)
+        
+        if tuples(cov) != 3:
+            failures += 1
+
+        write_map(3)
+        os.utime(dedup_d, ns=(0, 0))
+        if tuples(cov) != 4 or cov.folded != 4:
+            failures += 1
+
+        # Still being written, folded once complete
+        write_map(4, size=8)
+        os.utime(dedup_d, ns=(2, 2))
+        if tuples(cov) != 4:
+            failures += 1
+
+        write_map(4)
+        if tuples(cov) != 5 or cov.folded != 5:
+            failures += 1
+
+        cov.save()
+        os.remove(path.join(dedup_d, 'map_id=000000.testcase'))
+        os.utime(dedup_d, ns=(1, 1))
+
+        # New process state, restored from the checkpoint
+        DirManifest._manifests.clear()
+        cov = CoverageAccumulator(tmpdir)
+        if tuples(cov) != 4 or cov.rebuilds != 1:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 5)
+
+def test_afl_stats():
+    """ Stage stats should aggregate stage 1 and stage 2 AFL layouts """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-aflstats-')
+    now = int(time.time())
+
+    def write_stats(instance_d, execs, pid, stability):
+        os.makedirs(instance_d)
+        with open(path.join(instance_d, 'fuzzer_stats'), 'w') as obj:
+            obj.write('start_time        : %d\n' % (now - 10))
+            obj.write('fuzzer_pid        : %d\n' % pid)
+            obj.write('execs_done        : %d\n' % execs)
+            obj.write('paths_total       : 5\n')
+            obj.write('unique_crashes    : 1\n')
+            obj.write('stability         : %.2f%%\n' % stability)
+
+    try:
+        # Stage 1, one fuzzer is no longer running
+        stage1_d = path.join(tmpdir, 'stage1')
+        write_stats(path.join(stage1_d, 'master_fuzzer'), 1000, os.getpid(), 
+            100)
+        write_stats(path.join(stage1_d, 'slave_fuzzer_1'), 500, 2**22+1, 90)
+
+        stats = afl.get_stage_stats(stage1_d, now=now)
+        if stats['instances'] != 2 or stats['alive'] != 1 \
+                or stats['execs_done'] != 1500 \
+                or round(stats['execs_per_sec']) != 100 \
+                or stats['stability'] != 95:
+            failures += 1
+
+        # Stage 2, one master fuzzer per testcase
+        stage2_d = path.join(tmpdir, 'stage2')
+        for i in range(3):
+            write_stats(path.join(stage2_d, 'id=%06d' % i, 'master_fuzzer'),
+                100, os.getpid(), 100)
+
+        stats = afl.get_stage_stats(stage2_d, now=now)
+        if stats['instances'] != 3 or stats['paths_total'] != 15 \
+                or stats['unique_crashes'] != 3:
+            failures += 1
+
+        # An instance that did not write its pid yet is not running
+        write_stats(path.join(tmpdir, 'stage3', 'master_fuzzer'), 100, 0, 
+            100)
+        if afl.get_stage_stats(path.join(tmpdir, 'stage3'))['alive'] != 0:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 3)
+
+def test_event_loop():
+    """ Event loop should wake on timers, directory changes and child exits,
+    with and without inotify """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-eventloop-')
+    watched_d = path.join(tmpdir, 'watched')
+
+    try:
+        for use_inotify in [True, False]:
+            with EventLoop() as loop:
+                if not use_inotify and loop.inotify != None:
+                    loop.inotify.close()
+                    loop.selector.unregister(loop.inotify.fd)
+                    loop.inotify = None
+
+                # Watched before it exists, reported once created
+                if loop.changed(watched_d):
+                    failures += 1
+                os.makedirs(watched_d)
+                if not loop.changed(watched_d) or loop.changed(watched_d):
+                    failures += 1
+
+                fired = []
+                loop.drain()
+                loop.call_later(0.05, lambda: fired.append(True))
+                if 'timer' not in loop.wait(5) or fired != [True]:
+                    failures += 1
+
+                open(path.join(watched_d, 'new'), 'w').close()
+                os.utime(watched_d, ns=(0, 0))
+                loop.wait(5)
+                if not loop.changed(watched_d):
+                    failures += 1
+
+                subprocess.call(['true'])
+                loop.wait(5)
+                if not loop.child_exited():
+                    failures += 1
+
+                # Exits not waited for yet are kept by drain()
+                proc = subprocess.Popen(['true'])
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+                loop.drain()
+                if 'child' not in loop.wait(5) or not loop.child_exited():
+                    failures += 1
+
+                proc.wait()
+                loop.drain()
+                if loop.child_exited():
+                    failures += 1
+
+                # Forked processes do not inherit the loop's handlers
+                pid = os.fork()
+                if pid == 0:
+                    os._exit(int(signal.set_wakeup_fd(-1) != -1 \
+                        or signal.getsignal(signal.SIGCHLD) \
+                            != signal.SIG_DFL))
+                if os.waitpid(pid, 0)[1] != 0:
+                    failures += 1
+
+            shutil.rmtree(watched_d)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 16)
+
+def test_scheduler():
+    """ Coverage scheduler should start the candidates adding the most PM 
+    coverage first, cut stalled runs and extend productive ones """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-scheduler-')
+    gbl_d = path.join(tmpdir, '@dedup')
+    loc_d = path.join(tmpdir, '@dedup_sync')
+    afl_d = path.join(tmpdir, 'afl')
+
+    def write_map(dirpath, tc, tuples):
+        cov_map = np.zeros(64, dtype=np.uint8)
+        cov_map[tuples] = 1
+        cov_map.tofile(path.join(dirpath, 'map_' + tc + '.testcase'))
+        open(path.join(dirpath, 'pm_map_' + tc + '.testcase'), 'w').close()
+
+    def write_stats(name, paths_found, last_path):
+        fuzzer_d = path.join(afl_d, name, 'master_fuzzer')
+        os.makedirs(fuzzer_d, exist_ok=True)
+        with open(path.join(fuzzer_d, 'fuzzer_stats'), 'w') as obj:
+            obj.write('paths_found : %d\nlast_path : %d\n' \
+                % (paths_found, last_path))
+
+    try:
+        for dirpath in [gbl_d, loc_d, afl_d]:
+            os.makedirs(dirpath)
+
+        # id=000001 ran in an earlier iteration, id=000002 adds nothing
+        write_map(gbl_d, 'id=000001', [1, 2, 3])
+        for dirpath in [gbl_d, loc_d]:
+            write_map(dirpath, 'id=000002', [1, 2])
+            write_map(dirpath, 'id=000003', [2, 10, 11])
+
+        stage2 = types.SimpleNamespace(stage=2, iter_id=1, outdir=tmpdir,
+            tc_timeout=100, timers=TimerStore(loc_d),
+            dedup=types.SimpleNamespace(gbl_manifest=DirManifest.get(gbl_d),
+                loc_manifest=DirManifest.get(loc_d)),
+            get_result_dir=lambda name: path.join(afl_d, name, 
+                'master_fuzzer'))
+
+        sched = scheduler.CoverageScheduler(stage2, 
+                    {'max_extend': 1, 'cut_after': 0.5})
+
+        if sched.order(['id=000002', 'id=000003'], 'tc') \
+                != ['id=000003', 'id=000002']:
+            failures += 1
+
+        # Stalled for more than half a slice
+        stage2.timers.start_new('id=000002', 100, 'tc')
+        stage2.timers.state('id=000002')['start'] -= 60
+        stage2.timers.set_length('id=000002', 100)
+        write_stats('id=000002', 0, 0)
+
+        # Reached its deadline while finding paths
+        stage2.timers.start_new('id=000003', 100, 'tc')
+        stage2.timers.state('id=000003')['start'] -= 101
+        stage2.timers.set_length('id=000003', 100)
+        write_stats('id=000003', 5, int(time.time()))
+
+        if sched.pop_expired('tc') != ['id=000002']:
+            failures += 1
+        if stage2.timers.state('id=000003')['length'] != 200 \
+                or 'id=000003' not in stage2.timers.running('tc'):
+            failures += 1
+
+        sched.finished('id=000002', 'tc')
+        with open(sched.report_f, 'r') as obj:
+            lines = obj.read().splitlines()
+        if len(lines) != 2 or lines[1].split(',')[4] != 'id=000002':
+            failures += 1
+        if sched.expected_rate('tc') != 0:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 5)
+
+def test_afl_supervisor():
+    """ AFL supervisor should report instances that fail to start or die and
+    not report the ones it stopped """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-supervisor-')
+    good_d = path.join(tmpdir, 'good', 'master_fuzzer')
+    bad_d = path.join(tmpdir, 'bad', 'master_fuzzer')
+
+    supervisor = afl.AFLSupervisor.get()
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            supervisor.launch(good_d, ['sh', '-c', 'mkdir -p %s && touch '
+                '%s/fuzzer_stats && exec sleep 30' % (good_d, good_d)], 
+                None, devnull, devnull, group='tc')
+            supervisor.launch(bad_d, ['sh', '-c', 'exit 3'], None, devnull, 
+                devnull, group='tc')
+
+        if not supervisor.wait_started(good_d, timeout=10):
+            failures += 1
+        if supervisor.wait_started(bad_d, timeout=10):
+            failures += 1
+        if supervisor.running_count('tc') != 1:
+            failures += 1
+        if supervisor.failures('tc') != {path.abspath(bad_d): 3}:
+            failures += 1
+
+        # Stopped instances are not failures
+        if not supervisor.stop(good_d) or supervisor.running_count('tc') != 0:
+            failures += 1
+
+        deadline = time.time() + 10
+        while supervisor.tracks(good_d) and time.time() < deadline:
+            if supervisor.reap() != []:
+                failures += 1
+            time.sleep(0.05)
+
+        if supervisor.tracks(good_d) or supervisor.failed(good_d):
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 7)
+
+def test_timer_store():
+    """ Timer store should migrate .ptimer files, report every expired timer
+    once and survive a restart """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-timers-')
+
+    try:
+        # Left by an older version, already expired
+        with open(path.join(tmpdir, 'id=000001.ptimer'), 'w') as obj:
+            obj.write(str({'start': time.time() - 10, 'length': 1}))
+
+        timers = TimerStore(tmpdir)
+        timers.set_tag('id=000001', 'tc')
+        timers.timer('id=000002').start_new(0.1, 'tc')
+        timers.timer('id=000003').start_new(3600, 'tc')
+
+        if path.isfile(path.join(tmpdir, 'id=000001.ptimer')) \
+                or timers.running('tc') != {'id=000002', 'id=000003'}:
+            failures += 1
+
+        time.sleep(0.2)
+        if sorted(timers.pop_expired('tc')) != ['id=000001', 'id=000002'] \
+                or timers.pop_expired('tc') != [] \
+                or timers.running('tc') != {'id=000003'}:
+            failures += 1
+
+        # Changes are only written by flush()
+        store_f = path.join(tmpdir, TimerStore.STORE_FNAME)
+        with open(store_f, 'r') as obj:
+            saved = obj.read()
+
+        timers.flush()
+        with open(store_f, 'r') as obj:
+            if 'id=000002' in saved or 'id=000002' not in obj.read():
+                failures += 1
+
+        # Restart, expired timers are reported again
+        timers = TimerStore(tmpdir)
+        if len(timers.pop_expired('tc')) != 2 \
+                or not timers.timer('id=000003').deadline() \
+                == timers.next_deadline() > time.time() \
+                or not timers.timer('id=000002').expired() \
+                or not timers.timer('id=000004').is_new():
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 4)
+
+def test_turnover():
+    """ Turnover should reserve a bounded share of the cores only when
+    overlapped and report the idle core-seconds """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-turnover-')
+
+    def cfg(turnover):
+        return {'pmfuzz': {'stage': {'2': {'turnover': turnover}}}}
+
+    try:
+        os.makedirs(path.join(tmpdir, '@info'))
+
+        if Turnover.reserved_cores(cfg({'overlap': False}), 8) != 0 \
+                or Turnover.reserved_cores(cfg({'overlap': True}), 1) != 0:
+            failures += 1
+        if Turnover.reserved_cores(cfg({'overlap': True}), 8) != 2 \
+                or Turnover.reserved_cores(cfg({'overlap': True, 
+                    'reserve': 0.1}), 4) != 1 \
+                or Turnover.reserved_cores(cfg({'overlap': True, 
+                    'reserve': 1}), 4) != 3:
+            failures += 1
+
+        Turnover.report(tmpdir, 2, 1, 'overlap', 4, 1, 100, 102, 110)
+        with open(path.join(tmpdir, '@info', Turnover.REPORT_NAME)) as obj:
+            lines = obj.read().splitlines()
+        if lines[1] != '2,1,overlap,4,1,2.0,8.0,8.0':
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 3)
+
+def test_cmin():
+    """ Native corpus minimizer should keep the smallest testcase for the
+    rarest map and PM map tuples and report the testcases without PM maps """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-cmin-')
+
+    def write_map(map_f, counts):
+        if counts != None:
+            cov_map = np.zeros(64, dtype=np.uint8)
+            for idx, cnt in counts.items():
+                cov_map[idx] = cnt
+            cov_map.tofile(map_f)
+
+    def write_tc(name, size, counts, pm_counts={}, dirpath=tmpdir):
+        tc = path.join(dirpath, name + '.testcase')
+        with open(tc, 'wb') as obj:
+            obj.write(b'x'*size)
+
+        write_map(path.join(dirpath, 'map_' + name + '.testcase'), counts)
+        write_map(path.join(dirpath, 'pm_map_' + name + '.testcase'), 
+            pm_counts)
+
+        return tc
+
+    try:
+        os.makedirs(path.join(tmpdir, 'lcl'))
+
+        tcs = [
+            write_tc('id=000001', 10, {1: 1, 2: 1, 3: 1}),
+            write_tc('id=000002', 5,  {1: 1, 2: 1}),  # Smaller, not needed
+            write_tc('id=000003', 20, {3: 1, 4: 1}),  # Only one with 4
+            write_tc('id=000004', 1,  {1: 2}),        # Different bucket
+            write_tc('id=000005', 1,  {1: 3}),        # Same bucket as 4
+            write_tc('id=000006', 1,  {}),
+            write_tc('id=000007', 1,  None, None),
+            write_tc('id=000008', 30, {1: 1}, {5: 1}), # Only one with PM 5
+            write_tc('id=000009', 1,  None, {6: 1}),
+            # Same name as id=000002, in a different directory
+            write_tc('id=000002', 5,  {1: 1, 2: 1}, 
+                dirpath=path.join(tmpdir, 'lcl')),
+        ]
+
+        kept, missing = cmin.minimize(tcs)
+
+        if sorted(path.basename(tc) for tc in kept) != ['id=000002.testcase',
+                'id=000003.testcase', 'id=000004.testcase', 
+                'id=000008.testcase', 'id=000009.testcase'] \
+                or tcs[1] not in kept:
+            failures += 1
+        if missing != [tcs[6]]:
+            failures += 1
+        if cmin.minimize(tcs[6:7]) != ([], tcs[6:7]):
+            failures += 1
+
+        # Dedup runs afl-cmin only on the testcases without a PM map
+        afl_cmin_runs = []
+        def afl_cmin(tcs):
+            afl_cmin_runs.append(tcs)
+            return []
+
+        dedup = types.SimpleNamespace(verbose=False, _afl_cmin=afl_cmin,
+            cfg={'pmfuzz': {'stage': {'dedup': {'cmin': 'native'}}}})
+        dropped = Dedup.minimize_corpus(dedup, tcs)
+
+        if afl_cmin_runs != [[tcs[6]]] or tcs[6] not in dropped \
+                or tcs[1] in dropped:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 4)
+
+def test_img_cache():
+    """ Image cache should decompress an image once, hand out private copies
+    and evict the least recently used images over its size limit """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-imgcache-')
+
+    def gen_img(name, size):
+        img = path.join(tmpdir, name + '.pm_pool')
+        with open(img, 'wb') as obj:
+            obj.write(os.urandom(size))
+
+        compress(img, img + '.tar.gz', False)
+        with open(img, 'rb') as obj:
+            return img + '.tar.gz', obj.read()
+
+    try:
+        cache = ImageCache(path.join(tmpdir, 'cache'), 96*1024)
+        img1, data1 = gen_img('id=000001', 64*1024)
+        img2, _ = gen_img('id=000002', 64*1024)
+
+        dest = path.join(tmpdir, 'dest.pm_pool')
+        for i in range(3):
+            cache.get(img1, dest)
+
+            # Writes to the copy should not reach the cache
+            with open(dest, 'r+b') as obj:
+                if obj.read() != data1:
+                    failures += 1
+                obj.seek(0)
+                obj.write(b'dirty')
+
+        stats = cache.stats()
+        if stats['hits'] != 2 or stats['misses'] != 1 \
+                or stats['bytes_saved'] != 2*64*1024:
+            failures += 1
+
+        # Both do not fit, id=000001 is the least recently used
+        cache.get(img2, dest)
+        stats = cache.stats(reset=True)
+        if stats['evictions'] != 1 or stats['images'] != 1 \
+                or cache.stats()['hits'] != 0:
+            failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 5)
+
+# Speaks the protocol of the AFL runtime's fork server, every child exits with
+# the length of its stdin, hangs on 'hang' and crashes on 'crash'
+FAKE_FSRV = '''
+import os, signal, struct, sys, time
+os.write(199, struct.pack('I', 0))
+while len(os.read(198, 4)) == 4:
+    pid = os.fork()
+    if pid == 0:
+        data = sys.stdin.buffer.read()
+        if data == b'hang':
+            time.sleep(60)
+        if data == b'crash':
+            os.kill(os.getpid(), signal.SIGSEGV)
+        if data == b'fds':
+            fds = [fd for fd in os.listdir('/proc/self/fd') 
+                    if int(fd) > 2 and int(fd) not in [198, 199]]
+            os._exit(len(fds) - 1) # listdir()'s own descriptor
+        os._exit(len(data))
+    os.write(199, struct.pack('I', pid))
+    os.write(199, struct.pack('I', os.waitpid(pid, 0)[1]))
+'''
+
+def test_fork_server():
+    """ ForkServer should replay every testcase on a fresh child with the 
+    input rewound, report timeouts as None and not leak descriptors """
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='pmfuzz-test-fsrv-')
+
+    try:
+        tcs = {}
+        for name, data in [('long', b'abcdef'), ('short', b'ab'), 
+                ('hang', b'hang'), ('crash', b'crash'), ('fds', b'fds')]:
+            tcs[name] = path.join(tmpdir, name)
+            with open(tcs[name], 'wb') as obj:
+                obj.write(data)
+
+        leak_r, leak_w = os.pipe()
+        os.set_inheritable(leak_r, True)
+
+        with open(os.devnull, 'w') as out_obj:
+            fsrv = finj.ForkServer([sys.executable, '-c', FAKE_FSRV], 
+                        dict(os.environ), path.join(tmpdir, 'input'), out_obj)
+
+            started = fsrv.start()
+            os.close(leak_r)
+            os.close(leak_w)
+
+            if not started:
+                failures += 1
+            else:
+                try:
+                    if fsrv.run(tcs['long']) != 6 \
+                            or fsrv.run(tcs['short']) != 2:
+                        failures += 1
+                    if fsrv.run(tcs['hang'], timeout=0.5) != None \
+                            or fsrv.run(tcs['crash']) != -11 \
+                            or fsrv.run(tcs['short']) != 2:
+                        failures += 1
+
+                    # Only the fork server pipes are inherited and moved out
+                    # of this process once the target starts
+                    if fsrv.run(tcs['fds']) != 0 \
+                            or path.exists('/proc/self/fd/%d' \
+                                % finj.FORKSRV_FD):
+                        failures += 1
+                finally:
+                    fsrv.stop()
+
+            # A target without a fork server is detected
+            fsrv = finj.ForkServer(['true'], dict(os.environ), 
+                        path.join(tmpdir, 'input'), out_obj)
+            if fsrv.start(timeout=5):
+                failures += 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (failures, 4)
+
 def main():
-    f1, t1 = doctest.testmod(nh, verbose=False)
+    tests = [
+        lambda: doctest.testmod(nh, verbose=False),
+        test_parallel,
+        test_parallel_wait_modes,
+        test_worker_pool,
+        test_codecs,
+        test_sparse_io,
+        test_hash_cache,
+        test_crash_site_db,
+        test_validate_crash_sites,
+        test_dir_manifest,
+        test_whatsup_maps,
+        test_coverage_accumulator,
+        lambda: doctest.testmod(afl, verbose=False),
+        test_afl_stats,
+        test_event_loop,
+        lambda: doctest.testmod(ptimer, verbose=False),
+        test_timer_store,
+        test_afl_supervisor,
+        test_scheduler,
+        test_turnover,
+        test_cmin,
+        test_img_cache,
+        test_fork_server,
+    ]
 
-    f2, t2 = test_parallel()
+    failure_count, test_count = 0, 0
+    for test in tests:
+        failures, count = test()
 
-    failure_count = f1 + f2
-    test_count = t1 + t2
+        failure_count += failures
+        test_count += count
 
     print('%d of %d tests failed.' % (failure_count, test_count))
 
@@ -5,7 +5,6 @@
 
 SPDX-license-identifier: BSD-3-Clause
 """
-import pickledb
 import re
 import sys
 import time
@@ -19,10 +18,12 @@
 
 import handlers.name_handler as nh
 
+from core import cmin
 from core.dedupengine import DedupEngine
 from helper.common import *
 from helper import config
 from helper import parallel
+from helper.manifest import DirManifest
 from interfaces.afl import gen_tgt_img
 from interfaces.afl import run_afl_tmin
 from interfaces.afl import run_afl_cmin
@@ -30,6 +31,10 @@
 from helper.prettyprint import *
 from stages.stage import Stage
 
+def is_tc_any(filename):
+    """ Classifier for testcases and min testcases, for use with DirManifest """
+    return nh.is_tc(filename, all=True)
+
 class Dedup(Stage):
     """ @brief Run deduplication of all three fuzzing dimensions for specified 
     stage and iter_id. 
@@ -47,7 +52,11 @@ class Dedup(Stage):
     
     `*.after`: Used for cleanup (if any)
 
-    @TODO Update with new design that uses map files generated by AFL
+    #### Native corpus minimization
+    With pmfuzz.stage.dedup.cmin set to native, the corpus is minimized 
+    in-process using the maps and PM maps AFL already generated for every 
+    testcase (see core.cmin). Testcases without a PM map are kept, same as
+    tools/pmfuzz-cmin does.
     """
 
     # Result directory name for stage 1 directory
@@ -83,8 +92,17 @@ def __init__(self, stage, iter_id, srcdir, outdir, cfg, cores, verbose,
 
         # Create all the directories at startup
         self._gen_dirs()
+
+        self.gbl_manifest   = DirManifest.get(self.dedup_dir_gbl)
+        self.loc_manifest   = DirManifest.get(self.dedup_dir_loc)
+
+        self.select_ids     = set()
+        if 'select_ids' in self.cfg['pmfuzz']['stage']['2']:
+            self.select_ids = set(self.cfg['pmfuzz']['stage']['2']['select_ids'])
+
+        # Filtered lists for stage 2, valid till the manifest changes
+        self._st2_cache     = {}
         
-        self.crash_site_db_f = path.join(self.outdir, '@crashsitehashes.db')
         
         if verbose:
             printv('Creating dedup for stage %d with iter_id %d' % (stage, iter_id))
@@ -126,11 +144,7 @@ def should_use_cs(self, tc_p: str):
         """ Returns True if the give tc_p would be ever used """
         result = False 
 
-        ids = set()
-        if 'select_ids' in self.cfg['pmfuzz']['stage']['2']:
-            ids = set(self.cfg['pmfuzz']['stage']['2']['select_ids'])
-        # elif self.verbose:
-        #     printv('Skipping stage 2 select ids, none found')
+        ids = self.select_ids
 
         if len(ids) == 0:
             result = True
@@ -152,11 +166,7 @@ def should_use_tc(self, tc_p: str):
 
         result = False 
         
-        ids = set()
-        if 'select_ids' in self.cfg['pmfuzz']['stage']['2']:
-            ids = set(self.cfg['pmfuzz']['stage']['2']['select_ids'])
-        elif self.verbose:
-            printv('Skipping stage 2 select ids, none found')
+        ids = self.select_ids
         
         if len(ids) == 0:
             result = True
@@ -325,53 +335,50 @@ def construct_cmin_sh_files(self, srcdir, scriptsdir, imgdirs, tmp_img):
                     # Don't do anything, ':' character is NOP for shell
                     obj.write(':;\n')
 
-    def minimize_corpus_gbl(self):
-        """ @brief Minimizes the global dedup directory.
-        
-        This method uses modified afl-cmin that supports providing before and 
-        after shell scripts that provide the corresponding tgtcmd for each
-        testcase. Before and after shell scripts are passed to afl-cmin using
-        a config directory (tmp_cfgdir).
+    def _afl_cmin(self, tcs):
+        """ @brief Minimizes testcases using afl-cmin (afl.cmin in the config)
+        with the maps of the testcases
 
-        @todo Replace call to copypreserve with a softlink
-        @todo Cleanup indir and cfgdir after completion
-        @returns None """
-
-        write_state(self.outdir, 'Minimizing global corpus')
+        @param tcs List of complete paths to the testcases, their maps are
+               read from the same directory
+        @return List of complete paths of the testcases kept """
 
         # Create temporary directories for managing corpus
         tmp_indir = tempfile.mkdtemp(prefix='cmin-in-', dir=self.tempdir)
         tmp_mapdir = tempfile.mkdtemp(prefix='cmin-map-dir-', dir=self.tempdir)
 
-        # Copy all the test cases from self.tc_dir to temp directory for corpus
+        # Name of each testcase in the temp directory, testcases with the same
+        # name in different directories are prefixed to keep them apart
+        tmp_names = {}
+
+        # Copy the testcases and their maps to the temp directories for corpus
         # minimization
-        total_global_count = 0
-        for tc, _ in self.global_dedup_list_tc:
-            if nh.is_tc(tc):
-                total_global_count += 1
-                src = tc
-                dest = path.join(tmp_indir, path.basename(tc))
-                copypreserve(src, dest)
+        for tc in tcs:
+            tmp_name = path.basename(tc)
+            if tmp_name in tmp_names:
+                tmp_name = '%d.%s' % (len(tmp_names), tmp_name)
+            tmp_names[tmp_name] = tc
 
-                if self.verbose:
-                    printv(f'Copying testcase {src} -> {dest}')
+            metadata = nh.get_metadata_files(tc)
+            dest = path.join(tmp_indir, tmp_name)
+            copypreserve(tc, dest)
 
-                # Copy the map
-                src = path.join(path.dirname(tc), 'map_' + path.basename(tc))
-                dest = path.join(tmp_mapdir, 'map_' + path.basename(tc))
-                copypreserve(src, dest)
-                
-                if self.verbose:
-                    printv(f'Copying map {src} -> {dest}')
+            if self.verbose:
+                printv(f'Copying testcase {tc} -> {dest}')
 
-                # Copy the pm map
-                src = path.join(path.dirname(tc), 'pm_map_' + path.basename(tc))
-                dest = path.join(tmp_mapdir, 'pm_map_' + path.basename(tc))
+            for map_type in ['map', 'pm_map']:
+                src = metadata[map_type]
+                dest = path.join(tmp_mapdir, 
+                            path.basename(src).replace(path.basename(tc), 
+                                tmp_name))
 
                 if path.isfile(src):
                     copypreserve(src, dest)
-                    self.printv(f'Copying map {src} -> {dest}')
 
+                    if self.verbose:
+                        printv(f'Copying map {src} -> {dest}')
+                elif self.verbose:
+                    printv(f'Did not find {src}')
 
         # Create a temp image for cases that don't have any parent
         fd, temp_img = tempfile.mkstemp(prefix='pmfuzz-tmp-img-', 
@@ -391,21 +398,91 @@ def minimize_corpus_gbl(self):
             pmfuzzdir=self.outdir, 
             tgtcmd=tgtcmd_loc,
             cfg=self.cfg, 
-            # cfgdir=tmp_cfgdir,
             verbose=self.verbose,
             dry_run=False,
             mapdir=tmp_mapdir,
         )
 
-        dropped_files = []
-        for f in os.listdir(tmp_indir):
-            if f not in os.listdir(outdir):
-                dropped_files.append(f)
+        result = [tmp_names[name] for name in os.listdir(outdir)]
 
         if self.verbose:
-            printv('Dropping %d of %d testcases after cmin' \
-                % (len(dropped_files), total_global_count))
+            printv('Removing dir %s' % tmp_indir)
+            printv('Removing dir %s' % tmp_mapdir)
+            printv('Removing dir %s' % outdir)
+            printv('Removing %s' % temp_img)
         
+        rmtree(tmp_indir)
+        rmtree(tmp_mapdir)
+        rmtree(outdir)
+        os.remove(temp_img)
+
+        return result
+
+    def minimize_corpus(self, tcs):
+        """ @brief Minimizes a set of testcases using the minimizer selected
+        by pmfuzz.stage.dedup.cmin:
+
+        1. native: Greedy set cover over the stored maps and PM maps (see 
+           core.cmin), testcases without a PM map are minimized by afl-cmin
+        2. afl: afl-cmin (afl.cmin in the config) on every testcase
+
+        Configs without the key use afl-cmin.
+
+        @param tcs List of complete paths to the testcases, testcases with the
+               same name in different directories are minimized separately
+        @return List of complete paths of the testcases to drop """
+
+        mode = self.cfg['pmfuzz']['stage']['dedup'].get('cmin', 'afl')
+        abort_if(mode not in ['native', 'afl'], 
+            'Unknown corpus minimizer %s, should be native or afl' % mode)
+
+        if mode == 'native':
+            kept, missing = cmin.minimize(tcs)
+
+            # Only these are executed again to get their maps
+            if len(missing) > 0:
+                printw('%d testcases have no PM map, running afl-cmin on them'\
+                    % len(missing))
+                kept += self._afl_cmin(missing)
+        else:
+            kept = self._afl_cmin(tcs)
+
+        kept = set(kept)
+        result = [tc for tc in tcs if tc not in kept]
+
+        if self.verbose:
+            printv('Dropping %d of %d testcases after cmin (%s)' \
+                % (len(result), len(tcs), mode))
+
+        return result
+
+    def minimize_corpus_gbl(self, apply=True):
+        """ @brief Minimizes the global dedup directory using 
+        minimize_corpus().
+
+        @param apply Remove the dropped testcases from the global dedup 
+               directory, otherwise the caller removes them using 
+               drop_testcases_gbl(), e.g., from a different process
+        @returns List of names of the dropped testcases """
+
+        write_state(self.outdir, 'Minimizing global corpus')
+
+        tcs = [tc for tc, _ in self.global_dedup_list_tc if nh.is_tc(tc)]
+        dropped_files = [path.basename(tc) for tc in self.minimize_corpus(tcs)]
+        
+        if apply:
+            self.drop_testcases_gbl(dropped_files)
+        
+        return dropped_files
+
+    def drop_testcases_gbl(self, dropped_files):
+        """ @brief Removes testcases dropped by minimize_corpus_gbl() and 
+        their metadata from the global dedup directory, the compressed images
+        are kept
+
+        @param dropped_files List of names of the testcases
+        @return None """
+
         # Remove the dropped testcases and associated metadata files
         for f in dropped_files:
             metadata_files = nh.get_metadata_files(f, deleted=False)
@@ -428,112 +505,36 @@ def minimize_corpus_gbl(self):
 
             with open(placeholder_f, 'w') as obj:
                 obj.write('deleted at epoch=%d' % int(time.time()))
-        
-        if self.verbose:
-            printv('Removing dir %s' % tmp_indir)
-            printv('Removing dir %s' % tmp_mapdir)
-            printv('Removing %s' % temp_img)
-        
-        rmtree(tmp_indir)
-        rmtree(tmp_mapdir)
-        os.remove(temp_img)
-        
-        return
 
     def minimize_corpus_lcl(self):
         """ @brief Minimizes the local testcase directory by combining it with 
-        the global testcases.
-        
-        This method uses modified afl-cmin that supports providing before and 
-        after shell scripts that provide the corresponding tgtcmd for each
-        testcase. Before and after shell scripts are passed to afl-cmin using
-        a config directory (tmp_cfgdir).
+        the local dedup testcases using minimize_corpus().
         
         @returns None """
 
-        # Create temporary directories for managing corpus
-        tmp_indir = tempfile.mkdtemp(prefix='cmin-in-', dir=self.tempdir)
-        tmp_mapdir = tempfile.mkdtemp(prefix='cmin-map-dir-', dir=self.tempdir)
-
-        # Copy all testcases from global dedup to tmp_indir to allow 
-        # minimization on global corpus along with local
-        for f in os.listdir(self.dedup_dir_loc):
-            if nh.is_tc(f):
-                src = path.join(self.dedup_dir_loc, f)
-                dest = path.join(tmp_indir, f)
-
-                if self.verbose:
-                    printv(f'Copying to testcase: {src} -> {dest}')
-
-                copypreserve(src, dest)
-            elif nh.is_map(f) or nh.is_pm_map(f):
-                src = path.join(self.dedup_dir_loc, f)
-                dest = path.join(tmp_mapdir, f)
-
-                if path.isfile(src):
-                    copypreserve(src, dest)
-
-                    if self.verbose:
-                        printv(f'Copying to map: {src} -> {dest}')
-                elif self.verbose:
-                    printv(f'Did not find {src}')
-        
-        # Copy all the test cases from self.tc_dir to temp directory for corpus
-        # minimization
-        lcl_tcs = [path.join(self.tc_dir, f) for f in os.listdir(self.tc_dir)]
-        for f in lcl_tcs:
-            if nh.is_tc(f):
-                src = f
-                dest = path.join(tmp_indir, path.basename(f))
-                copypreserve(src, dest)
-
-                if self.verbose:
-                    printv(f'Copying to testcase: {src} -> {dest}')
-            elif nh.is_map(f) or nh.is_pm_map(f):
-                src = f
-                dest = path.join(tmp_mapdir, path.basename(f))
-
-                if path.isfile(src):
-                    copypreserve(src, dest)
-
-                    if self.verbose:
-                        printv(f'Copying to map: {src} -> {dest}')
-                elif self.verbose:
-                    printv(f'Did not find {src}')
-
-        total_tcs = len(os.listdir(tmp_indir))
-
-        # Create a temp image for cases that don't have any parent
-        _, temp_img = tempfile.mkstemp(prefix='pmfuzz-tmp-img-', 
-                        dir=self.tempdir)
-        _, tgtcmd_loc \
-            = nh.set_img_path(list(self.cfg.tgtcmd), temp_img, self.cfg)
-        gen_tgt_img(tgtcmd_loc, self.cfg, verbose=self.verbose)
-
-        # Run the actual thing
-        outdir = run_afl_cmin(
-            indir=tmp_indir, 
-            pmfuzzdir=self.outdir, 
-            tgtcmd=self.cfg.tgtcmd,
-            cfg=self.cfg, 
-            # cfgdir=tmp_cfgdir,
-            verbose=self.verbose,
-            mapdir=tmp_mapdir,
-            dry_run=False,
-        )
-
-        dropped_files = []
-        for f in os.listdir(tmp_indir):
-            if f not in os.listdir(outdir):
-                dropped_files.append(f)
-
-        if self.verbose:
-            printv('Dropping %d of %d testcases after cmin' \
-                % (len(dropped_files), total_tcs))
+        tcs = [path.join(self.dedup_dir_loc, f) \
+                for f in os.listdir(self.dedup_dir_loc) if nh.is_tc(f)]
+        tcs += [path.join(self.tc_dir, f) \
+                for f in os.listdir(self.tc_dir) if nh.is_tc(f)]
+
+        dropped = self.minimize_corpus(tcs)
+
+        # Testcases are keyed on their complete path, a testcase can be in
+        # both the directories. It is removed from the local testcase 
+        # directory if that copy was dropped and from the global dedup 
+        # directory if no copy was kept.
+        dropped_set = set(dropped)
+        kept_names = set(path.basename(tc) for tc in tcs \
+                        if tc not in dropped_set)
+
+        lcl_dropped = [path.basename(tc) for tc in dropped \
+                        if path.dirname(tc) == self.tc_dir]
+        dropped_files = sorted(set(path.basename(tc) for tc in dropped) \
+                            - kept_names)
         
         # Remove the dropped testcases and associated metadata files from the
         # local testcase directory 
-        for f in dropped_files:
+        for f in lcl_dropped:
             metadata_files = nh.get_metadata_files(f)
             for metadata_file_type in metadata_files:
                 file_to_delete = path.join(self.tc_dir, 
@@ -570,64 +571,45 @@ def minimize_corpus_lcl(self):
                 except FileNotFoundError:
                     pass
 
-        # TODO: Clean up file descriptors
-
-        if self.verbose:
-            printv('Removing dir %s' % tmp_indir)
-            printv('Removing dir %s' % tmp_mapdir)
-            printv('Removing %s' % temp_img)
-        
-        rmtree(tmp_indir)
-        rmtree(tmp_mapdir)
-        os.remove(temp_img)
-        
         return
 
     def deduplicate_crash_sites_lcl(self):
-        db = pickledb.load(self.crash_site_db_f, True)
+        """ Removes the crash sites with duplicate contents from the local 
+        image directory, keeping the one whose hash was seen first """
 
-        files = os.listdir(self.img_dir)
-        files = [path.join(self.img_dir, fname) for fname in files]
+        files = filter(nh.is_cmpr_crash_site, os.listdir(self.img_dir))
+        names = [fname.replace('.tar.gz', '') for fname in files]
 
-        hash_seen = {}
-        files_to_drop = []
-        for file_path in filter(nh.is_cmpr_crash_site, files):
-            file_name = path.basename(file_path)
-            clean_name = file_name.replace('.tar.gz', '')
+        files_to_drop, missing, unique = self.crash_site_db.duplicates(names)
 
-            hash_v = db.get(clean_name)
-
-            # DB should always carry the hash since it should've been inserted
-            # on compressed image generation
-            abort_if(hash_v == False, 
-                'Unable to find key %s in crash site db (%s)' \
-                % (clean_name, hash_v))
-
-            # Add the file to the drop list if the hash is unseen
-            if hash_v not in hash_seen:
-                hash_seen[hash_v] = True
-            else:
-                files_to_drop.append(file_name)
+        # DB should always carry the hash since it should've been inserted
+        # on compressed image generation
+        abort_if(len(missing) != 0, 
+            'Unable to find keys %s in crash site db' % str(missing[:10]))
 
         printi('Found %d files to remove' % len(files_to_drop))
-        for file_name in files_to_drop:
-            file_path = path.join(self.img_dir, file_name)
+        for name in files_to_drop:
+            file_path = path.join(self.img_dir, name + '.tar.gz')
             if self.verbose:
-                hash_val = db.get(file_name.replace('.tar.gz', ''))
-                printw('Deleting file %s with hash %s' \
-                    % (file_path, hash_val))
+                printw('Deleting file %s' % file_path)
             os.remove(file_path)
 
         if self.verbose:
-            orig_count = len(list(filter(nh.is_cmpr_crash_site, files)))
+            orig_count = len(names)
             printv('Original count: ' + str(orig_count))
-            printv('hash_seen length: ' + str(len(hash_seen)))
+            printv('hash_seen length: ' + str(unique))
             denominator = orig_count if orig_count > 0 else 1
             printv('Reduced by: ' \
-                + str((denominator-len(hash_seen))/denominator*100) + '%')
+                + str((denominator-unique)/denominator*100) + '%')
+
+    def _deduplicate_gbl(self, fdedup, min_tc, min_corpus, apply=True):
+        """ Reads the output of all the stages and deduplicates them 
+        
+        @param apply See minimize_corpus_gbl()
+        @return List of names of the testcases dropped by the corpus 
+                minimization """
 
-    def _deduplicate_gbl(self, fdedup, min_tc, min_corpus):
-        """ Reads the output of all the stages and deduplicates them """
+        dropped = []
 
         printi('Deduplicating global, fdedup: %s, min_tc: %s, min_corpus: %s' % (\
             '1' if fdedup else '0', 
@@ -641,9 +623,11 @@ def _deduplicate_gbl(self, fdedup, min_tc, min_corpus):
             testcases_path, _ = map(list, zip(*self.global_dedup_list_tc))
             
             if self.cfg('pmfuzz.stage.dedup.global.fdedup') == 'pm_map':
-                DedupEngine(testcases_path, self.verbose, nh.is_pm_map).run()
+                DedupEngine(testcases_path, self.verbose, nh.is_pm_map, 
+                    self.hash_cache).run()
             elif self.cfg('pmfuzz.stage.dedup.global.fdedup') == 'map':
-                DedupEngine(testcases_path, self.verbose, nh.is_map).run()
+                DedupEngine(testcases_path, self.verbose, nh.is_map, 
+                    self.hash_cache).run()
 
         if min_tc:
             abort('Minimizing TC doesn\'t make sense')
@@ -656,7 +640,9 @@ def _deduplicate_gbl(self, fdedup, min_tc, min_corpus):
             if self.verbose:
                 printv('Minimizing global corpus')
             write_state(self.outdir, 'Minimizing global corpus')
-            self.minimize_corpus_gbl()
+            dropped = self.minimize_corpus_gbl(apply)
+
+        return dropped
             
     def _deduplicate_lcl(self, fdedup, min_tc, min_corpus):
         printi('Deduplicating local')
@@ -689,6 +675,23 @@ def run(self, fdedup=True, min_tc=True, min_corpus=True, gbl=True):
         else:
             self._deduplicate_lcl(fdedup, min_tc, min_corpus)
 
+        # Crash sites and images come and go, drop the digests of the removed
+        # ones
+        pruned = self.hash_cache.prune()
+        if self.verbose:
+            printv('Pruned %d digests from the hash cache' % pruned)
+
+    def _cached_st2(self, key, manifest, gen_list):
+        """ Returns gen_list() cached till the manifest changes """
+
+        manifest.names # Refresh the manifest if the directory changed
+
+        if key not in self._st2_cache \
+                or self._st2_cache[key][0] != manifest.generation:
+            self._st2_cache[key] = (manifest.generation, gen_list())
+
+        return list(self._st2_cache[key][1])
+
     @property
     def local_dedup_list(self):
         """ @brief Get all the testcase and corresponding images in the local
@@ -699,22 +702,19 @@ def local_dedup_list(self):
 
         result = []
 
-        loc_dedup_files = listdir(self.dedup_dir_loc)
+        loc_dedup_files = self.loc_manifest.names
 
-        for filepath in loc_dedup_files:
+        for filepath in sorted(self.loc_manifest.view(is_tc_any)):
+            entry = [filepath, None]
             
-            # Only process testcases
-            if nh.is_tc(filepath, all=True):
-                entry = [filepath, None]
-                
-                # If this testcase has a corresponding pool image
-                imgpath = filepath.replace(Dedup.EXT_TC, Dedup.EXT_PM_POOL)
-                if imgpath in loc_dedup_files:
-                    # Add it to the tuple
-                    entry[1] = imgpath
+            # If this testcase has a corresponding pool image
+            imgpath = filepath.replace(Dedup.EXT_TC, Dedup.EXT_PM_POOL)
+            if imgpath in loc_dedup_files:
+                # Add it to the tuple
+                entry[1] = imgpath
 
-                # Add tuple to the results
-                result.append(tuple(entry))
+            # Add tuple to the results
+            result.append(tuple(entry))
 
         return result
 
@@ -729,21 +729,11 @@ def local_dedup_list_st2(self):
         @return List of tuple with first entry the path to the testcase and 
                 second entry a corresponding path to the image or None """
 
-        result: list = self.local_dedup_list
-        
-        idx2del = []
-        for iter in range(len(result)):
-            tc_p, img_p = result[iter]
-            if not self.should_use_tc(tc_p):
-                idx2del.append(iter)
+        def gen_list():
+            return [(tc_p, img_p) for tc_p, img_p in self.local_dedup_list \
+                        if self.should_use_tc(tc_p)]
 
-        if self.verbose:
-            printv('Dropping: ' + str(idx2del))
-
-        for idx in sorted(idx2del, reverse=True):
-            del result[idx]
-
-        return result
+        return self._cached_st2('tc', self.loc_manifest, gen_list)
     
     @property
     def global_dedup_list_tc(self):
@@ -757,28 +747,21 @@ def global_dedup_list_tc(self):
 
         result = []
 
-        gbl_dedup_files = listdir(self.dedup_dir_gbl)
+        gbl_dedup_files = self.gbl_manifest.names
 
-        # Complete the path
-        gbl_dedup_files = [path.join(self.dedup_dir_gbl, fname) \
-                                for fname in gbl_dedup_files]
+        for filepath in self.gbl_manifest.paths(nh.is_tc):
+            entry = [filepath, None]
 
-        for filepath in gbl_dedup_files:
-            
-            # Only process testcases
-            if nh.is_tc(filepath):
-                entry = [filepath, None]
-
-                # If this testcase has a corresponding pool image
-                imgpath = nh.get_metadata_files(filepath)['pm_cmpr_pool']
-                if imgpath in gbl_dedup_files:
-                    # Add it to the tuple
-                    entry[1] = imgpath
-                else:
-                    printw('No image found %s' % imgpath)
+            # If this testcase has a corresponding pool image
+            imgpath = nh.get_metadata_files(filepath)['pm_cmpr_pool']
+            if path.basename(imgpath) in gbl_dedup_files:
+                # Add it to the tuple
+                entry[1] = imgpath
+            else:
+                printw('No image found %s' % imgpath)
 
-                # Add tuple to the results
-                result.append(tuple(entry))
+            # Add tuple to the results
+            result.append(tuple(entry))
         
         if self.verbose:
             printv('Returning %d cases' % len(result))
@@ -794,21 +777,7 @@ def local_dedup_list_cs(self):
 
         @return List of path for every crash site in global dedup store """
 
-        result = []
-
-        local_cs_files = listdir(self.dedup_dir_loc)
-
-        # Complete the path
-        local_cs_files = [
-            path.join(self.dedup_dir_loc, fname) for fname in local_cs_files
-        ]
-
-        for filepath in local_cs_files:
-            # Only process testcases
-            if nh.is_cmpr_crash_site(filepath):
-                result.append(filepath)
-
-        return result
+        return self.loc_manifest.paths(nh.is_cmpr_crash_site)
 
     @property
     def local_dedup_list_cs_st2(self):
@@ -819,20 +788,11 @@ def local_dedup_list_cs_st2(self):
 
         @return List of path for every crash site in global dedup store """
 
-        result = []
-
-        local_cs_files = listdir(self.dedup_dir_loc)
-
-        # Complete the path
-        local_cs_files = [
-            path.join(self.dedup_dir_loc, fname) for fname in local_cs_files
-        ]
+        def gen_list():
+            return [filepath for filepath in self.local_dedup_list_cs \
+                        if self.should_use_cs(filepath)]
 
-        for filepath in local_cs_files:
-            # Only process testcases
-            if nh.is_cmpr_crash_site(filepath) \
-                    and self.should_use_cs(filepath):
-                result.append(filepath)
+        result = self._cached_st2('cs', self.loc_manifest, gen_list)
 
         if self.verbose:
             printv('Returning cs list: len = ' + str(len(result)))
@@ -847,21 +807,7 @@ def global_dedup_list_cs(self):
 
         @return List of path for every crash site in global dedup store """
 
-        result = []
-
-        gbl_dedup_files = listdir(self.dedup_dir_gbl)
-
-        # Complete the path
-        gbl_dedup_files = [
-            path.join(self.dedup_dir_gbl, fname) for fname in gbl_dedup_files
-        ]
-
-        for filepath in gbl_dedup_files:
-            # Only process testcases
-            if nh.is_cmpr_crash_site(filepath):
-                result.append(filepath)
-
-        return result
+        return self.gbl_manifest.paths(nh.is_cmpr_crash_site)
 
     @property
     def local_testcases_list(self):
@@ -908,7 +854,11 @@ def update_global(self):
 
         printi('Updating global')
 
-        gbl_tc_files = listdir(self.dedup_dir_gbl)
+        gbl_tc_files = self.gbl_manifest
+
+        # Snapshot for the membership checks, every name checked below is
+        # copied at most once
+        gbl_names = set(gbl_tc_files.names)
 
         # 1. Copy testcases and corresponding images
         for testcase, img in self.local_testcases_list:
@@ -920,8 +870,8 @@ def update_global(self):
                 = nh.get_metadata_files(dest_name_tc, deleted=True)['deleted']
 
             # Copy only if destination does not exists
-            if (dest_name_tc not in gbl_tc_files) \
-                    and (dest_name_placeholder not in gbl_tc_files):
+            if (dest_name_tc not in gbl_names) \
+                    and (dest_name_placeholder not in gbl_names):
                 printi('Copying files related to ' \
                     + path.basename(dest_name_tc))
                 
@@ -930,6 +880,7 @@ def update_global(self):
                 dest = path.join(self.dedup_dir_gbl, dest_name_tc)
                 
                 copypreserve(src, dest)
+                gbl_tc_files.add(dest_name_tc)
                 
                 if self.verbose:
                     printv('Copying to global dedup: %s -> %s' % (src, dest))
@@ -941,6 +892,7 @@ def update_global(self):
                 
                 if path.isfile(src):
                     copypreserve(src, dest)
+                    gbl_tc_files.add(path.basename(dest))
                 
                     if self.verbose:
                         printv('Copying to exec map: %s -> %s' % (src, dest))
@@ -955,6 +907,7 @@ def update_global(self):
                 
                 if path.isfile(src):
                     copypreserve(src, dest)
+                    gbl_tc_files.add(path.basename(dest))
                 
                     if self.verbose:
                         printv('Copying to PM map: %s -> %s' % (src, dest))
@@ -968,13 +921,14 @@ def update_global(self):
                 
                 copypreserve(src, dest)
                 abort_if(not os.path.isfile(dest), 'Cannot copy')
+                gbl_tc_files.add(dest_name_img)
                 
                 if self.verbose:
                     printv('Copying to global dedup: %s -> %s' % (src, dest))
 
         # 2. Copy crash sites
         for fname in os.listdir(self.img_dir):
-            should_copy = fname not in os.listdir(self.dedup_dir_gbl)
+            should_copy = fname not in gbl_names
 
             if nh.is_cmpr_crash_site(fname) and should_copy:
                 src = path.join(self.img_dir, fname)
@@ -984,6 +938,7 @@ def update_global(self):
                     printv('Copying cs %s -> %s' % (src, dest))
 
                 copypreserve(src, dest)
+                gbl_tc_files.add(fname)
 
     def update_local(self):
         """ @brief Copies testcases and images from global dedup store to local 
@@ -997,8 +952,8 @@ def update_local(self):
 
         printi('Updating local')
 
-        loc_tc_files = listdir(self.dedup_dir_loc)
-        loc_tc_files = [f.replace('.min', '') for f in loc_tc_files]
+        loc_tc_files = set(f.replace('.min', '') \
+                            for f in self.loc_manifest.names)
 
         # 1. Copy testcases
         for testcase, img in self.global_dedup_list_tc:
@@ -1034,6 +989,8 @@ def update_local(self):
                     printv(f'Copying to local dedup: {src} -> {dest}')
                 
                 copypreserve(src, dest)
+                self.loc_manifest.add(path.basename(dest))
+                loc_tc_files.add(path.basename(dest))
                 
                 if img != '':
                     # Copy image
@@ -1048,6 +1005,7 @@ def update_local(self):
                     
                     copypreserve(src, dest)
                     abort_if(not os.path.isfile(dest), 'Cannot copy')
+                    self.loc_manifest.add(path.basename(dest))
 
                 else:
                     abort('Image not found for %s' % dest_name_tc)
@@ -1061,6 +1019,7 @@ def update_local(self):
                 if self.verbose:
                     printv(f'Copying map to local dedup {src} -> {dest}')
                 copypreserve(src, dest)
+                self.loc_manifest.add(metadata_files['map'])
 
                 # Copy PM map
                 testcasebasename = os.path.basename(testcase)
@@ -1072,23 +1031,28 @@ def update_local(self):
                 if os.path.isfile(src):
                     copied = True
                     copypreserve(src, dest)
+                    self.loc_manifest.add(metadata_files['pm_map'])
                 
                 if copied:
                     self.printv(f'Copying map to local dedup {src} -> {dest}')
                 else:
                     self.printv(f'Did not find {src}')
 
-        if len(self.global_dedup_list_cs) == 0:
+        global_dedup_list_cs = self.global_dedup_list_cs
+
+        if len(global_dedup_list_cs) == 0:
             self.printv('Did not find any crash site in global dedup')
         else:
-            self.printv('=> ' + str(self.global_dedup_list_cs))
+            self.printv('=> ' + str(global_dedup_list_cs))
 
         # 2. Copy crash images
-        for cs in self.global_dedup_list_cs:
-            if path.basename(cs) not in os.listdir(self.dedup_dir_loc):
+        loc_cs_files = set(self.loc_manifest.names)
+        for cs in global_dedup_list_cs:
+            if path.basename(cs) not in loc_cs_files:
                 src = cs
                 dest = path.join(self.dedup_dir_loc, path.basename(src))
 
                 self.printv('Copying cs: %s -> %s' % (src, dest))
 
                 copypreserve(src, dest)
+                self.loc_manifest.add(path.basename(src))
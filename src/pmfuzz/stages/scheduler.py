@@ -0,0 +1,339 @@
+"""
+@file       scheduler.py
+@details    Orders the stage 2 testcases and crash sites and sizes their runs
+@copyright  2020-21 PMFuzz Authors
+
+SPDX-license-identifier: BSD-3-Clause
+
+Stage 2 asks its scheduler which candidates (testcases or crash sites in the
+local dedup store) to start first, how long to run them for and which runs
+are done. Two schedulers are available, selected using
+pmfuzz.stage.2.scheduler.mode:
+
+1. fifo: Runs the candidates in the order of the local dedup store, every run
+   gets tc_timeout seconds. This is the behavior of older versions.
+2. coverage: Runs the candidates that add the most PM coverage first. A
+   candidate's score is the number of tuples covered by its map but not by
+   the union of the PM maps in @dedup outside this iteration, decayed by its
+   lineage depth (nh.ancestor_cnt). Runs still finding paths at the end of
+   their slice at least as fast as the completed runs are extended, runs that
+   found nothing for a while are cut short.
+
+Every completed run is appended to @info/scheduler.csv with the coverage it
+was expected to find and the coverage it found per core-hour.
+"""
+
+import numpy as np
+import os
+import time
+
+from os import path
+
+import handlers.name_handler as nh
+
+from core import whatsup as wu
+from helper import common
+from helper.prettyprint import *
+from interfaces import afl
+
+class Scheduler:
+    """ @class FIFO scheduler, the base class for every scheduler """
+
+    name        = 'fifo'
+
+    REPORT_NAME = 'scheduler.csv'
+    REPORT_HDR  = ['time', 'stage', 'iter', 'tag', 'name', 'scheduler',
+                    'score', 'slice', 'runtime', 'paths_found',
+                    'expected_per_core_hour', 'achieved_per_core_hour']
+
+    def __init__(self, stage2, sched_cfg):
+        """ @brief Create a scheduler for a stage 2 iteration
+
+        @param stage2 Stage2 object the scheduler works for
+        @param sched_cfg dict with pmfuzz.stage.2.scheduler """
+
+        self.stage2     = stage2
+        self.timers     = stage2.timers
+        self.slice_len  = stage2.tc_timeout
+        self.report_f   = path.join(stage2.outdir, '@info', self.REPORT_NAME)
+
+        # tag -> [runs, paths found, core-hours] of the completed runs
+        self._completed = {}
+        self._load_report()
+
+    def _load_report(self):
+        """ @brief Reads the runs completed by earlier passes and processes
+        """
+
+        if not path.isfile(self.report_f):
+            return
+
+        with open(self.report_f, 'r') as obj:
+            obj.readline()
+            for line in obj:
+                row = dict(zip(self.REPORT_HDR, line.strip().split(',')))
+
+                try:
+                    self._add_completed(row['tag'], int(row['paths_found']),
+                        float(row['runtime'])/3600)
+                except (KeyError, ValueError):
+                    printw('Ignoring invalid line in %s: %s' \
+                        % (self.report_f, line.strip()))
+
+    def _add_completed(self, tag, paths_found, core_hours):
+        runs = self._completed.setdefault(tag, [0, 0, 0.0])
+        runs[0] += 1
+        runs[1] += paths_found
+        runs[2] += core_hours
+
+    def expected_rate(self, tag):
+        """ @brief Paths per core-hour found by the completed runs of a tag
+        @return float or None if no run completed yet """
+
+        runs = self._completed.get(tag, None)
+        if runs == None or runs[2] == 0:
+            return None
+
+        return runs[1]/runs[2]
+
+    def score(self, name, tag):
+        """ @brief Expected value of running a candidate, higher is better
+        @return float """
+
+        return 0.0
+
+    def order(self, names, tag):
+        """ @brief Orders the candidates to start
+
+        @param names List of clean names of the candidates, e.g.,
+               'id=000001,id=000002'
+        @param tag Timer tag of the candidates, Stage2.TIMER_TC or TIMER_CS
+        @return list of names in the order to start them """
+
+        return names
+
+    def slice(self, name, tag):
+        """ @brief Length of a new run
+        @return seconds """
+
+        return self.slice_len
+
+    def pop_expired(self, tag):
+        """ @brief Returns the runs of a tag that are done, see
+        TimerStore.pop_expired()
+        @return list of names """
+
+        return self.timers.pop_expired(tag)
+
+    def run_stats(self, name):
+        """ @brief Reads the fuzzer_stats of a run
+        @return dict or None if the run did not write it yet """
+
+        stats_f = path.join(self.stage2.get_result_dir(name), 'fuzzer_stats')
+
+        try:
+            with open(stats_f, 'r') as obj:
+                return afl.parse_fuzzer_stats(obj.read())
+        except FileNotFoundError:
+            return None
+
+    def finished(self, name, tag):
+        """ @brief Records a completed run to the report, should be called
+        before the run's AFL instance is stopped
+
+        @param name Clean name of the candidate
+        @param tag Timer tag of the candidate
+        @return None """
+
+        state = self.timers.state(name)
+        runtime = max(0, min(time.time(), state['start'] + state['length']) \
+                    - state['start'])
+
+        stats = self.run_stats(name)
+        paths_found = 0 if stats == None else stats.get('paths_found', 0)
+
+        core_hours = runtime/3600
+        expected = self.expected_rate(tag)
+        achieved = paths_found/core_hours if core_hours > 0 else 0
+
+        row = [int(time.time()), self.stage2.stage, self.stage2.iter_id, tag,
+                name, self.name, '%.2f' % self.score(name, tag),
+                int(state['length']), int(runtime), paths_found,
+                '' if expected == None else '%.2f' % expected,
+                '%.2f' % achieved]
+
+        os.makedirs(path.dirname(self.report_f), exist_ok=True)
+
+        write_hdr = not path.isfile(self.report_f)
+        with open(self.report_f, 'a') as obj:
+            if write_hdr:
+                obj.write(','.join(self.REPORT_HDR) + '\n')
+            obj.write(','.join(str(val) for val in row) + '\n')
+
+        self._add_completed(tag, paths_found, core_hours)
+
+        printi('Run %s found %d paths in %ds (%.2f/core-hour, expected %s)' \
+            % (name, paths_found, runtime, achieved,
+                'n/a' if expected == None else '%.2f' % expected))
+
+class CoverageScheduler(Scheduler):
+    """ @class Runs the candidates adding the most PM coverage first and
+    adapts the length of the runs to the rate they find new paths """
+
+    name        = 'coverage'
+
+    # Score multiplier per ancestor, prefers shallow lineages among
+    # candidates adding the same coverage
+    DEPTH_DECAY = 0.9
+
+    def __init__(self, stage2, sched_cfg):
+        super().__init__(stage2, sched_cfg)
+
+        self.max_extend = sched_cfg.get('max_extend', 2)
+        self.cut_after  = sched_cfg.get('cut_after', 0.5)
+
+        self._scores    = {}    # name -> score, the maps never change
+        self._base      = None  # Tuples not covered outside this iteration
+        self._base_gen  = None
+
+    def _uncovered(self):
+        """ @brief Tuples not covered by the PM maps in @dedup that are not
+        candidates of this iteration, recomputed when @dedup changes
+        @return numpy.ndarray of bool or None if there are no maps """
+
+        dedup   = self.stage2.dedup
+        gbl_mf  = dedup.gbl_manifest
+        loc_mf  = dedup.loc_manifest
+
+        gbl_names = gbl_mf.view(nh.is_pm_map)
+        if self._base_gen == gbl_mf.generation:
+            return self._base
+
+        names = sorted(gbl_names - loc_mf.view(nh.is_pm_map))
+        union = wu.merge_map_files([path.join(gbl_mf.dirpath,
+                    wu.pm_map_to_map(name)) for name in names])
+
+        self._base = None if union is None else union == 0
+        self._base_gen = gbl_mf.generation
+        self._scores = {}
+
+        return self._base
+
+    def _map_f(self, name):
+        """ @brief Map of a candidate, crash sites use the map of the
+        testcase they were generated from
+        @return path or None if the candidate has no PM map """
+
+        loc_mf = self.stage2.dedup.loc_manifest
+
+        tc_f = name + '.' + nh.TC_EXT
+        for tc in [tc_f, nh.get_testcase_parent(tc_f)]:
+            if tc == '':
+                continue
+
+            metadata = nh.get_metadata_files(tc)
+            if metadata['pm_map'] in loc_mf:
+                return path.join(loc_mf.dirpath, metadata['map'])
+
+        return None
+
+    def score(self, name, tag):
+        uncovered = self._uncovered()
+
+        if name in self._scores:
+            return self._scores[name]
+
+        novelty = 0
+        map_f = self._map_f(name)
+
+        if map_f != None:
+            cov_map = np.fromfile(map_f, dtype=np.uint8)
+            if uncovered is None:
+                novelty = wu.count_tuples(cov_map)
+            elif len(cov_map) == len(uncovered):
+                novelty = int(np.count_nonzero(
+                    np.logical_and(cov_map != 0, uncovered)))
+            else:
+                common.abort('Map size mismatch: ' + map_f)
+
+        depth = nh.ancestor_cnt(name + '.' + nh.TC_EXT)
+        result = (1 + novelty)*self.DEPTH_DECAY**depth
+        self._scores[name] = result
+
+        return result
+
+    def order(self, names, tag):
+        return sorted(names, key=lambda name: -self.score(name, tag))
+
+    def _extend(self, name, tag, now):
+        """ @brief Checks if a run that reached its deadline should continue
+        @return bool """
+
+        state = self.timers.state(name)
+        if state['length'] >= self.slice_len*(1 + self.max_extend):
+            return False
+
+        stats = self.run_stats(name)
+        runtime = now - state['start']
+        if stats == None or runtime <= 0:
+            return False
+
+        expected = self.expected_rate(tag)
+        rate = stats.get('paths_found', 0)/(runtime/3600)
+
+        return rate > 0 and (expected == None or rate >= expected)
+
+    def _stalled(self, name, now):
+        """ @brief Checks if a run found no new path for cut_after of a slice
+        @return bool """
+
+        state = self.timers.state(name)
+        if now - state['start'] < self.cut_after*self.slice_len:
+            return False
+
+        stats = self.run_stats(name)
+        if stats == None:
+            return False
+
+        last_path = max(stats.get('last_path', 0), state['start'])
+        return now - last_path >= self.cut_after*self.slice_len
+
+    def pop_expired(self, tag):
+        now = time.time()
+
+        cut = [name for name in self.timers.running(tag) \
+                if self._stalled(name, now)]
+        for name in cut:
+            printi('Cutting %s short, no new path in %ds' \
+                % (name, self.cut_after*self.slice_len))
+            self.timers.set_length(name,
+                now - self.timers.state(name)['start'] - 1)
+
+        result = []
+        for name in self.timers.pop_expired(tag):
+            if name not in cut and self._extend(name, tag, now):
+                length = self.timers.state(name)['length'] + self.slice_len
+                printi('Extending %s to %ds' % (name, length))
+                self.timers.set_length(name, length)
+            else:
+                result.append(name)
+
+        return result
+
+SCHEDULERS = {sched.name: sched for sched in [Scheduler, CoverageScheduler]}
+
+def from_cfg(cfg, stage2):
+    """ @brief Returns the scheduler configured in
+    pmfuzz.stage.2.scheduler.mode, configs without the key use fifo
+
+    @param cfg Config object
+    @param stage2 Stage2 object to schedule
+    @return Scheduler object """
+
+    sched_cfg = cfg['pmfuzz']['stage']['2'].get('scheduler', {'mode': 'fifo'})
+    mode = sched_cfg.get('mode', 'fifo')
+
+    common.abort_if(mode not in SCHEDULERS, 'Unknown scheduler %s, should ' \
+        'be one of ' % mode + ', '.join(SCHEDULERS))
+
+    return SCHEDULERS[mode](stage2, sched_cfg)
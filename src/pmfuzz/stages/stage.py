@@ -7,19 +7,31 @@
 """
 
 import datetime
+import tempfile
 import time
 
 from os import path
+from shutil import rmtree
 
+from helper import codec
 from helper import common
 from helper import config
 from helper.bugreport import BugReport
+from helper.crashsitedb import CrashSiteDB
+from helper.hashcache import HashCache
+from helper.parallel import Parallel
+from helper.parallel import WorkerPool
+from helper.parallel import in_worker
 from helper.target import Target as Tgt
 from stages.fuzzobj import FuzzObj
 
 class Stage(FuzzObj):
     """ @class Class for creating Stage objects """
 
+    # Signals of a crash site run that might be a bug: SIGILL, SIGFPE, 
+    # SIGBUS, SIGSEGV and SIGSYS
+    INTERESTING_SIG_NUM = [4, 8, 10, 11, 12]
+
     def __init__(self, name, srcdir, outdir, cfg, cores, verbose, 
             force_resp, dry_run):
 
@@ -31,7 +43,9 @@ def __init__(self, name, srcdir, outdir, cfg, cores, verbose,
         self.cores              = cores
         self.dry_run            = dry_run
 
-        self.crash_site_db_f    = path.join(self.outdir, '@crashsitehashes.db')
+        self.crash_site_db      = CrashSiteDB(self.outdir, verbose)
+        self.codec              = codec.from_cfg(cfg)
+        self.hash_cache         = HashCache(self.outdir)
 
     def save_possible_bug(self, tester_f, imgpath, cmd, env):
         bug_report = BugReport(tester_f, imgpath, cmd, env, self.outdir)
@@ -50,10 +64,63 @@ def check_crash_site(self, cspath):
         On a crash of the program, the details related to the crash are saved
         to the global crash database.
 
+        @see validate_crash_sites()
+
         @param cspath str Representing compelete path to the crash site
         @return None"""
 
-        INTERESTING_SIG_NUM = [4, 8, 10, 11, 12]
+        self.validate_crash_sites([cspath])
+
+    def validate_workers(self):
+        """ @brief Number of processes testing crash sites, set using
+        pmfuzz.failure_injection.validate.workers, 0 uses all the cores. 
+        Crash sites are tested one at a time in Parallel and WorkerPool 
+        workers, their callers already use all the cores.
+        @return int """
+
+        if in_worker():
+            return 1
+
+        val_cfg = self.cfg['pmfuzz']['failure_injection'].get('validate', {})
+        workers = val_cfg.get('workers', 0)
+
+        return max(1, self.cores if workers == 0 else workers)
+
+    def _test_crash_site(self, tester_f, cspath):
+        """ @brief Runs the target on a copy of a crash site, the target 
+        writes to the image it is given and the crash site should keep the
+        contents it was hashed with
+        @return Tuple (success, exit_code, cmd, env), cmd uses cspath """
+
+        tmpdir = tempfile.mkdtemp(prefix='pmfuzz-validate-', 
+                    dir=self.cfg('pmfuzz.img_loc'))
+        tmp_cs = path.join(tmpdir, path.basename(cspath))
+
+        try:
+            common.copypreserve(cspath, tmp_cs)
+            success, exit_code, cmd, env = \
+                Tgt(tester_f, self.cfg, self.verbose).test_img(tmp_cs)
+        finally:
+            rmtree(tmpdir)
+
+        cmd = [arg.replace(tmp_cs, cspath) for arg in cmd]
+        return success, exit_code, cmd, env
+
+    def validate_crash_sites(self, cspaths, digests=None):
+        """ Checks if crash sites work, same as check_crash_site() for each 
+        crash site
+
+        Crash sites are keyed on the hash of their contents. Only one crash
+        site per hash is tested, on a copy so the crash sites are not 
+        modified, in parallel using validate_workers() processes. The 
+        verdicts are saved in the crash site DB, so a hash tested earlier, by
+        any process, is not tested again. A possible bug is saved once, for 
+        the crash site it was found with.
+
+        @param cspaths List of complete paths to the crash sites
+        @param digests dict of crash site path -> sparse_sha256 digest for the
+               crash sites whose hash is already known
+        @return dict of crash site path -> digest for all the crash sites """
 
         tester_f_key = 'pmfuzz.failure_injection.test_with'
         tester_f = self.cfg(tester_f_key)
@@ -61,20 +128,65 @@ def check_crash_site(self, cspath):
         common.abort_if(tester_f == 'None', 'Key %s needs to be non None' \
             % tester_f_key)
 
-        tgt = Tgt(tester_f, self.cfg, self.verbose)
-        success, exit_code, cmd, env = tgt.test_img(cspath)
+        result = dict(digests) if digests != None else {}
+        for cspath in cspaths:
+            if cspath not in result:
+                result[cspath] = self.hash_cache.digest(cspath, 
+                                    'sparse_sha256')
 
-        if self.verbose:
-            common.printv('Testing %s, success = %s' % (cspath, str(success)))
+        verdicts = self.crash_site_db.get_verdicts(
+                    set(result[cspath] for cspath in cspaths), tester_f)
+
+        # One crash site per hash without a verdict
+        todo = {}
+        for cspath in cspaths:
+            digest = result[cspath]
+            if digest not in verdicts and digest not in todo:
+                todo[digest] = cspath
+
+        new_verdicts = []
+
+        def record(cspath, run):
+            if run == None:
+                return
+
+            success, exit_code, cmd, env = run
+
+            if self.verbose:
+                common.printv('Testing %s, success = %s' \
+                    % (cspath, str(success)))
 
-        # If the program was terminated with a signal
-        if exit_code < 0:
-            sig_num = -exit_code
+            # If the program was terminated with a signal
+            if exit_code != None and exit_code < 0:
+                sig_num = -exit_code
 
-            if sig_num in INTERESTING_SIG_NUM:
-                self.save_possible_bug(tester_f, cspath, cmd, env)
+                if sig_num in self.INTERESTING_SIG_NUM:
+                    self.save_possible_bug(tester_f, cspath, cmd, env)
+
+            new_verdicts.append((result[cspath], path.basename(cspath), 
+                success, exit_code))
+
+        jobs = [[tester_f, cspath] for cspath in todo.values()]
+        workers = min(self.validate_workers(), len(jobs))
+
+        if workers <= 1:
+            for job in jobs:
+                record(job[1], self._test_crash_site(*job))
+        else:
+            with WorkerPool(self._test_crash_site, workers, 
+                    failure_mode=Parallel.FAILURE_EXIT,
+                    name='Validate crash site', verbose=self.verbose) as pool:
+                for (_, cspath), run in pool.imap_unordered(jobs):
+                    record(cspath, run)
+
+        self.crash_site_db.set_verdicts(new_verdicts, tester_f)
+
+        if self.verbose:
+            common.printv('Validated %d crash sites: %d tested, %d known or '
+                'duplicate' % (len(cspaths), len(new_verdicts), 
+                    len(cspaths) - len(todo)))
 
-        return
+        return result
 
     @property
     def srcdir(self):
@@ -6,13 +6,12 @@
 SPDX-license-identifier: BSD-3-Clause
 """
 
-import pickledb
 import re 
 import sys
 
 from os import path, makedirs, listdir
 from random import randrange
-from shutil import which, rmtree
+from shutil import rmtree
 
 import handlers.name_handler as nh
 import interfaces.failureinjection as finj
@@ -58,6 +57,9 @@ def __init__(self, name, srcdir, outdir, cfg, cores, verbose,
         self.tc_dir     = path.join(stageoutdir, Dedup.TESTCASE_DIR)
         self.map_dir    = path.join(stageoutdir, Dedup.MAP_DIR)
 
+        # Testcases waiting for crash site generation, see collect_results()
+        self._cs_pending = None
+
         try: 
             makedirs(self.tc_dir)
         except OSError as e:
@@ -100,18 +102,15 @@ def run(self):
         self.test_img_creation()
 
     def whatsup(self):
-        """ Function that calls afl's whats-up tool on the result directory """        
+        """ Prints a summary of the fuzzer_stats of the stage 1 fuzzers """        
 
         afl_whatsup_bin = path.join(self.cfg['pmfuzz']['bin_dir'], 'afl-whatsup') 
 
-        if which('watch') is None:
-            abort('`watch\' not found, is it included in the $PATH?')
-
         afl_whatsup_cmd = [afl_whatsup_bin, '-s', self.afloutdir]
         printi('Use the following command to track progress:'
                 + '\n\t\twatch --color -n0.1 -d \'' 
                 + ' '.join(afl_whatsup_cmd) + '\'')
-        exec_shell(afl_whatsup_cmd, wait=True)
+        printi('Stage 1: ' + fmt_stage_stats(get_stage_stats(self.afloutdir)))
 
     def test_img_creation(self):
         """ Generates crash sites for testing image creation process """
@@ -129,6 +128,10 @@ def test_img_creation(self):
             with open(testcase_f, 'w') as obj:
                 obj.write(self.cfg('target.empty_img.stdin') + '\n')
 
+        # Latency of every crash site dump, written by libpmfuzz
+        fd, stats_f = tempfile.mkstemp(prefix='pmfuzz-img-creation-dumps-')
+        os.close(fd)
+
         finj.run_failure_inj(
             cfg         = self.cfg,
             tgtcmd      = self.cfg.tgtcmd,
@@ -137,10 +140,29 @@ def test_img_creation(self):
             clean_name  = 'id=000000',
             create      = True,
             verbose     = self.verbose,
+            stats_f     = stats_f,
         )
 
-        for img in glob(imgpath + '*'):
-            self.check_crash_site(img)
+        self.validate_crash_sites(glob(imgpath + '*'))
+
+        dumps = finj.read_dump_stats(stats_f)
+        os.remove(stats_f)
+
+        for dump in dumps:
+            self.printv('Failure point %d: %s, %d bytes in %.3f ms' \
+                % (dump['failure_id'], dump['method'], dump['bytes'], 
+                    dump['ns']/1e6))
+
+        if len(dumps) > 0:
+            latencies = sorted(dump['ns'] for dump in dumps)
+            methods = sorted(set(dump['method'] for dump in dumps))
+
+            printi('Dumped %d crash sites (%s): %.3f ms mean, %.3f ms max '
+                'per failure point' % (len(dumps), ', '.join(methods), 
+                    sum(latencies)/len(latencies)/1e6, latencies[-1]/1e6))
+        else:
+            printw('No crash site dump reported, is the target linked with '
+                'an older libpmfuzz?')
 
     def _collect_map(self, source_name, clean_name):
         """ Copy the maps from the queue directory to the local map directory 
@@ -184,9 +206,10 @@ def add_cs_hash_lcl(self):
         """ Adds hashes from .hash files in the self.img_dir to the db 
         @return None """
 
-        hash_db = pickledb.load(self.crash_site_db_f, True)
+        hash_fs = list(filter(nh.is_hash_f, os.listdir(self.img_dir)))
+        hashes = []
 
-        for fname in filter(nh.is_hash_f, os.listdir(self.img_dir)):
+        for fname in hash_fs:
             hash_f = path.join(self.img_dir, fname)
 
             with open(hash_f, 'r') as hash_obj:
@@ -196,15 +219,20 @@ def add_cs_hash_lcl(self):
                 abort_if(hash_v.count('\n') != 0, 
                     'Invalid hash value:' + hash_v)
 
-                hash_db.set(hash_k, hash_v)
-                hash_db.dump()
+                hashes.append((hash_k, hash_v))
 
-                if self.verbose:
-                    printv('Updated HashDB at %s with %s: %s' \
-                        % (self.crash_site_db_f, hash_k, hash_v))
-                    printw('Deleting ' + hash_f)
+        self.crash_site_db.set_many(hashes)
+
+        if self.verbose:
+            printv('Updated HashDB with %d hashes' % len(hashes))
+
+        for fname in hash_fs:
+            hash_f = path.join(self.img_dir, fname)
+
+            if self.verbose:
+                printw('Deleting ' + hash_f)
 
-                os.remove(hash_f)
+            os.remove(hash_f)
 
     def compress_new_crash_site(self, img):
         """ Compresses a specific crash site """
@@ -217,11 +245,8 @@ def compress_new_crash_site(self, img):
 
         clean_img = path.join(self.img_dir, crash_img_name)
 
-        # Check if this crash site works before compressing it
-        self.check_crash_site(img)
-
-        compress(img, clean_img+'.tar.gz', self.verbose, level=3, 
-            extra_params=['--transform', 's/pmfuzz-tmp-img-.........//'])
+        compress(img, clean_img+'.tar.gz', self.verbose, codec=self.codec,
+            arcname=crash_img_name)
 
     def compress_new_crash_sites(self, parent_img, clean_name):
         """ Compresses the crash sites generated for the parent img """
@@ -236,34 +261,39 @@ def compress_new_crash_sites(self, parent_img, clean_name):
             printv('Using pattern %s found %d images' \
                 % (crash_imgs_pattern, len(new_crash_imgs)))
 
-        hashdb = pickledb.load(self.crash_site_db_f, True)
+        # Generate the hash of all the crash sites
+        prl_hash = parallel.WorkerPool(
+            lambda img: self.hash_cache.digest(img, 'sparse_sha256'), 
+            self.cores, 
+            chunksize=8,
+            failure_mode=parallel.Parallel.FAILURE_EXIT,
+            name='Crash site hash',
+            verbose=self.verbose,
+        )
 
-        def get_hash(img):
-            clean_img = re.sub(r"<pid=\d+>", "", img)
-            crash_img_name = path.basename(clean_img)
+        hashes = []
+        digests = {}
 
-            # Remove the initial random part from the name
-            crash_img_name = crash_img_name[crash_img_name.index('.')+1:]
+        with prl_hash:
+            for (img,), hash_v in prl_hash.imap_unordered(
+                    [[img] for img in new_crash_imgs]):
+                digests[img] = hash_v
 
-            hash_v = sha256sum(img)
-            hash_f = path.join(self.img_dir, crash_img_name + '.hash')
-            with open(hash_f, 'w') as hash_obj:
-                hash_obj.write(hash_v)
+                clean_img = re.sub(r"<pid=\d+>", "", img)
+                crash_img_name = path.basename(clean_img)
 
-        # Generate the hash of all the crash sites
-        prl_hash = parallel.Parallel(
-            get_hash, 
-            self.cores, 
-            transparent_io=True, 
-            failure_mode=parallel.Parallel.FAILURE_EXIT
-        )
+                # Remove the initial random part from the name
+                hash_k = crash_img_name[crash_img_name.index('.')+1:]
 
-        for img in new_crash_imgs:
-            if self.verbose:
-                printv('Running hash collection for ' + img)
-            prl_hash.run([img])
+                hashes.append((hash_k, hash_v))
 
-        prl_hash.wait()
+                if self.verbose:
+                    printv('Updating HashDB with %s: %s' % (hash_k, hash_v))
+
+        self.crash_site_db.set_many(hashes)
+
+        # Check if the crash sites work before compressing them
+        self.validate_crash_sites(new_crash_imgs, digests)
 
         if self.verbose:
             printv('Now left: %d images' % (len(new_crash_imgs)))
@@ -327,6 +357,54 @@ def tc_gen_crash_sites(self, raw_tcname):
         if self.verbose:
             printv('Crash sites compressed')
 
+    def gen_crash_sites_batch(self, raw_tcnames, workers):
+        """ Generates crash sites for testcases using 
+        finj.run_failure_inj_batch(), all the testcases use the same empty
+        image
+
+        @see tc_gen_crash_sites()
+
+        @param raw_tcnames List of paths to the testcases
+        @param workers Number of fork servers to use
+        @return None """
+
+        printi('Generating crash images for %d testcases using %d fork '
+            'servers' % (len(raw_tcnames), workers))
+
+        start = time.time()
+
+        imgpaths = []
+        for _ in range(workers):
+            fd, imgpath = tempfile.mkstemp(prefix='pmfuzz-tmp-img-', 
+                            dir=self.cfg['pmfuzz']['img_loc'], 
+                            suffix='.' + nh.PM_IMG_EXT)
+            os.close(fd)
+            imgpaths.append(imgpath)
+
+        testcases = [(tc, nh.clean_tc_name(path.basename(tc))) \
+                        for tc in raw_tcnames]
+
+        with TempEmptyImage(self.cfg, self.verbose) as tmp_img:
+            done = list(finj.run_failure_inj_batch(self.cfg, 
+                        self.cfg.tgtcmd, tmp_img, testcases, imgpaths, 
+                        create=False, verbose=self.verbose))
+
+        # Compressed after the fork server threads are joined, it forks 
+        # worker processes
+        for _, clean_name, imgpath in done:
+            self.compress_new_crash_sites(imgpath, clean_name)
+
+        for imgpath in imgpaths:
+            if path.isfile(imgpath):
+                os.remove(imgpath)
+
+        self.add_cs_hash_lcl()
+
+        elapsed = time.time() - start
+        printi('Generated crash images for %d testcases in %.1fs (%.2f '
+            'testcases/s)' % (len(raw_tcnames), elapsed, 
+                len(raw_tcnames)/max(elapsed, 1e-6)))
+
     def collect_tc(self, source_name, clean_name):
         """ Copy the testcase from the queue directory to the local tc & img 
         dir and generate images 
@@ -362,45 +440,66 @@ def collect_tc(self, source_name, clean_name):
         if self.cfg['pmfuzz']['failure_injection']['enable']:
             randval = randrange(100)
             thresh = 5
-            if randval < thresh:
+            if randval < thresh and self._cs_pending != None:
+                self._cs_pending.append(orig_tc_path)
+            elif randval < thresh:
                 self.tc_gen_crash_sites(orig_tc_path)
             else:
                 self.printv('Skipping cs generation'\
                     +f' ({randval} < {thresh})')
 
 
-    def collect_results(self) -> None:
+    def collect_results(self, batch=None) -> int:
         """ Copies the results from the master fuzzer to local tc & img 
         directory 
         
-        @return None """
+        @param batch Max number of testcases to collect, oldest first, all if
+               None
+        @return Number of testcases left to collect """
         
-        found_cases = os.listdir(self.tc_dir)
-        gen_cases = [name for name in listdir(self.o_tc_dir) \
-                        if name.startswith('id') == True]
+        found_cases = set(os.listdir(self.tc_dir))
+        gen_cases = sorted(name for name in listdir(self.o_tc_dir) \
+                        if name.startswith('id') == True)
+
+        # Remove unnecessary information from testcase's name and check if 
+        # this testcase is not already copied 
+        pending = [(gen_case, nh.clean_tc_name(gen_case)) \
+                    for gen_case in gen_cases]
+        pending = [(gen_case, clean_name) for gen_case, clean_name in pending\
+                    if clean_name not in found_cases]
+
+        if batch != None:
+            todo = pending[:batch]
+        else:
+            todo = pending
 
-        cnt = 0
-        
-        for gen_case in gen_cases:
+        # Crash sites of the batch are generated using the fork servers once
+        # all of its testcases are collected
+        workers = finj.batch_workers(self.cfg, self.cores)
+        self._cs_pending = [] if workers > 0 else None
+
+        for gen_case, clean_name in todo:
+            self.collect_tc(gen_case, clean_name)
 
-            # Remove unnecessary information from testcase's name and check if 
-            # this testcase is not already copied 
-            clean_name = nh.clean_tc_name(gen_case)
-            if not clean_name in found_cases:
-                self.collect_tc(gen_case, clean_name)
-                cnt += 1
+        if workers > 0 and len(self._cs_pending) > 0:
+            self.gen_crash_sites_batch(self._cs_pending, workers)
+
+        self._cs_pending = None
 
         if self.verbose:
-            printv('%d cases processed (%d already exists).' \
-                % (cnt, len(found_cases)))
+            printv('%d cases processed (%d already exists, %d left).' \
+                % (len(todo), len(found_cases), len(pending) - len(todo)))
+
+        return len(pending) - len(todo)
 
-    def collect(self):
-        """ Collects all the testcases in the master_fuzzer's queue and copies
+    def collect(self, batch=None):
+        """ Collects the testcases in the master_fuzzer's queue and copies
         them to the local tc and img directory 
         
-        @return None """
+        @param batch Max number of testcases to collect, see collect_results()
+        @return Number of testcases left to collect """
 
         if self.verbose:
             printv('Collecting results from stage 1')
 
-        self.collect_results()
+        return self.collect_results(batch)
@@ -8,11 +8,9 @@
 
 from glob import glob
 import re
-import pickledb
 import psutil
 import signal
 import sys
-import time
 
 from enum import IntEnum, unique
 from os import path, makedirs, listdir, remove
@@ -24,12 +22,15 @@
 
 from core.dedupengine import DedupEngine
 from helper import config
+from helper import imgcache
 from helper.common import *
 from helper.parallel import Parallel
-from helper.ptimer import PTimer
+from helper.parallel import WorkerPool
+from helper.ptimer import TimerStore
 from interfaces.afl import *
 from helper.target import Target as tgt
 from helper.prettyprint import *
+from . import scheduler
 from .dedup import Dedup
 from .stage import Stage
 
@@ -38,6 +39,10 @@ class Stage2(Stage):
 
     CS_GEN_THRESH = 2
 
+    # Tags of the timers of testcases and crash sites in the TimerStore
+    TIMER_TC = 'tc'
+    TIMER_CS = 'cs'
+
     @unique
     class RunType(IntEnum):
         TC  = int('0b01', 2)
@@ -78,6 +83,45 @@ def __init__(self, stage, iter_id, srcdir, outdir, cfg, cores,
 
         self.tc_timeout = cfg['pmfuzz']['stage']['2']['tc_timeout']
 
+        # Timers of the testcases (tag TIMER_TC) and crash sites (tag 
+        # TIMER_CS) of this iteration
+        self.timers = TimerStore.get(self.dedup.dedup_dir_loc, verbose)
+        self._tag_migrated_timers()
+
+        # Decides the order and the length of the runs
+        self.scheduler = scheduler.from_cfg(cfg, self)
+
+        # Background minimization of the previous iteration, see 
+        # core.turnover
+        self.turnover = None
+
+        # Decompressed parent images, None if disabled
+        self.img_cache = imgcache.ImageCache.from_cfg(cfg, verbose)
+
+    def _tag_migrated_timers(self):
+        """ @brief Tags the timers imported from .ptimer files as testcase or
+        crash site timers
+        @return None """
+
+        untagged = self.timers.untagged()
+
+        for name in untagged:
+            cs_name = name + '.' + nh.CMPR_CRASH_SITE_EXT
+
+            if cs_name in self.dedup.loc_manifest:
+                self.timers.set_tag(name, Stage2.TIMER_CS)
+            else:
+                self.timers.set_tag(name, Stage2.TIMER_TC)
+
+        self.timers.flush()
+
+    @property
+    def next_deadline(self):
+        """ @brief Earliest deadline of the running testcases and crash sites
+        @return Time as returned by time.time(), None if nothing is running"""
+
+        return self.timers.next_deadline()
+
     def get_result_dir(self, name):
         """ Returns the path to the queue directory for a run
         @param name str representing the name of the run 
@@ -101,8 +145,7 @@ def kill_all(self):
                             .replace(self.dedup.EXT_TC, '')
 
             
-            ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                testcasename, self.verbose)
+            ptimer = self.timers.timer(testcasename)
             
             if not ptimer.is_new(): 
                 # If the timer was already started
@@ -154,9 +197,10 @@ def add_cs_hash_lcl(self):
         """ Adds hashes from .hash files in the self.img_dir to the db 
         @return None """
 
-        hash_db = pickledb.load(self.crash_site_db_f, True)
+        hash_fs = list(filter(nh.is_hash_f, os.listdir(self.img_dir)))
+        hashes = []
 
-        for fname in filter(nh.is_hash_f, os.listdir(self.img_dir)):
+        for fname in hash_fs:
             hash_f = path.join(self.img_dir, fname)
 
             with open(hash_f, 'r') as hash_obj:
@@ -166,14 +210,20 @@ def add_cs_hash_lcl(self):
                 abort_if(hash_v.count('\n') != 0, 
                     'Invalid hash value:' + hash_v)
 
-                hash_db.set(hash_k, hash_v)
-                hash_db.dump()
+                hashes.append((hash_k, hash_v))
 
-                if self.verbose:
-                    printv('Updated HashDB %s: %s' % (hash_k, hash_v))
-                    printw('Deleting ' + hash_f)
+        self.crash_site_db.set_many(hashes)
+
+        if self.verbose:
+            printv('Updated HashDB with %d hashes' % len(hashes))
+
+        for fname in hash_fs:
+            hash_f = path.join(self.img_dir, fname)
+
+            if self.verbose:
+                printw('Deleting ' + hash_f)
 
-                os.remove(hash_f)
+            os.remove(hash_f)
 
     def get_img_dir(self, testcasename):
         """ Returns the location of the image for a stage 2 run """
@@ -203,12 +253,15 @@ def _terminate_testcase(self, testcasename:str, timer):
         # Kill only if the pid file exists (indicating a running AFL process)
         if path.isfile(pid_f):
             printi('Killing ' + pid_f) 
+            self.scheduler.finished(testcasename, Stage2.TIMER_TC)
 
             with open(pid_f, 'r') as fobj:
                 pid = int(fobj.read().strip())
 
-            # Kill the running AFL instance
-            os.kill(pid, signal.SIGTERM) # Send signal 9
+            # Kill the running AFL instance, through its handle if this 
+            # process started it so a reused pid is never signalled
+            if not AFLSupervisor.get().stop(self.get_result_dir(testcasename)):
+                os.kill(pid, signal.SIGTERM)
 
             # Remove the pid file
             remove(pid_f)     
@@ -244,6 +297,10 @@ def _terminate_testcase(self, testcasename:str, timer):
                 verbose=self.verbose,
             )
             
+            # Testcases to generate crash sites for using the fork servers
+            cs_pending = []
+            batch_workers = finj.batch_workers(self.cfg, core_count)
+
             q_dir_contents = os.listdir(q_dir)
             q_dir_contents = [f for f in q_dir_contents if f.startswith('id')]
 
@@ -272,15 +329,21 @@ def _terminate_testcase(self, testcasename:str, timer):
                                         'queue', childtc)
 
                         randval = randrange(100)
-                        if randval < self.CS_GEN_THRESH:
-                            prl_gen_cs.run([tcdir_path])
-                        else:
+                        if randval >= self.CS_GEN_THRESH:
                             self.printv('Skipping cs generation'\
-                                +f' ({randval} < {self.CS_GEN_THRESH})')
+                                +f' ({randval} >= {self.CS_GEN_THRESH})')
+                        elif batch_workers > 0:
+                            cs_pending.append(tcdir_path)
+                        else:
+                            prl_gen_cs.run([tcdir_path])
 
             prl_ct.wait()
             prl_gen_cs.wait()
 
+            if len(cs_pending) > 0:
+                self.gen_crash_sites_batch(testcasename + '.' + nh.TC_EXT,
+                    cs_pending, batch_workers)
+
             printi('Cleaning up local uncompressed images')
             self.clean_up_uncmpr_lcl()
             self.add_cs_hash_lcl()
@@ -329,12 +392,15 @@ def _terminate_cs(self, csname:str, timer):
         # Kill only if the pid file exists (indicating a running AFL process)
         if path.isfile(pid_f):
             printi('Killing ' + pid_f) 
+            self.scheduler.finished(csname, Stage2.TIMER_CS)
 
             with open(pid_f, 'r') as fobj:
                 pid = int(fobj.read().strip())
 
-            # Kill the running AFL instance
-            os.kill(pid, signal.SIGTERM) # Send signal 9
+            # Kill the running AFL instance, through its handle if this 
+            # process started it so a reused pid is never signalled
+            if not AFLSupervisor.get().stop(self.get_result_dir(csname)):
+                os.kill(pid, signal.SIGTERM)
 
             # Remove the pid file
             remove(pid_f)     
@@ -380,6 +446,10 @@ def _terminate_cs(self, csname:str, timer):
                 verbose=self.verbose,
             )
             
+            # Testcases to generate crash sites for using the fork servers
+            cs_pending = []
+            batch_workers = finj.batch_workers(self.cfg, core_count)
+
             q_dir_contents = os.listdir(q_dir)
             q_dir_contents = [f for f in q_dir_contents if f.startswith('id')]
 
@@ -413,15 +483,21 @@ def _terminate_cs(self, csname:str, timer):
                                         'queue', childtc)
 
                         randval = randrange(100)
-                        if randval < self.CS_GEN_THRESH:
-                            prl_gen_cs.run([tcdir_path])
-                        else:
+                        if randval >= self.CS_GEN_THRESH:
                             self.printv('Skipping cs generation'\
-                                +f' ({randval} < {self.CS_GEN_THRESH})')
+                                +f' ({randval} >= {self.CS_GEN_THRESH})')
+                        elif batch_workers > 0:
+                            cs_pending.append(tcdir_path)
+                        else:
+                            prl_gen_cs.run([tcdir_path])
 
             prl_ct.wait()
             prl_gen_cs.wait()
 
+            if len(cs_pending) > 0:
+                self.gen_crash_sites_batch(csname + '.' + nh.TC_EXT,
+                    cs_pending, batch_workers)
+
             printi('Cleaning up local uncompressed images')
             self.clean_up_uncmpr_lcl()
             self.add_cs_hash_lcl()
@@ -433,7 +509,8 @@ def _terminate_cs(self, csname:str, timer):
             DedupEngine(
                 testcases_path, 
                 self.verbose, 
-                checker=nh.is_map
+                checker=nh.is_map,
+                hash_cache=self.hash_cache,
             ).run()
  
             lcl_cfg = self.cfg['pmfuzz']['stage']['dedup']['local']
@@ -473,7 +550,8 @@ def _run_testcase(self, testcasename:str):
 
         abort_if(img_path == "", 'Unable to set img path for %s.' % img_path)
 
-        decompress(img_src_path + '.tar.gz', imgdestdir, self.verbose)        
+        imgcache.decompress(self.img_cache, img_src_path + '.tar.gz', 
+            img_path, self.verbose)
 
         pids = run_afl(
             indir       = indir,
@@ -485,6 +563,7 @@ def _run_testcase(self, testcasename:str):
             persist_tgt = False,
             dry_run     = self.dry_run,
             gen_img     = False,
+            group       = Stage2.TIMER_TC,
         )
 
     def _run_cs(self, csname:str):
@@ -502,10 +581,10 @@ def _run_cs(self, csname:str):
 
         #TODO: Figure out a way to clean this up on completion
 
-        decompress(cspath, imgdir+'/', self.verbose)
-
         imgpm = path.join(imgdir, csname + '.' + nh.CRASH_SITE_EXT)
 
+        imgcache.decompress(self.img_cache, cspath, imgpm, self.verbose)
+
         indir           = self.srcdir
         outdir          = path.join(self.outdir, nh.get_outdir_name(
                             self.stage, self.iter_id), 
@@ -525,65 +604,62 @@ def _run_cs(self, csname:str):
             persist_tgt = False,
             dry_run     = self.dry_run,
             gen_img     = False,
+            group       = Stage2.TIMER_CS,
         )
 
-        # Wait for AFL to start and see if it works
+        # run_afl() waited for AFL to start, see if it works
         if self.verbose:
             printv('Checking for PID: ' + str(pids))
-            
-        time.sleep(5)
-        for pid in pids:
-            abort_if(not psutil.pid_exists(pid), 
-                f'AFL crashed for pid {pid}')
+
+        abort_if(AFLSupervisor.get().failed(self.get_result_dir(csname)),
+            f'AFL crashed for pid {pids}')
+
+    def _check_running(self, tag, label):
+        """ @brief Aborts if an AFL instance of a tag died before its timer
+        expired
+
+        @param tag Timer tag of the instances, TIMER_TC or TIMER_CS
+        @param label Prefix for the error message
+        @return Number of running instances """
+
+        supervisor = AFLSupervisor.get()
+        running = self.timers.running(tag)
+
+        failed = supervisor.failures(tag)
+        abort_if(len(failed) != 0, 
+            f'[{label}] AFL crashed for {", ".join(sorted(failed))}')
+
+        # Every running instance was started by this process
+        if supervisor.running_count(tag) == len(running):
+            return len(running)
+
+        # Instances left running by an earlier PMFuzz process can only be
+        # checked through their pid files
+        for name in running:
+            if supervisor.tracks(self.get_result_dir(name)):
+                continue
+
+            pid_f = path.join(self.get_result_dir(name), 'pid')
+            with open(pid_f, 'r') as obj:
+                pid = int(obj.read())
+                abort_if(not psutil.pid_exists(pid), 
+                    f'[{label}] AFL crashed for pid {pid}')
+
+        return len(running)
 
     def get_run_count(self, type=RunType.ALL):
         """ Get the total number of runnning testcases """
 
         result = 0
 
-        if type&Stage2.RunType.TC:
-            run_count = 0
-            for testcasepath, imgpath in self.dedup.local_dedup_list_st2:
-                
-                testcasename = path.basename(testcasepath)\
-                                .replace(self.dedup.EXT_TC, '')
-                
-                ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                    testcasename, self.verbose)
+        # Collect the AFL instances that exited since the last call
+        AFLSupervisor.get().reap()
 
-                if not ptimer.is_new() and not ptimer.expired():
-                    run_count += 1
-
-                    # Check if the process is still running
-                    pid_f = path.join(self.get_result_dir(testcasename), 'pid')
-                    with open(pid_f, 'r') as obj:
-                        pid = int(obj.read())
-                        abort_if(not psutil.pid_exists(pid), 
-                            f'[TC] AFL crashed for pid {pid}')
-                                
-            result += run_count
+        if type&Stage2.RunType.TC:
+            result += self._check_running(Stage2.TIMER_TC, 'TC')
 
         if type&Stage2.RunType.CS:
-            run_count = 0
-            for cspath in self.dedup.local_dedup_list_cs_st2:
-                
-                csname = path.basename(cspath)\
-                                .replace('.'+nh.CMPR_CRASH_SITE_EXT, '')
-                
-                ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                    csname, self.verbose)
-
-                if not ptimer.is_new() and not ptimer.expired():
-                    run_count += 1
-
-                    # Check if the process is still running
-                    pid_f = path.join(self.get_result_dir(csname), 'pid')
-                    with open(pid_f, 'r') as obj:
-                        pid = int(obj.read())
-                        abort_if(not psutil.pid_exists(pid), 
-                            f'[CS] AFL crashed for pid {pid}')
-                                
-            result += run_count
+            result += self._check_running(Stage2.TIMER_CS, 'CS')
     
         return result
 
@@ -591,31 +667,18 @@ def show_progress(self, type):
         """ Print the progress of currently running instances """
 
         if type&Stage2.RunType.TC:
-            for testcasepath, imgpath in self.dedup.local_dedup_list_st2:
-                
-                testcasename = path.basename(testcasepath)\
-                                .replace(self.dedup.EXT_TC, '')
-                
-                ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                    testcasename, self.verbose)
+            for testcasename in sorted(self.timers.running(Stage2.TIMER_TC)):
+                ptimer = self.timers.timer(testcasename)
 
-                if not ptimer.is_new() and not ptimer.expired():
-                    printi('elapsed (tc): ' + str(ptimer.elapsed_hr()) \
-                                + ' ' + ptimer.elapsed_pb())
+                printi('elapsed (tc): ' + str(ptimer.elapsed_hr()) \
+                            + ' ' + ptimer.elapsed_pb())
 
         if type&Stage2.RunType.CS:
-            run_count = 0
-            for cspath in self.dedup.local_dedup_list_cs_st2:
-                
-                csname = path.basename(cspath)\
-                                .replace('.'+nh.CMPR_CRASH_SITE_EXT, '')
-                
-                ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                    csname, self.verbose)
+            for csname in sorted(self.timers.running(Stage2.TIMER_CS)):
+                ptimer = self.timers.timer(csname)
 
-                if not ptimer.is_new() and not ptimer.expired():
-                    printi('elapsed (cs): ' + str(ptimer.elapsed_hr()) \
-                                + ' ' + ptimer.elapsed_pb())
+                printi('elapsed (cs): ' + str(ptimer.elapsed_hr()) \
+                            + ' ' + ptimer.elapsed_pb())
     
     def resume(self):
         """ Resumes a already running stage
@@ -653,71 +716,69 @@ def resume(self):
         printi('Slots TC: ' + str(cores_tc))
         printi('Slots CS: ' + str(cores_cs))
 
-        # Create timers for all the testcases
-        for testcasepath, imgpath in self.dedup.local_dedup_list_st2:
-
-            # Get the name to construct a timer for the testcase
-            testcasename = path.basename(testcasepath)\
-                            .replace(self.dedup.EXT_TC, '')
-            
-            ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                testcasename, self.verbose)
-            
-            if not ptimer.is_new(): 
-                # If the timer was already started
-                if ptimer.expired():
-
-                    # Stop this testcase
-                    self._terminate_testcase(testcasename, None)
-                    #!
-                    #! todo: run_count -= 1
-            else:
+        # Stop the testcases the scheduler is done with since the last pass
+        for testcasename in self.scheduler.pop_expired(Stage2.TIMER_TC):
+            self._terminate_testcase(testcasename, None)
 
-                # Run only if there are cores available 
-                if run_count < cores_tc:
+        # Testcases that were never started, in the order to start them
+        new_tcs = [path.basename(testcasepath).replace(self.dedup.EXT_TC, '')\
+                    for testcasepath, _ in self.dedup.local_dedup_list_st2]
+        new_tcs = [testcasename for testcasename in new_tcs \
+                    if self.timers.timer(testcasename).is_new()]
 
-                    printi('Starting new testcase: %s' % testcasename)
+        # Start timers for new testcases while there are cores available
+        for testcasename in self.scheduler.order(new_tcs, Stage2.TIMER_TC):
+            if run_count >= cores_tc:
+                break
 
-                    # This testcase was never started
-                    ptimer.start_new(self.tc_timeout)
-                    self._run_testcase(testcasename)
+            ptimer = self.timers.timer(testcasename)
             
-                    run_count += 1
+            if ptimer.is_new(): 
+                printi('Starting new testcase: %s' % testcasename)
+
+                # This testcase was never started
+                ptimer.start_new(
+                    self.scheduler.slice(testcasename, Stage2.TIMER_TC), 
+                    Stage2.TIMER_TC)
+                self._run_testcase(testcasename)
+        
+                run_count += 1
 
         if finj_enabled:
             run_count = self.get_run_count(type=Stage2.RunType.CS)
             printi('CS occupancy: ' + str(run_count))
 
-            # Create timers for all the crash images
-            for cspath in self.dedup.local_dedup_list_cs_st2:
+            # Stop the crash sites the scheduler is done with
+            for csname in self.scheduler.pop_expired(Stage2.TIMER_CS):
+                self._terminate_cs(csname, None)
 
-                # Get the name to construct a timer for the testcase
-                csname = path.basename(cspath)\
-                            .replace('.' + nh.CMPR_CRASH_SITE_EXT, '')
+            # Crash sites that were never started, in the order to start them
+            new_css = [path.basename(cspath)\
+                            .replace('.' + nh.CMPR_CRASH_SITE_EXT, '') \
+                        for cspath in self.dedup.local_dedup_list_cs_st2]
+            new_css = [csname for csname in new_css \
+                        if self.timers.timer(csname).is_new()]
 
-                
-                ptimer = PTimer(self.dedup.dedup_dir_loc, csname, self.verbose)
-                
-                if not ptimer.is_new(): 
-                    # If the timer was already started
-                    if ptimer.expired():
-
-                        # Stop this testcase
-                        self._terminate_cs(csname, None)
-                        #!
-                        #! todo: run_count -= 1
-                else:
+            # Start timers for new crash sites while there are cores available
+            for csname in self.scheduler.order(new_css, Stage2.TIMER_CS):
+                if run_count >= cores_cs:
+                    break
 
-                    # Run only if there are cores available 
-                    if run_count < cores_cs:
+                ptimer = self.timers.timer(csname)
+                
+                if ptimer.is_new(): 
+                    printi('Starting new crash site fuzzing: %s' % csname)
 
-                        printi('Starting new crash site fuzzing: %s' % csname)
+                    # This testcase was never started
+                    ptimer.start_new(
+                        self.scheduler.slice(csname, Stage2.TIMER_CS), 
+                        Stage2.TIMER_CS)
+                    self._run_cs(csname)
+            
+                    run_count += 1
 
-                        # This testcase was never started
-                        ptimer.start_new(self.tc_timeout)
-                        self._run_cs(csname)
-                
-                        run_count += 1
+        # Timers started or stopped by this pass are written out together
+        self.timers.flush()
 
         self.show_progress(Stage2.RunType.ALL)
             
@@ -753,17 +814,17 @@ def process_new_crash_sites(self, parent_img, clean_name):
             printv('Using pattern %s found %d images' \
                 % (crash_imgs_pattern, len(new_crash_imgs)))
 
-        for img in new_crash_imgs:
-            # Check the crash site for segfaults and non-zero exit codes
-            self.check_crash_site(img)
+        # Check the crash sites for segfaults and non-zero exit codes
+        digests = self.validate_crash_sites(new_crash_imgs)
 
+        for img in new_crash_imgs:
             clean_img = re.sub(r"<pid=\d+>", "", img)
 
             # Only compress a crash site if it would ever be used
             if self.dedup.should_use_cs(clean_img):
                 self.printv(f'Compressing: {img} -> {clean_img}.tar.gz')
-                compress(img, clean_img+'.tar.gz', self.verbose, level=3,
-                    extra_params=['--transform', r's/<pid=[[:digit:]]\+>//'])
+                compress(img, clean_img+'.tar.gz', self.verbose,
+                    codec=self.codec, arcname=path.basename(clean_img))
 
                 src = clean_img+'.tar.gz'
                 dst = path.join(self.img_dir, path.basename(clean_img+'.tar.gz'))
@@ -777,11 +838,10 @@ def process_new_crash_sites(self, parent_img, clean_name):
                     self.img_dir, 
                     path.basename(clean_img) + '.hash')
 
-                with open(hash_f, 'w') as hash_obj:
-                    hash_obj.write(sha256sum(img))
+                hash_v = digests[img]
 
-                hash_k = path.basename(img)
-                hash_v = sha256sum(img)
+                with open(hash_f, 'w') as hash_obj:
+                    hash_obj.write(hash_v)
 
                 os.remove(src)
 
@@ -831,12 +891,15 @@ def tc_gen_crash_sites(self, raw_tcname):
         parent_img_uniq = path.join(pm_dir, parent_img_name_uniq)
         
         # Decompres+Copy the image
-        if not os.path.isfile(parent_img):
-            decompress(parent_cmpr_img, parent_img, self.verbose)
-        printv('tempimg: %s -> %s' % (parent_cmpr_img, parent_img))
+        if self.img_cache != None:
+            self.img_cache.get(parent_cmpr_img, parent_img_uniq)
+        else:
+            if not os.path.isfile(parent_img):
+                decompress(parent_cmpr_img, parent_img, self.verbose)
+            printv('tempimg: %s -> %s' % (parent_cmpr_img, parent_img))
 
-        copypreserve(parent_img, parent_img_uniq)
-        printv('unique image: %s -> %s' % (parent_img, parent_img))
+            copypreserve(parent_img, parent_img_uniq)
+            printv('unique image: %s -> %s' % (parent_img, parent_img))
 
         finj.run_failure_inj(self.cfg, self.cfg.tgtcmd, parent_img_uniq, raw_tcname, 
             clean_name, self.verbose)
@@ -859,6 +922,75 @@ def tc_gen_crash_sites(self, raw_tcname):
         if self.verbose:
             printv('Crash sites compressed')
 
+    def gen_crash_sites_batch(self, parent_name, raw_tcnames, workers):
+        """ Generates crash sites for testcases of the same parent using
+        finj.run_failure_inj_batch(), the parent image is decompressed once 
+        and the crash sites are processed once all the runs complete and the
+        fork server threads are joined
+
+        @param parent_name Name of the parent testcase, e.g., 
+               'id=000001.testcase'
+        @param raw_tcnames List of paths to the testcases
+        @param workers Number of fork servers to use
+        @return None """
+
+        printi('Generating crash images for %d testcases of %s using %d '
+            'fork servers' % (len(raw_tcnames), parent_name, workers))
+
+        start = time.time()
+
+        parent_cmpr_img = nh.get_parent_img(
+            parent_name, self.dedup.dedup_dir_gbl, 'exists', 
+            isparent=True, verbose=self.verbose)
+
+        if parent_cmpr_img.endswith(nh.CMPR_PM_IMG_EXT):
+            parent_img_name = nh.get_metadata_files(parent_name)['pm_pool']
+        else:
+            parent_img_name = nh.get_metadata_files(parent_name)['crash_site']
+
+        pm_dir = tempfile.mkdtemp(prefix='pmfuzz-cs-gen-st2-', 
+            dir=self.cfg('pmfuzz.img_loc'))
+        parent_img = path.join(pm_dir, parent_img_name)
+        imgcache.decompress(self.img_cache, parent_cmpr_img, parent_img, 
+            self.verbose)
+
+        # Every worker has its own directory, the images have the same name
+        # as the unique images of tc_gen_crash_sites()
+        img_name = nh.get_metadata_files(parent_name)['clean'] + '<pid=' \
+                    + str(os.getpid()) + '>' + '.' + nh.CRASH_SITE_EXT
+        worker_dirs = [tempfile.mkdtemp(prefix='pmfuzz-cs-gen-st2-', 
+                        dir=self.cfg('pmfuzz.img_loc')) \
+                            for _ in range(workers)]
+
+        prl_proc_cs = Parallel(
+            self.process_new_crash_sites,
+            max(1, workers//2), 
+            transparent_io=True,
+            failure_mode=Parallel.FAILURE_EXIT,
+            name='Process Crash Site',
+            verbose=self.verbose,
+        )
+
+        testcases = [(tc, nh.clean_tc_name(path.basename(tc))) \
+                        for tc in raw_tcnames]
+        imgpaths = [path.join(dirpath, img_name) for dirpath in worker_dirs]
+
+        done = list(finj.run_failure_inj_batch(self.cfg, self.cfg.tgtcmd, 
+                    parent_img, testcases, imgpaths, verbose=self.verbose))
+
+        for _, clean_name, imgpath in done:
+            prl_proc_cs.run([imgpath, clean_name])
+
+        prl_proc_cs.wait()
+
+        for dirpath in worker_dirs + [pm_dir]:
+            rmtree(dirpath)
+
+        elapsed = time.time() - start
+        printi('Generated crash images for %d testcases in %.1fs (%.2f '
+            'testcases/s)' % (len(raw_tcnames), elapsed, 
+                len(raw_tcnames)/max(elapsed, 1e-6)))
+
     def collect_tc(self, o_tc_dir:str, source_name:str, clean_name:str):
         """ Copy the testcase from the queue directory to the local tc & img 
         dir and generate images.
@@ -931,16 +1063,17 @@ def collect_results(self) -> None:
         # Get all the output directories for all the testcases that were run
         o_dirs = self.get_o_tc_dirs()
 
-        # Create a parallel object
-        prl = Parallel(
+        # Create a pool of workers
+        prl = WorkerPool(
             self.collect_tc, 
             self.cores, 
             failure_mode=Parallel.FAILURE_EXIT,
-            transparent_io=False,
+            capture_io=True,
+            name='Collect TC',
             verbose=self.verbose
         )
 
-        cnt = 0
+        jobs = []
         found_cases = os.listdir(self.tc_dir)
 
         # Collect testcases from all of them
@@ -958,10 +1091,12 @@ def collect_results(self) -> None:
                 # if this testcase is not already copied 
                 clean_name = parent_name + nh.clean_tc_name(gen_case)
                 if not path.basename(clean_name) in found_cases:
-                    prl.run([o_dir, gen_case, clean_name])
-                    cnt += 1
+                    jobs.append([o_dir, gen_case, clean_name])
         
-        prl.wait()
+        with prl:
+            prl.map(jobs)
+
+        cnt = len(jobs)
 
         if self.verbose:
             printv('%d cases processed (%d already exists).' \
@@ -1017,8 +1152,7 @@ def completed(self):
             testcasename = path.basename(testcasepath)\
                             .replace(self.dedup.EXT_TC, '')
             
-            ptimer = PTimer(self.dedup.dedup_dir_loc, 
-                                testcasename, self.verbose)
+            ptimer = self.timers.timer(testcasename)
             
             if self.verbose:
                 printv('%s: is_new=%s, expired=%s' % \